@@ -0,0 +1,108 @@
+# Gemini usage report: token totals, cost and a 30-day cost projection, latency
+# percentiles and outcomes, from the ai_call_logs table.
+#
+# Usage: python ai_cost_report.py [--days 30] [--company-id N]
+#                                 [--input-price USD_PER_1M] [--output-price USD_PER_1M]
+
+import argparse
+import os
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+from app import app  # Import your Flask app
+from caches import get_company
+from config import GEMINI_INPUT_PRICE_PER_MTOK, GEMINI_OUTPUT_PRICE_PER_MTOK
+from models import AICallLog
+from stats import percentile
+
+DAYS_PER_MONTH = 30
+
+
+def summarize(logs, input_price, output_price):
+    prompt_tokens = sum(log.prompt_tokens or 0 for log in logs)
+    output_tokens = sum(log.output_tokens or 0 for log in logs)
+    latencies = sorted(log.latency_ms for log in logs if log.latency_ms is not None)
+    return {
+        'calls': len(logs),
+        'prompt_tokens': prompt_tokens,
+        'output_tokens': output_tokens,
+        'cost': prompt_tokens / 1_000_000 * input_price + output_tokens / 1_000_000 * output_price,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'retries': sum(log.retries or 0 for log in logs),
+        'outcomes': Counter(log.outcome for log in logs),
+    }
+
+
+def print_row(label, summary, monthly_factor):
+    p50 = f"{summary['p50_ms']:,}" if summary['p50_ms'] is not None else '-'
+    p95 = f"{summary['p95_ms']:,}" if summary['p95_ms'] is not None else '-'
+    print(f"{label:<32} {summary['calls']:>7,} {summary['prompt_tokens']:>12,} {summary['output_tokens']:>12,} "
+          f"{summary['cost']:>10.4f} {summary['cost'] * monthly_factor:>12.4f} {p50:>8} {p95:>8} {summary['retries']:>7,}")
+
+
+def generate_report(days, company_id, input_price, output_price):
+    since = datetime.utcnow() - timedelta(days=days)
+    with app.app_context():
+        query = AICallLog.query.filter(AICallLog.created_at >= since)
+        if company_id is not None:
+            query = query.filter(AICallLog.company_id == company_id)
+        logs = query.order_by(AICallLog.created_at).all()
+
+        if not logs:
+            print(f"No Gemini calls recorded in the last {days} days.")
+            return
+
+        monthly_factor = DAYS_PER_MONTH / days
+        print(f"Gemini usage for the last {days} days (since {since:%Y-%m-%d %H:%M} UTC)")
+        print(f"Prices: ${input_price}/1M input tokens, ${output_price}/1M output tokens; "
+              f"monthly projection = cost x {monthly_factor:.2f}")
+        print()
+        header = (f"{'':<32} {'calls':>7} {'prompt tok':>12} {'output tok':>12} "
+                  f"{'cost USD':>10} {'USD/month':>12} {'p50 ms':>8} {'p95 ms':>8} {'retries':>7}")
+        print(header)
+        print('-' * len(header))
+
+        total = summarize(logs, input_price, output_price)
+        print_row('All calls', total, monthly_factor)
+
+        by_type = defaultdict(list)
+        by_company = defaultdict(list)
+        for log in logs:
+            by_type[log.call_type].append(log)
+            by_company[log.company_id].append(log)
+
+        print()
+        for call_type, type_logs in sorted(by_type.items()):
+            print_row(f"type: {call_type}", summarize(type_logs, input_price, output_price), monthly_factor)
+
+        print()
+        for company_id_key, company_logs in sorted(by_company.items(), key=lambda item: len(item[1]), reverse=True):
+            company = get_company(company_id_key)
+            label = company.name if company else f"company {company_id_key}"
+            print_row(f"company: {label}"[:32], summarize(company_logs, input_price, output_price), monthly_factor)
+
+        print()
+        print("Outcomes: " + ', '.join(f"{outcome}={count}" for outcome, count in total['outcomes'].most_common()))
+        capa_count = len({log.capa_id for log in logs if log.capa_id is not None})
+        if capa_count:
+            print(f"Average cost per CAPA: ${total['cost'] / capa_count:.4f} over {capa_count} CAPAs")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report Gemini token usage, cost and latency.")
+    parser.add_argument('--days', type=int, default=30, help="Look-back window in days (default: 30)")
+    parser.add_argument('--company-id', type=int, default=None, help="Only include calls for this company")
+    parser.add_argument('--input-price', type=float, default=GEMINI_INPUT_PRICE_PER_MTOK,
+                        help="USD per 1M prompt tokens")
+    parser.add_argument('--output-price', type=float, default=GEMINI_OUTPUT_PRICE_PER_MTOK,
+                        help="USD per 1M output tokens (thinking tokens included)")
+    args = parser.parse_args()
+    if args.days <= 0:
+        parser.error("--days must be positive")
+    generate_report(args.days, args.company_id, args.input_price, args.output_price)
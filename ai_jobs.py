@@ -0,0 +1,120 @@
+# Inspect and cancel the AI jobs of the scheduler in ai_scheduler.py, from the ai_jobs table.
+#
+# Usage: python ai_jobs.py list [--status queued,running] [--priority bulk] [--company-id N]
+#        python ai_jobs.py summary
+#        python ai_jobs.py cancel JOB_ID [JOB_ID ...]
+#        python ai_jobs.py cancel --all [--priority bulk] [--company-id N]
+#        python ai_jobs.py purge [--days 30]
+#
+# Only queued jobs can be cancelled; a running job finishes. Jobs left 'queued' or 'running'
+# by a worker process that died (see the worker column) are never picked up again; cancel them.
+
+import argparse
+import os
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+from app import app  # Import your Flask app
+from ai_scheduler import PRIORITIES
+from models import db, AIJob
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+
+def filtered(query, priority, company_id):
+    if priority is not None:
+        query = query.filter(AIJob.priority == priority)
+    if company_id is not None:
+        query = query.filter(AIJob.company_id == company_id)
+    return query
+
+
+def list_jobs(statuses, priority, company_id):
+    jobs = filtered(AIJob.query.filter(AIJob.status.in_(statuses)), priority, company_id) \
+        .order_by(AIJob.created_at, AIJob.id).all()
+    if not jobs:
+        print(f"No {'/'.join(statuses)} AI jobs.")
+        return
+    now = datetime.utcnow()
+    header = (f"{'id':>8} {'status':<9} {'priority':<11} {'stage':<12} {'capa':>6} {'company':>7} "
+              f"{'age s':>7} {'worker':<28} error")
+    print(header)
+    print('-' * len(header))
+    for job in jobs:
+        print(f"{job.id:>8} {job.status:<9} {job.priority:<11} {job.stage:<12} {job.capa_id or '-':>6} "
+              f"{job.company_id or '-':>7} {int((now - job.created_at).total_seconds()):>7} {job.worker:<28} "
+              f"{job.error_message or ''}")
+
+
+def summary():
+    counts = Counter(db.session.query(AIJob.status, AIJob.priority)
+                     .filter(AIJob.status.in_(ACTIVE_STATUSES)).all())
+    if not counts:
+        print("No queued or running AI jobs.")
+        return
+    print(f"{'priority':<11} {'queued':>7} {'running':>8}")
+    for priority in PRIORITIES:
+        print(f"{priority:<11} {counts[('queued', priority)]:>7} {counts[('running', priority)]:>8}")
+
+
+def cancel(job_ids, cancel_all, priority, company_id):
+    query = AIJob.query.filter(AIJob.status == 'queued')
+    if job_ids:
+        query = query.filter(AIJob.id.in_(job_ids))
+    elif not cancel_all:
+        print("Give job ids, or --all to cancel every queued job (optionally per --priority / --company-id).")
+        return
+    cancelled = filtered(query, priority, company_id).update(
+        {AIJob.status: 'cancelled', AIJob.finished_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    print(f"Cancelled {cancelled} queued AI job(s).")
+    if job_ids and cancelled < len(job_ids):
+        print("Jobs that were not queued any more (running or finished) were left alone.")
+
+
+def purge(days):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    deleted = AIJob.query.filter(AIJob.status.in_(FINISHED_STATUSES), AIJob.created_at < cutoff) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Deleted {deleted} finished AI job(s) older than {days} days.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and cancel scheduled AI jobs.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help="List AI jobs (default: queued and running).")
+    list_parser.add_argument('--status', default=','.join(ACTIVE_STATUSES),
+                             help="Comma-separated statuses to show (queued, running, done, failed, cancelled).")
+    commands.add_parser('summary', help="Queued and running jobs per priority.")
+    cancel_parser = commands.add_parser('cancel', help="Cancel queued jobs.")
+    cancel_parser.add_argument('job_ids', nargs='*', type=int, help="Ids of the jobs to cancel.")
+    cancel_parser.add_argument('--all', action='store_true', help="Cancel every queued job matching the filters.")
+    purge_parser = commands.add_parser('purge', help="Delete finished jobs.")
+    purge_parser.add_argument('--days', type=int, default=30, help="Keep finished jobs this many days (default: 30).")
+    for sub_parser in (list_parser, cancel_parser):
+        sub_parser.add_argument('--priority', choices=PRIORITIES, default=None, help="Only jobs of this priority.")
+        sub_parser.add_argument('--company-id', type=int, default=None, help="Only jobs of this company.")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == 'list':
+            list_jobs([status.strip() for status in args.status.split(',') if status.strip()],
+                      args.priority, args.company_id)
+        elif args.command == 'summary':
+            summary()
+        elif args.command == 'cancel':
+            cancel(args.job_ids, args.all, args.priority, args.company_id)
+        elif args.command == 'purge':
+            purge(args.days)
+
+
+if __name__ == '__main__':
+    main()
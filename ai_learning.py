@@ -1,5 +1,12 @@
+import hashlib
 import json
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from cachetools import TTLCache
+from flask import current_app
+from sqlalchemy import case, func
 from models import db, AIKnowledgeBase, RootCause, CapaIssue, ActionPlan
 from sentence_transformers import SentenceTransformer
 import numpy as np
@@ -7,16 +14,27 @@ import os
 from sklearn.metrics.pairwise import cosine_similarity
 import logging
 
+from config import (
+    RCA_PREFETCH_CACHE_MAX_ENTRIES,
+    RCA_PREFETCH_CACHE_TTL_SECONDS,
+    RCA_PREFETCH_ENABLED,
+    RCA_PREFETCH_WORKERS
+)
+from logging_config import PAYLOAD, describe_array
+from metrics import rca_prefetch_lookups_total, timed
+from prompt_builder import stored_snippet
+
+logger = logging.getLogger(__name__)
+
 # Initialize the embedding model globally at the module level
 embedding_model_name = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
 embedding_model = None
 try:
     embedding_model = SentenceTransformer(embedding_model_name)
-    print(
-        f"Successfully initialized SentenceTransformer model: {embedding_model_name}")
+    logger.info("Successfully initialized SentenceTransformer model: %s", embedding_model_name)
 except Exception as e:
-    print(
-        f"Error initializing SentenceTransformer model {embedding_model_name} at module level: {e}")
+    logger.error("Error initializing SentenceTransformer model %s at module level: %s",
+                 embedding_model_name, e)
     # embedding_model remains None, fallback mechanisms should handle this.
 
 
@@ -27,50 +45,47 @@ def store_knowledge_on_capa_close(capa_id):
     """
     issue = CapaIssue.query.options(
         db.joinedload(CapaIssue.root_cause),
-        db.joinedload(CapaIssue.action_plan)
+        db.joinedload(CapaIssue.action_plan),
+        db.undefer_group('embeddings')
     ).get(capa_id)
 
     if not issue:
-        print(f"Error: CAPA ID {capa_id} not found.")
+        logger.error("CAPA ID %s not found.", capa_id)
         return False
 
     final_whys_json = None
     if issue.root_cause and issue.root_cause.user_adjusted_whys_json:
-        final_whys_json = issue.root_cause.user_adjusted_whys_json
+        # The knowledge base keeps the whys as a JSON string
+        final_whys_json = json.dumps(issue.root_cause.user_adjusted_whys_json)
     else:
-        print(
-            f"Warning: No final RCA (user_adjusted_whys_json) found for CAPA ID {capa_id}.")
+        logger.warning("No final RCA (user_adjusted_whys_json) found for CAPA ID %s.", capa_id)
         # Allow proceeding without RCA if necessary, or return False if RCA is mandatory
         # For now, we'll allow it to proceed and store null for whys.
 
     temp_action_texts_json = None
     prev_action_texts_json = None
     if issue.action_plan and issue.action_plan.user_adjusted_actions_json:
-        try:
-            user_adjustment = json.loads(
-                issue.action_plan.user_adjusted_actions_json)
-            temp_action_texts = [action.get('action_text', '') for action in user_adjustment.get(
-                'temp_actions', []) if action.get('action_text')]
-            prev_action_texts = [action.get('action_text', '') for action in user_adjustment.get(
-                'prev_actions', []) if action.get('action_text')]
-            temp_action_texts_json = json.dumps(temp_action_texts)
-            prev_action_texts_json = json.dumps(prev_action_texts)
-        except json.JSONDecodeError:
-            print(
-                f"Error: Failed to parse user_adjusted_actions_json for CAPA ID {capa_id}.")
-            # Allow proceeding without action plans if parsing fails, or return False
-            # For now, we'll allow it to proceed and store null for actions.
+        user_adjustment = issue.action_plan.user_adjusted_actions_json
+        temp_action_texts = [action.get('action_text', '') for action in user_adjustment.get(
+            'temp_actions', []) if action.get('action_text')]
+        prev_action_texts = [action.get('action_text', '') for action in user_adjustment.get(
+            'prev_actions', []) if action.get('action_text')]
+        temp_action_texts_json = json.dumps(temp_action_texts)
+        prev_action_texts_json = json.dumps(prev_action_texts)
     else:
-        print(
-            f"Warning: No final Action Plan (user_adjusted_actions_json) found for CAPA ID {capa_id}.")
+        logger.warning("No final Action Plan (user_adjusted_actions_json) found for CAPA ID %s.", capa_id)
 
     # If there's neither RCA nor Action Plan data, maybe don't store anything.
     if not final_whys_json and not temp_action_texts_json and not prev_action_texts_json:
-        print(
-            f"Info: No RCA or Action Plan data to store for CAPA ID {capa_id}. Skipping knowledge entry.")
+        logger.info("No RCA or Action Plan data to store for CAPA ID %s. Skipping knowledge entry.", capa_id)
         return False  # Or True, depending on desired behavior for empty data
 
     try:
+        # Reuse the embeddings computed for the CAPA's AI stages (only missing ones are encoded)
+        final_whys = issue.root_cause.user_adjusted_whys_json if issue.root_cause else None
+        embed_rows([issue], 'issue_embedding', [issue.issue_description], store=True)
+        embed_rows([issue], 'whys_embedding', [whys_text(final_whys)], store=True)
+
         # Check if an entry already exists for this capa_id
         knowledge_entry = AIKnowledgeBase.query.filter_by(
             capa_id=capa_id).first()
@@ -84,7 +99,8 @@ def store_knowledge_on_capa_close(capa_id):
             knowledge_entry.adjusted_preventive_actions_json = prev_action_texts_json
             knowledge_entry.created_at = datetime.utcnow()  # Update timestamp
             knowledge_entry.is_active = True
-            print(f"Successfully updated AI knowledge for CAPA ID {capa_id}.")
+            _copy_embeddings(issue, knowledge_entry)
+            logger.info("Successfully updated AI knowledge for CAPA ID %s.", capa_id)
         else:
             # Create new AI knowledge base entry
             new_knowledge = AIKnowledgeBase(
@@ -95,51 +111,53 @@ def store_knowledge_on_capa_close(capa_id):
                 adjusted_temporary_actions_json=temp_action_texts_json,
                 adjusted_preventive_actions_json=prev_action_texts_json,
                 created_at=datetime.utcnow(),
-                is_active=True
+                is_active=True,
+                company_id=issue.company_id
             )
+            _copy_embeddings(issue, new_knowledge)
             db.session.add(new_knowledge)
-            print(
-                f"Successfully stored new AI knowledge for CAPA ID {capa_id}.")
+            knowledge_entry = new_knowledge
+            logger.info("Successfully stored new AI knowledge for CAPA ID %s.", capa_id)
+
+        # Rendered once here, so building a prompt only concatenates the stored lines
+        from ai_service import render_knowledge_entry_snippets  # Import here to avoid circular imports
+        knowledge_entry.prompt_snippets_json = render_knowledge_entry_snippets(knowledge_entry)
 
         db.session.commit()
         return True
 
     except Exception as e:
-        print(
-            f"Error storing AI knowledge for CAPA ID {capa_id}: {e}")
+        logger.error("Error storing AI knowledge for CAPA ID %s: %s", capa_id, e)
         db.session.rollback()
         return False
 
 
+@timed('embedding.encode')
 def get_embedding_st_rca(text_list):
     if not text_list or not all(isinstance(t, str) and t.strip() != "" for t in text_list):
         return [None] * len(text_list) if text_list else []
     try:
         embeddings = embedding_model.encode(
             text_list, convert_to_tensor=False)
-        print(
-            f"[RCA DEBUG get_embedding_st_rca] Input text_list: {text_list}")
-        print(
-            f"[RCA DEBUG get_embedding_st_rca] Raw embeddings from model: {embeddings}")
-        print(
-            f"[RCA DEBUG get_embedding_st_rca] Type of embeddings from model: {type(embeddings)}")
-        if isinstance(embeddings, np.ndarray):
-            print(
-                f"[RCA DEBUG get_embedding_st_rca] Embeddings dtype: {embeddings.dtype}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Encoded %d texts into %s", len(text_list), describe_array(embeddings))
+            logger.debug("Embedding input texts: %s", text_list, extra=PAYLOAD)
         return embeddings
     except Exception as e:
-        print(
-            f"Error getting embedding with SentenceTransformer for RCA: {e}")
+        logger.error("Error getting embedding with SentenceTransformer for RCA: %s", e)
         return [None] * len(text_list)
 
 
+def _encode_one(text):
+    """Embedding vector of a single text, or None if it is empty or could not be encoded."""
+    if not embedding_model:
+        return None
+    vectors = get_embedding_st_rca([text])
+    return vectors[0] if isinstance(vectors, np.ndarray) and len(vectors) else None
+
+
 def cosine_similarity_rca(vec1, vec2):
     """Calculates the cosine similarity between two vectors."""
-    logging.debug(
-        f"[RCA DEBUG cosine_similarity_rca ENTRY] vec1 type: {type(vec1)}, vec2 type: {type(vec2)}")
-    # logging.debug(f"[RCA DEBUG cosine_similarity_rca ENTRY] vec1 content: {vec1}") # Can be very verbose
-    # logging.debug(f"[RCA DEBUG cosine_similarity_rca ENTRY] vec2 content: {vec2}") # Can be very verbose
-
     # Ensure both vectors are not None and are numpy arrays before proceeding
     if vec1 is not None and vec2 is not None and isinstance(vec1, np.ndarray) and isinstance(vec2, np.ndarray):
         # Reshape a 1D array to a 2D array with one row
@@ -147,34 +165,171 @@ def cosine_similarity_rca(vec1, vec2):
         vec2_reshaped = vec2.reshape(1, -1)
         similarity = cosine_similarity(
             vec1_reshaped, vec2_reshaped)[0][0]
-        logging.debug(
-            f"[RCA DEBUG cosine_similarity_rca] Calculated similarity: {similarity}")
         return similarity
     else:
-        logging.debug(
-            f"[RCA DEBUG cosine_similarity_rca] Invalid input for cosine similarity (vec1 type: {type(vec1)}, vec2 type: {type(vec2)}). Returning 0.0")
+        logger.debug("Invalid input for cosine similarity (vec1 type: %s, vec2 type: %s). Returning 0.0",
+                     type(vec1).__name__, type(vec2).__name__)
         return 0.0  # Return 0.0 if inputs are not valid to prevent errors
 
 
+def whys_text(whys):
+    """Concatenated text of a list of WHYs, given as plain strings or {'why', 'cause'} dicts."""
+    text_parts = []
+    for item in whys or []:
+        if isinstance(item, dict):
+            text_parts.append(item.get('why', ''))
+            text_parts.append(item.get('cause', ''))
+        elif isinstance(item, str):
+            text_parts.append(item.strip())
+    return " ".join(filter(None, text_parts)).strip()
+
+
 def _extract_text_from_whys_json_str(whys_json_str):
-    """Extracts concatenated 'why' and 'cause' text from a 5 Whys JSON string."""
+    """Extracts the concatenated WHYs text from a 5 Whys JSON string."""
     if not whys_json_str:
         return ""
     try:
-        whys_data = json.loads(whys_json_str)
-        text_parts = []
-        for item in whys_data:
-            if isinstance(item, dict):
-                text_parts.append(item.get('why', ''))
-                text_parts.append(item.get('cause', ''))
-        return " ".join(filter(None, text_parts)).strip()
-    except json.JSONDecodeError as e:
-        logging.error(
-            f"Error decoding WHYs JSON: {e} - JSON string: {whys_json_str}")
+        return whys_text(json.loads(whys_json_str))
+    except (json.JSONDecodeError, TypeError) as e:
+        logger.error("Error decoding WHYs JSON: %s - JSON string: %s", e, whys_json_str)
         return ""
 
 
-def get_relevant_action_plan_knowledge(current_capa_issue_description, current_capa_machine_name, current_capa_user_adjusted_whys_json, limit=5):
+# --- Stored embeddings ---
+# The description and final-WHYs embeddings of a CAPA are encoded once, stored on the CAPA
+# and copied to its knowledge entry on close, so retrieval, regeneration and every later
+# stage reuse them instead of running the model again. A stored blob is the SHA-1 of the
+# text it was computed from followed by the float32 vector, so a blob whose text has since
+# been edited is simply ignored; rows are tagged with the model name, so switching models
+# re-encodes everything.
+
+_TEXT_DIGEST_SIZE = 20
+
+
+def _text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+def pack_embedding(text, vector):
+    return _text_digest(text) + np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpack_embedding(blob, text):
+    """The vector stored in `blob`, or None if there is none or it was computed from another text."""
+    if not blob or not text or blob[:_TEXT_DIGEST_SIZE] != _text_digest(text):
+        return None
+    return np.frombuffer(blob[_TEXT_DIGEST_SIZE:], dtype=np.float32)
+
+
+def _store_embedding(row, column, text, vector):
+    if row.embedding_model != embedding_model_name:
+        # Vectors from another model are not comparable; drop them all
+        row.issue_embedding = None
+        row.whys_embedding = None
+        row.embedding_model = embedding_model_name
+    setattr(row, column, pack_embedding(text, vector))
+
+
+def embed_rows(rows, column, texts, store=False):
+    """Embeddings of `texts` (one per row), reusing the vectors stored in `column` of each row.
+
+    Missing or outdated vectors are encoded in one batch; with `store=True` they are also
+    saved on the rows (the caller commits). Entries are None for empty texts or when the
+    model is unavailable.
+    """
+    vectors = [None] * len(rows)
+    missing = []
+    for idx, (row, text) in enumerate(zip(rows, texts)):
+        if row.embedding_model == embedding_model_name:
+            vectors[idx] = unpack_embedding(getattr(row, column), text)
+        if vectors[idx] is None and isinstance(text, str) and text.strip():
+            missing.append(idx)
+
+    if missing and embedding_model:
+        encoded = get_embedding_st_rca([texts[idx] for idx in missing])
+        for idx, vector in zip(missing, encoded):
+            if vector is None:
+                continue
+            vectors[idx] = vector
+            if store:
+                _store_embedding(rows[idx], column, texts[idx], vector)
+    logger.debug("Embeddings for %d rows (%s): %d stored, %d encoded",
+                 len(rows), column, len(rows) - len(missing), len(missing))
+    return vectors
+
+
+def _copy_embeddings(issue, knowledge_entry):
+    knowledge_entry.issue_embedding = issue.issue_embedding
+    knowledge_entry.whys_embedding = issue.whys_embedding
+    knowledge_entry.embedding_model = issue.embedding_model
+
+
+def capa_issue_embedding(issue):
+    """Description embedding of a CAPA, encoded and stored on it only when missing (caller commits)."""
+    return embed_rows([issue], 'issue_embedding', [issue.issue_description], store=True)[0]
+
+
+def capa_whys_embedding(issue, whys):
+    """Embedding of a CAPA's final WHYs, encoded and stored on it only when missing (caller commits)."""
+    return embed_rows([issue], 'whys_embedding', [whys_text(whys)], store=True)[0]
+
+
+def _rca_candidates(machine_name):
+    """Active knowledge entries with usable WHYs, of `machine_name` if given, newest first."""
+    query = AIKnowledgeBase.query.options(db.undefer_group('embeddings')).filter_by(is_active=True)
+
+    # Only include entries with at least 10 non-whitespace characters in adjusted_whys_json
+    query = query.filter(
+        func.length(func.replace(
+            AIKnowledgeBase.adjusted_whys_json, ' ', '')) >= 10
+    )
+
+    # Filter by machine name if provided
+    if machine_name:
+        query = query.filter(AIKnowledgeBase.machine_name == machine_name)
+
+    return query.order_by(AIKnowledgeBase.created_at.desc()).all()
+
+
+def _rank_rca_entries(potential_rca_entries, entry_issue_embeddings, current_issue_embedding, limit):
+    """The `limit` entries most similar to the current description, as retrieval results."""
+    scored_entries = []
+    for idx, entry in enumerate(potential_rca_entries):
+        if not entry.adjusted_whys_json:
+            continue
+
+        entry_issue_embedding = entry_issue_embeddings[idx]
+
+        issue_similarity = 0
+        if current_issue_embedding is not None and entry_issue_embedding is not None:
+            issue_similarity = cosine_similarity_rca(
+                current_issue_embedding, entry_issue_embedding)
+
+        if issue_similarity > 0.3:  # Lowered threshold for better recall
+            scored_entries.append({
+                "score": issue_similarity,
+                "data": {
+                    "adjusted_whys": entry.adjusted_whys_json,
+                    "prompt_snippet": stored_snippet(entry.prompt_snippets_json, 'rca'),
+                    "context": {
+                        "machine_name": entry.machine_name,
+                        "issue_description": entry.issue_description,
+                        "source_capa_id": entry.capa_id,
+                        "company_id": entry.company_id,
+                        "similarity_score": round(issue_similarity, 2)
+                    }
+                }
+            })
+
+    logger.debug("Scored %d of %d RCA entries above the similarity threshold",
+                 len(scored_entries), len(potential_rca_entries))
+    scored_entries.sort(key=lambda x: x["score"], reverse=True)
+    return [entry["data"] for entry in scored_entries[:limit]]
+
+
+@timed('retrieval.action_plan')
+def get_relevant_action_plan_knowledge(current_capa_issue_description, current_capa_machine_name, current_capa_user_adjusted_whys_json, limit=5,
+                                       current_issue_embedding=None, current_whys_embedding=None):
     """
     Retrieves relevant action plan knowledge (temp/prev action texts) from the knowledge base using semantic search.
     Uses a two-stage semantic process:
@@ -182,13 +337,13 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
     2. From these N, filter top M (e.g., 3) by 5 Whys similarity.
     Also considers exact machine_name matching (if provided).
     Returns max `limit` entries, sorted by the final stage's relevance score.
+    The current CAPA's stored embeddings can be passed in to skip encoding them again.
     """
-    logging.info(
-        f"Starting get_relevant_action_plan_knowledge for machine: {current_capa_machine_name}, limit: {limit}")
-    logging.debug(
-        f"Current CAPA Issue Description: {current_capa_issue_description}")
+    logger.info("Starting get_relevant_action_plan_knowledge for machine: %s, limit: %s",
+                current_capa_machine_name, limit)
+    logger.debug("Current CAPA Issue Description: %s", current_capa_issue_description)
 
-    query = AIKnowledgeBase.query
+    query = AIKnowledgeBase.query.options(db.undefer_group('embeddings'))
     if current_capa_machine_name and current_capa_machine_name.lower() != 'all':
         query = query.filter_by(machine_name=current_capa_machine_name)
 
@@ -197,8 +352,8 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
         (AIKnowledgeBase.adjusted_preventive_actions_json != None)
     ).all()
 
-    logging.info(
-        f"Found {len(potential_ap_entries)} potential AP entries from DB (machine: {current_capa_machine_name}).")
+    logger.info("Found %d potential AP entries from DB (machine: %s).",
+                len(potential_ap_entries), current_capa_machine_name)
 
     results = []
 
@@ -207,11 +362,11 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
         if current_capa_machine_name:
             machine_filtered_entries = [
                 entry for entry in potential_ap_entries if entry.machine_name == current_capa_machine_name]
-            logging.info(
-                f"Filtered down to {len(machine_filtered_entries)} entries matching machine name: '{current_capa_machine_name}'.")
+            logger.info("Filtered down to %d entries matching machine name: '%s'.",
+                        len(machine_filtered_entries), current_capa_machine_name)
             if not machine_filtered_entries:
-                logging.info(
-                    f"No action plan knowledge base entries found for machine name '{current_capa_machine_name}'. Skipping semantic search for this machine.")
+                logger.info("No action plan knowledge base entries found for machine name '%s'. "
+                            "Skipping semantic search for this machine.", current_capa_machine_name)
                 # Optionally, could proceed with all entries if no machine match, or return empty, or fallback to keyword on all.
                 # For now, we will only proceed with machine-matched entries if a machine name is provided.
                 # Effectively stops further semantic processing for this specific request if no machine match
@@ -220,48 +375,35 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                 # Continue with machine-filtered entries
                 potential_ap_entries = machine_filtered_entries
         else:
-            logging.info(
+            logger.info(
                 "No current_capa_machine_name provided, proceeding with all potential AP entries for semantic search.")
             # potential_ap_entries remains as all entries
 
         # Proceed only if there are entries after machine filtering (or if no machine name was specified)
         if not potential_ap_entries:
-            logging.info(
+            logger.info(
                 "No entries to process after machine name filtering (if applicable). Skipping semantic search stages.")
         else:
-            # Get embedding for current issue description
-            current_issue_embedding_list = get_embedding_st_rca(
-                [current_capa_issue_description])
-            current_issue_embedding = None
-            if current_issue_embedding_list is not None:
-                if isinstance(current_issue_embedding_list, np.ndarray) and current_issue_embedding_list.ndim == 2 and current_issue_embedding_list.shape[0] > 0:
-                    current_issue_embedding = current_issue_embedding_list[0]
-                elif isinstance(current_issue_embedding_list, list) and len(current_issue_embedding_list) > 0 and isinstance(current_issue_embedding_list[0], np.ndarray):
-                    current_issue_embedding = current_issue_embedding_list[0]
+            # Get embedding for current issue description (unless the stored one was passed in)
+            if current_issue_embedding is None:
+                current_issue_embedding = _encode_one(current_capa_issue_description)
 
             if current_issue_embedding is None:
-                logging.warning(
+                logger.warning(
                     "Could not generate embedding for current issue description. Proceeding without issue-based semantic search for action plans.")
 
             # Get embedding for current 5 WHYs
             current_whys_text = _extract_text_from_whys_json_str(
                 current_capa_user_adjusted_whys_json)
-            current_whys_embedding = None
             # Only proceed if issue embedding was successful
-            if current_whys_text and current_issue_embedding is not None:
-                current_whys_embedding_list = get_embedding_st_rca(
-                    [current_whys_text])
-                if current_whys_embedding_list is not None:
-                    if isinstance(current_whys_embedding_list, np.ndarray) and current_whys_embedding_list.ndim == 2 and current_whys_embedding_list.shape[0] > 0:
-                        current_whys_embedding = current_whys_embedding_list[0]
-                    elif isinstance(current_whys_embedding_list, list) and len(current_whys_embedding_list) > 0 and isinstance(current_whys_embedding_list[0], np.ndarray):
-                        current_whys_embedding = current_whys_embedding_list[0]
+            if current_whys_embedding is None and current_whys_text and current_issue_embedding is not None:
+                current_whys_embedding = _encode_one(current_whys_text)
 
             if not current_whys_text:
-                logging.info(
+                logger.info(
                     "No current WHYs text provided for action plan semantic search.")
             elif current_whys_embedding is None and current_issue_embedding is not None:
-                logging.warning(
+                logger.warning(
                     "Could not generate embedding for current WHYs text, but issue embedding exists.")
 
             # STAGE 1: Filter by Issue Description Similarity (Top 5)
@@ -272,11 +414,11 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                 entry_issue_descriptions = [
                     entry.issue_description for entry in potential_ap_entries]
                 if entry_issue_descriptions:  # Ensure there are descriptions to process
-                    entry_issue_embeddings = get_embedding_st_rca(
-                        entry_issue_descriptions)
+                    entry_issue_embeddings = embed_rows(
+                        potential_ap_entries, 'issue_embedding', entry_issue_descriptions)
 
-                    logging.info(
-                        f"Calculating Stage 1 (Issue Sim.) scores for {len(potential_ap_entries)} potential APs (post machine filter) using SentenceTransformer...")
+                    logger.info("Calculating Stage 1 (Issue Sim.) scores for %d potential APs "
+                                "(post machine filter) using SentenceTransformer...", len(potential_ap_entries))
 
                     for idx, entry in enumerate(potential_ap_entries):
                         # Skip entries without action plans (already filtered by DB query, but good to double check structure)
@@ -297,7 +439,7 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                             'issue_similarity': issue_similarity
                         })
             else:  # current_issue_embedding is None, skip stage 1 and stage 2 logic
-                logging.info(
+                logger.info(
                     "Skipping semantic stages for action plans as current issue embedding is not available.")
 
             # Sort stage1_candidates by issue_similarity descending and take top N
@@ -308,21 +450,21 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                 reverse=True
             )[:TOP_N_ISSUE_SIMILARITY]
 
-            logging.info(
-                f"Stage 1 (Issue Sim.) selected top {len(stage1_top_n)} candidates.")
-            for cand in stage1_top_n:
-                logging.debug(
-                    f"  S1 Candidate: CAPA ID {cand['entry'].capa_id}, Issue Sim: {cand['issue_similarity']:.4f}")
+            logger.info("Stage 1 (Issue Sim.) selected top %d candidates.", len(stage1_top_n))
+            if logger.isEnabledFor(logging.DEBUG):
+                for cand in stage1_top_n:
+                    logger.debug("  S1 Candidate: CAPA ID %s, Issue Sim: %.4f",
+                                 cand['entry'].capa_id, cand['issue_similarity'])
 
             # STAGE 2: Filter by 5 WHYs Similarity (Top M from Stage 1's Top N)
             stage2_candidates = []
             if current_whys_embedding is not None and stage1_top_n:
-                logging.info("Calculating Stage 2 (WHYs Sim.) scores...")
+                logger.info("Calculating Stage 2 (WHYs Sim.) scores...")
                 # Prepare batch for historical WHYs text embeddings
                 historical_whys_texts = [_extract_text_from_whys_json_str(
                     cand['entry'].adjusted_whys_json) for cand in stage1_top_n]
-                historical_whys_embeddings_list = get_embedding_st_rca(
-                    historical_whys_texts)
+                historical_whys_embeddings_list = embed_rows(
+                    [cand['entry'] for cand in stage1_top_n], 'whys_embedding', historical_whys_texts)
 
                 for idx, candidate_s1 in enumerate(stage1_top_n):
                     entry = candidate_s1['entry']
@@ -339,15 +481,15 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                         whys_similarity = cosine_similarity_rca(
                             current_whys_embedding, historical_whys_embedding)
 
-                    logging.debug(
-                        f"  S2 Candidate: CAPA ID {entry.capa_id}, Issue Sim: {issue_similarity:.4f}, WHYs Sim: {whys_similarity:.4f}")
+                    logger.debug("  S2 Candidate: CAPA ID %s, Issue Sim: %.4f, WHYs Sim: %.4f",
+                                 entry.capa_id, issue_similarity, whys_similarity)
                     stage2_candidates.append({
                         'entry': entry,
                         'issue_similarity': issue_similarity,
                         'whys_similarity': whys_similarity
                     })
             elif stage1_top_n:  # Current WHYs embedding is None, but we have Stage 1 results. Use Stage 1 results with 0 WHYs score.
-                logging.info(
+                logger.info(
                     "Current WHYs embedding not available. Using Stage 1 issue similarity for ranking, WHYs similarity will be 0.")
                 for candidate_s1 in stage1_top_n:
                     stage2_candidates.append({
@@ -364,8 +506,7 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                 reverse=True
             )[:TOP_M_WHYS_SIMILARITY]
 
-            logging.info(
-                f"Stage 2 (WHYs Sim.) selected top {len(stage2_top_m)} candidates to form final results.")
+            logger.info("Stage 2 (WHYs Sim.) selected top %d candidates to form final results.", len(stage2_top_m))
 
             # Format final results, respecting the overall 'limit'
             for candidate_s2 in stage2_top_m:
@@ -379,10 +520,12 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                     "score": candidate_s2['whys_similarity'],
                     "adjusted_temporary_actions": temp_actions,
                     "adjusted_preventive_actions": prev_actions,
+                    "prompt_snippet": stored_snippet(entry.prompt_snippets_json, 'action_plan'),
                     "context": {
                         "machine_name": entry.machine_name,
                         "issue_description": entry.issue_description,
                         "source_capa_id": entry.capa_id,
+                        "company_id": entry.company_id,
                         "issue_similarity_score": round(candidate_s2['issue_similarity'], 4),
                         "whys_similarity_score": round(candidate_s2['whys_similarity'], 4),
                         "match_type": "semantic_issue_then_whys"
@@ -390,15 +533,15 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                 })
 
             if results:
-                logging.info(
-                    f"Found {len(results)} semantically similar action plans using two-stage process.")
+                logger.info("Found %d semantically similar action plans using two-stage process.", len(results))
                 for i, res_item in enumerate(results):
-                    logging.info(
-                        f"  {i+1}. CAPA ID: {res_item['context']['source_capa_id']}, Final Score (Whys Sim): {res_item['score']:.4f}, Issue Sim: {res_item['context']['issue_similarity_score']:.4f}, Machine: {res_item['context']['machine_name']}")
+                    logger.info("  %d. CAPA ID: %s, Final Score (Whys Sim): %.4f, Issue Sim: %.4f, Machine: %s",
+                                i + 1, res_item['context']['source_capa_id'], res_item['score'],
+                                res_item['context']['issue_similarity_score'], res_item['context']['machine_name'])
 
     # Fallback to keyword based search if semantic search yielded no results or was skipped
     if not results and potential_ap_entries:  # Check 'results' not 'scored_entries'
-        logging.info(
+        logger.info(
             "Semantic search for action plans yielded no results or was skipped, trying keyword based search...")
         # Use traditional keyword search as fallback
         if current_capa_issue_description:
@@ -425,10 +568,12 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
                     results.append({
                         "adjusted_temporary_actions": temp_actions,
                         "adjusted_preventive_actions": prev_actions,
+                        "prompt_snippet": stored_snippet(entry.prompt_snippets_json, 'action_plan'),
                         "context": {
                             "machine_name": entry.machine_name,
                             "issue_description": entry.issue_description,
                             "source_capa_id": entry.capa_id,
+                            "company_id": entry.company_id,
                             "match_type": "keyword"
                         }
                     })
@@ -436,143 +581,55 @@ def get_relevant_action_plan_knowledge(current_capa_issue_description, current_c
     return results
 
 
-def get_relevant_rca_knowledge(current_capa_issue_description, current_capa_machine_name, limit=5):
+@timed('retrieval.rca')
+def get_relevant_rca_knowledge(current_capa_issue_description, current_capa_machine_name, limit=5,
+                               current_issue_embedding=None):
     """
     Retrieves relevant RCA knowledge (adjusted 5 whys) from the knowledge base using semantic search.
     Uses a combination of:
     1. Exact machine_name matching (if provided)
     2. Semantic similarity for issue descriptions
     Returns max `limit` entries, sorted by relevance score.
+    The current CAPA's stored description embedding can be passed in to skip encoding it again.
     """
-    from sqlalchemy import func
     # SentenceTransformer and numpy are imported at the top of the module.
     # embedding_model is initialized globally at the module level.
 
-    # First, filter by machine name and ensure we have valid WHYs data
-    query = AIKnowledgeBase.query.filter_by(is_active=True)
-
-    # Only include entries with at least 10 non-whitespace characters in adjusted_whys_json
-    query = query.filter(
-        func.length(func.replace(
-            AIKnowledgeBase.adjusted_whys_json, ' ', '')) >= 10
-    )
-
-    # Filter by machine name if provided
-    if current_capa_machine_name:
-        query = query.filter(AIKnowledgeBase.machine_name ==
-                             current_capa_machine_name)
-
-    # Get all potential matches
-    potential_rca_entries = query.order_by(
-        AIKnowledgeBase.created_at.desc()).all()
+    potential_rca_entries = _rca_candidates(current_capa_machine_name)
 
     # If no entries found, return empty list
     if not potential_rca_entries:
-        print("No potential RCA entries found in database.")
+        logger.info("No potential RCA entries found in database.")
         return []
 
     # Use sentence-transformers for semantic search
     if embedding_model:
         try:
-            # Get embeddings for current issue description
-            current_issue_embedding_list = get_embedding_st_rca(
-                [current_capa_issue_description])
-            print(
-                f"[RCA DEBUG POST get_embed_current] current_issue_embedding_list type: {type(current_issue_embedding_list)}")
-            print(
-                f"[RCA DEBUG POST get_embed_current] current_issue_embedding_list content: {current_issue_embedding_list}")
-
-            # current_issue_embedding_list is either np.ndarray (shape (1,D)) from successful encode of one item,
-            # or a Python list [None] if get_embedding_st_rca failed internally for that one item.
-            if isinstance(current_issue_embedding_list, np.ndarray):
-                # Successful embedding, current_issue_embedding_list is ndarray (1,D)
-                # We want the 1D vector itself.
-                if current_issue_embedding_list.ndim == 2 and current_issue_embedding_list.shape[0] == 1:
-                    current_issue_embedding = current_issue_embedding_list[0]
-                # Should not happen if model.encode returns (1,D) for single text
-                elif current_issue_embedding_list.ndim == 1:
-                    current_issue_embedding = current_issue_embedding_list
-                else:
-                    print(
-                        f"[RCA WARNING] Unexpected ndarray shape for current_issue_embedding_list: {current_issue_embedding_list.shape}")
-                    current_issue_embedding = None
-            elif isinstance(current_issue_embedding_list, list) and current_issue_embedding_list and current_issue_embedding_list[0] is None:
-                # get_embedding_st_rca failed and returned [None]
-                current_issue_embedding = None
-            else:
-                # Fallback for any other unexpected structure
-                print(
-                    f"[RCA WARNING] Unexpected structure for current_issue_embedding_list. Type: {type(current_issue_embedding_list)}, Content: {current_issue_embedding_list}")
-                current_issue_embedding = None
-
-            print(
-                f"[RCA DEBUG POST current_issue_assign] current_issue_embedding type: {type(current_issue_embedding)}")
-            print(
-                f"[RCA DEBUG POST current_issue_assign] current_issue_embedding content: {current_issue_embedding}")
+            # Get embedding for current issue description (unless the stored one was passed in)
+            if current_issue_embedding is None:
+                current_issue_embedding = _encode_one(current_capa_issue_description)
 
-            # Prepare batch for entry issue descriptions
+            # Stored embeddings of the entries; only missing or outdated ones are encoded
             entry_issue_descriptions_rca = [
                 entry.issue_description for entry in potential_rca_entries]
-            entry_issue_embeddings_rca = get_embedding_st_rca(
-                entry_issue_descriptions_rca)
-            print(
-                f"[RCA DEBUG POST get_embed_batch] entry_issue_embeddings_rca type: {type(entry_issue_embeddings_rca)}")
-            print(
-                f"[RCA DEBUG POST get_embed_batch] entry_issue_embeddings_rca content: {entry_issue_embeddings_rca}")
-
-            scored_entries = []
-            for idx, entry in enumerate(potential_rca_entries):
-                if not entry.adjusted_whys_json:
-                    continue
+            entry_issue_embeddings_rca = embed_rows(
+                potential_rca_entries, 'issue_embedding', entry_issue_descriptions_rca)
 
-                entry_issue_embedding = entry_issue_embeddings_rca[idx]
-
-                print(
-                    f"[RCA DEBUG PRE-SIMILARITY CHECK] current_issue_embedding type: {type(current_issue_embedding)}")
-                print(
-                    f"[RCA DEBUG PRE-SIMILARITY CHECK] current_issue_embedding content: {current_issue_embedding}")
-                print(
-                    f"[RCA DEBUG PRE-SIMILARITY CHECK] entry_issue_embedding type: {type(entry_issue_embedding)}")
-                print(
-                    f"[RCA DEBUG PRE-SIMILARITY CHECK] entry_issue_embedding content: {entry_issue_embedding}")
-
-                issue_similarity = 0
-                if current_issue_embedding is not None and entry_issue_embedding is not None:
-                    issue_similarity = cosine_similarity_rca(
-                        current_issue_embedding, entry_issue_embedding)
-
-                if issue_similarity > 0.3:  # Lowered threshold for better recall
-                    scored_entries.append({
-                        "score": issue_similarity,
-                        "data": {
-                            "adjusted_whys": entry.adjusted_whys_json,
-                            "context": {
-                                "machine_name": entry.machine_name,
-                                "issue_description": entry.issue_description,
-                                "source_capa_id": entry.capa_id,
-                                "similarity_score": round(issue_similarity, 2)
-                            }
-                        }
-                    })
-
-            scored_entries.sort(key=lambda x: x["score"], reverse=True)
-            results = [entry["data"] for entry in scored_entries[:limit]]
+            results = _rank_rca_entries(potential_rca_entries, entry_issue_embeddings_rca,
+                                        current_issue_embedding, limit)
 
             if results:
-                print(
-                    f"Found {len(results)} semantically similar RCA entries using SentenceTransformer.")
+                logger.info("Found %d semantically similar RCA entries using SentenceTransformer.", len(results))
                 return results
             else:
-                print(
-                    "No semantically similar RCA entries found using SentenceTransformer.")
+                logger.info("No semantically similar RCA entries found using SentenceTransformer.")
         except Exception as e:
-            print(
-                f"Error using SentenceTransformer for semantic search for RCA knowledge: {e}")
+            logger.error("Error using SentenceTransformer for semantic search for RCA knowledge: %s", e)
     else:
-        print("SentenceTransformer model not initialized for RCA. Falling back.")
+        logger.warning("SentenceTransformer model not initialized for RCA. Falling back.")
 
     # Fallback to traditional search if semantic search fails or finds no results or model not loaded
-    print("Falling back to traditional keyword search for RCA knowledge.")
+    logger.info("Falling back to traditional keyword search for RCA knowledge.")
 
     # Reset results for fallback method
     results = []
@@ -599,12 +656,157 @@ def get_relevant_rca_knowledge(current_capa_issue_description, current_capa_mach
             if keyword_match:
                 results.append({
                     "adjusted_whys": entry.adjusted_whys_json,
+                    "prompt_snippet": stored_snippet(entry.prompt_snippets_json, 'rca'),
                     "context": {
                         "machine_name": entry.machine_name,
                         "issue_description": entry.issue_description,
                         "source_capa_id": entry.capa_id,
+                        "company_id": entry.company_id,
                         "match_type": "keyword"
                     }
                 })
 
     return results
+
+
+# --- Speculative RCA retrieval ---
+# The RCA retrieval only depends on the CAPA description and machine, which are known
+# when the CAPA is created. new_capa schedules it on a small background executor and the
+# ranked candidates are kept per CAPA, so the Gemba submit only waits for the LLM call.
+# A cached result is used only while the description, machine and knowledge base version
+# are unchanged; otherwise the retrieval runs inline as before. The cache is per process:
+# a Gemba submit served by another worker process simply misses.
+
+RCA_KNOWLEDGE_LIMIT = 5
+
+RcaPrefetch = namedtuple('RcaPrefetch', ['issue_description', 'machine_name', 'limit', 'kb_version', 'results'])
+
+# capa_id -> Future resolving to an RcaPrefetch
+_rca_prefetch_cache = TTLCache(maxsize=RCA_PREFETCH_CACHE_MAX_ENTRIES, ttl=RCA_PREFETCH_CACHE_TTL_SECONDS)
+_rca_prefetch_lock = threading.Lock()
+_rca_prefetch_executor = None
+
+
+def get_knowledge_base_version():
+    """Cheap fingerprint of the knowledge base.
+
+    Changes whenever an entry is added, deleted, re-stored on CAPA close (which refreshes
+    created_at) or (de)activated.
+    """
+    row = db.session.query(
+        func.count(AIKnowledgeBase.knowledge_id),
+        func.max(AIKnowledgeBase.knowledge_id),
+        func.max(AIKnowledgeBase.created_at),
+        func.sum(case((AIKnowledgeBase.is_active, 1), else_=0))
+    ).one()
+    return tuple(row)
+
+
+def _get_rca_prefetch_executor():
+    # Created on first use, i.e. inside the worker process that serves requests
+    global _rca_prefetch_executor
+    with _rca_prefetch_lock:
+        if _rca_prefetch_executor is None:
+            _rca_prefetch_executor = ThreadPoolExecutor(max_workers=RCA_PREFETCH_WORKERS,
+                                                        thread_name_prefix='rca-prefetch')
+        return _rca_prefetch_executor
+
+
+def _run_rca_prefetch(app, capa_id, issue_description, machine_name):
+    with app.app_context():
+        # Read the version first, so a knowledge base change during the retrieval makes the result stale
+        kb_version = get_knowledge_base_version()
+        # Encode and store the CAPA's description embedding now, so no later stage has to
+        issue = CapaIssue.query.options(db.undefer_group('embeddings')).get(capa_id)
+        issue_embedding = None
+        if issue is not None and issue.issue_description == issue_description:
+            issue_embedding = capa_issue_embedding(issue)
+            db.session.commit()
+        results = get_relevant_rca_knowledge(issue_description, machine_name, limit=RCA_KNOWLEDGE_LIMIT,
+                                             current_issue_embedding=issue_embedding)
+        return RcaPrefetch(issue_description, machine_name, RCA_KNOWLEDGE_LIMIT, kb_version, results)
+
+
+def prefetch_rca_knowledge(capa_id, issue_description, machine_name):
+    """Start the RCA knowledge retrieval for a newly created CAPA in the background."""
+    if not RCA_PREFETCH_ENABLED:
+        return
+    app = current_app._get_current_object()
+    future = _get_rca_prefetch_executor().submit(_run_rca_prefetch, app, capa_id, issue_description, machine_name)
+    with _rca_prefetch_lock:
+        _rca_prefetch_cache[capa_id] = future
+    logger.debug("Scheduled speculative RCA retrieval for CAPA ID %s", capa_id)
+
+
+@timed('retrieval.rca_batch')
+def prefetch_rca_knowledge_batch(issues, limit=RCA_KNOWLEDGE_LIMIT):
+    """Retrieve the RCA knowledge of many CAPAs at once into the speculative retrieval cache.
+
+    For bulk re-generation: missing description embeddings are encoded in one model call
+    (and stored; the caller commits), and the knowledge entries of each machine are loaded
+    and embedded once for all of its CAPAs. CAPAs without a semantic match are left out, so
+    their retrieval runs inline with the keyword fallback. Returns the number cached.
+    """
+    if not issues or not embedding_model:
+        return 0
+    kb_version = get_knowledge_base_version()
+    issue_embeddings = embed_rows(issues, 'issue_embedding', [issue.issue_description for issue in issues], store=True)
+
+    by_machine = {}
+    for issue, issue_embedding in zip(issues, issue_embeddings):
+        by_machine.setdefault(issue.machine_name, []).append((issue, issue_embedding))
+
+    cached = 0
+    for machine_name, machine_issues in by_machine.items():
+        candidates = _rca_candidates(machine_name)
+        if not candidates:
+            continue
+        candidate_embeddings = embed_rows(candidates, 'issue_embedding',
+                                          [entry.issue_description for entry in candidates])
+        for issue, issue_embedding in machine_issues:
+            results = _rank_rca_entries(candidates, candidate_embeddings, issue_embedding, limit)
+            if not results:
+                continue
+            future = Future()
+            future.set_result(RcaPrefetch(issue.issue_description, issue.machine_name, limit, kb_version, results))
+            with _rca_prefetch_lock:
+                _rca_prefetch_cache[issue.capa_id] = future
+            cached += 1
+    logger.info("Batch RCA retrieval: cached knowledge for %d of %d CAPAs", cached, len(issues))
+    return cached
+
+
+def get_rca_knowledge_for_capa(capa_id, issue_description, machine_name, limit=RCA_KNOWLEDGE_LIMIT,
+                               issue_embedding=None):
+    """RCA knowledge for a CAPA, taken from the speculative retrieval while it is still valid."""
+    with _rca_prefetch_lock:
+        future = _rca_prefetch_cache.get(capa_id)
+    # Still queued behind other CAPAs: retrieving inline is quicker than waiting for the queue
+    if future is not None and future.cancel():
+        future = None
+
+    result = 'miss'
+    if future is not None:
+        waited = not future.done()
+        prefetch = None
+        try:
+            prefetch = future.result()
+        except Exception as e:
+            logger.warning("Speculative RCA retrieval for CAPA ID %s failed: %s", capa_id, e)
+
+        if (prefetch is not None
+                and prefetch.issue_description == issue_description
+                and prefetch.machine_name == machine_name
+                and prefetch.limit >= limit
+                and prefetch.kb_version == get_knowledge_base_version()):
+            rca_prefetch_lookups_total.inc(result='waited' if waited else 'hit')
+            logger.info("Using speculative RCA retrieval for CAPA ID %s (%d entries).", capa_id, len(prefetch.results))
+            return prefetch.results[:limit]
+
+        result = 'stale'
+        with _rca_prefetch_lock:
+            _rca_prefetch_cache.pop(capa_id, None)
+
+    rca_prefetch_lookups_total.inc(result=result)
+    return get_relevant_rca_knowledge(issue_description, machine_name, limit=limit,
+                                      current_issue_embedding=issue_embedding)
@@ -0,0 +1,210 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import insert, update
+
+from config import AI_SCHEDULER_INTERACTIVE_RESERVED, AI_SCHEDULER_WORKERS
+from metrics import ai_job_queue_wait, ai_jobs_total, registry
+from models import db, AIJob
+
+logger = logging.getLogger(__name__)
+
+# --- AI job scheduler ---
+# AI generation runs as jobs on a pool of worker threads per process, started in priority order:
+#   interactive - an engineer waiting for the page after submitting a form;
+#   background  - work nobody waits for, e.g. refining a fast-path suggestion;
+#   bulk        - re-generation and import scripts.
+# Within a priority the companies take turns (round robin), so one company's batch does
+# not delay another's jobs. Background and bulk jobs only start while
+# AI_SCHEDULER_INTERACTIVE_RESERVED workers stay free, so interactive jobs never queue
+# behind a bulk run. Every job also has a row in ai_jobs: ai_jobs.py lists the queued and
+# running jobs of all worker processes and cancels queued ones, which the scheduler
+# notices when the job's turn comes.
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BACKGROUND, BULK)  # Highest first
+
+Job = namedtuple('Job', [
+    'job_id', 'stage', 'capa_id', 'company_id', 'priority', 'app', 'func', 'args', 'future', 'enqueued_at'
+])
+
+
+class AIJobCancelled(RuntimeError):
+    """The job was cancelled (with ai_jobs.py, or by its script) before it started."""
+
+
+def _worker_name():
+    # Read on every submit: the pid changes when prefork.py forks the workers
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class AIScheduler:
+    """Priority queues with per-company round robin, served by `workers` threads."""
+
+    def __init__(self, workers, interactive_reserved):
+        self.workers = workers
+        # Background and bulk jobs running at once; at least one, so they cannot starve
+        self.max_other_running = max(1, workers - interactive_reserved)
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}  # company_id -> deque of Jobs
+        self._running = {priority: 0 for priority in PRIORITIES}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _start_workers(self):
+        # Started on first use, i.e. inside the worker process that serves requests
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'ai-job-{len(self._threads) + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, stage, capa_id, company_id, priority, func, *args):
+        """Queue `func(*args)` to run in an app context of the current app.
+
+        The job's ai_jobs row is written in a transaction of its own; the caller's session
+        is left alone, so commit it first if the job must see its changes.
+        Returns (job id, Future of the result).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown AI job priority '{priority}' (expected one of {', '.join(PRIORITIES)})")
+        with db.engine.begin() as connection:
+            job_id = connection.execute(insert(AIJob).values(
+                stage=stage, priority=priority, capa_id=capa_id, company_id=company_id,
+                status='queued', worker=_worker_name())).inserted_primary_key[0]
+
+        job = Job(job_id, stage, capa_id, company_id, priority, current_app._get_current_object(),
+                  func, args, Future(), time.monotonic())
+        with self._cond:
+            self._start_workers()
+            self._queues[priority].setdefault(company_id, deque()).append(job)
+            self._cond.notify_all()
+        logger.debug("Queued %s AI job %s (%s) for CAPA ID %s", priority, job_id, stage, capa_id)
+        return job_id, job.future
+
+    def queue_depths(self):
+        with self._cond:
+            return {(priority,): sum(len(jobs) for jobs in self._queues[priority].values())
+                    for priority in PRIORITIES}
+
+    def running(self):
+        with self._cond:
+            return {(priority,): count for priority, count in self._running.items()}
+
+    def cancel_queued(self):
+        """Cancel every job still queued in this process (e.g. when a bulk script is interrupted).
+
+        Returns the number of jobs cancelled.
+        """
+        with self._cond:
+            jobs = [job for queue in self._queues.values() for company_jobs in queue.values() for job in company_jobs]
+            for queue in self._queues.values():
+                queue.clear()
+        for job in jobs:
+            job.future.cancel()
+            ai_jobs_total.inc(priority=job.priority, status='cancelled')
+        if jobs:
+            db.session.execute(
+                update(AIJob)
+                .where(AIJob.id.in_([job.job_id for job in jobs]), AIJob.status == 'queued')
+                .values(status='cancelled', finished_at=datetime.utcnow()))
+            db.session.commit()
+        return len(jobs)
+
+    def wait_idle(self, timeout=None):
+        """Wait until no job is queued or running in this process; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not any(self._queues.values()) and not any(self._running.values()), timeout)
+
+    def _next_job(self):
+        """The job to start now, or None; called with the lock held."""
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            if priority != INTERACTIVE and self._running[BACKGROUND] + self._running[BULK] >= self.max_other_running:
+                return None
+            company_id, jobs = next(iter(queue.items()))
+            job = jobs.popleft()
+            # The company goes to the back of the line
+            if jobs:
+                queue.move_to_end(company_id)
+            else:
+                del queue[company_id]
+            return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.priority] += 1
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running[job.priority] -= 1
+                    # A freed background / bulk slot may let a waiting job start
+                    self._cond.notify_all()
+
+    def _claim(self, job):
+        """Mark the job running unless it was cancelled while queued."""
+        result = db.session.execute(
+            update(AIJob)
+            .where(AIJob.id == job.job_id, AIJob.status == 'queued')
+            .values(status='running', started_at=datetime.utcnow()))
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _finish(self, job, status, error=None):
+        ai_jobs_total.inc(priority=job.priority, status=status)
+        try:
+            db.session.execute(
+                update(AIJob)
+                .where(AIJob.id == job.job_id)
+                .values(status=status, finished_at=datetime.utcnow(),
+                        error_message=str(error)[:500] if error is not None else None))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Could not record the end of AI job %s: %s", job.job_id, e)
+
+    def _run(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        with job.app.app_context():
+            try:
+                if not self._claim(job):
+                    ai_jobs_total.inc(priority=job.priority, status='cancelled')
+                    logger.info("Skipping cancelled %s AI job %s (%s) for CAPA ID %s",
+                                job.priority, job.job_id, job.stage, job.capa_id)
+                    job.future.set_exception(AIJobCancelled(f"AI job {job.job_id} was cancelled"))
+                    return
+                ai_job_queue_wait.observe(time.monotonic() - job.enqueued_at, priority=job.priority)
+                result = job.func(*job.args)
+            except Exception as e:
+                db.session.rollback()
+                self._finish(job, 'failed', e)
+                job.future.set_exception(e)
+            else:
+                self._finish(job, 'done')
+                job.future.set_result(result)
+
+
+scheduler = AIScheduler(AI_SCHEDULER_WORKERS, AI_SCHEDULER_INTERACTIVE_RESERVED)
+
+registry.gauge('capa_ai_job_queue_depth', 'AI jobs queued in this process by priority.',
+               ('priority',), scheduler.queue_depths)
+registry.gauge('capa_ai_jobs_running', 'AI jobs running in this process by priority.',
+               ('priority',), scheduler.running)
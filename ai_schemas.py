@@ -0,0 +1,198 @@
+import json
+import logging
+import re
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+logger = logging.getLogger(__name__)
+
+# --- Structured AI output ---
+# The RCA and action-plan suggestions are requested as JSON constrained by a response
+# schema (Gemini's response_mime_type / response_schema), then validated with the
+# pydantic models below. Answers that do not validate as-is (code fences, renamed keys,
+# actions given as plain strings, trailing commas...) are repaired locally, so a
+# formatting slip never costs a second LLM round-trip or a user re-trigger.
+
+WHY_KEYS = ('why1', 'why2', 'why3', 'why4', 'root_cause')
+
+
+class SuggestionParseError(ValueError):
+    """The model's answer could not be turned into a valid suggestion, even after repair."""
+
+
+class RcaSuggestion(BaseModel):
+    why1: str
+    why2: str
+    why3: str
+    why4: str
+    root_cause: str
+    # Set when the suggestion was copied from a near-identical closed CAPA instead of generated
+    source_capa_id: Optional[int] = None
+
+    @field_validator(*WHY_KEYS, mode='before')
+    @classmethod
+    def _to_text(cls, value):
+        return value.strip() if isinstance(value, str) else ('' if value is None else str(value))
+
+
+class ActionStep(BaseModel):
+    langkah: str
+
+
+class ActionPlanSuggestion(BaseModel):
+    temporary_action: list[ActionStep]
+    preventive_action: list[ActionStep]
+    source_capa_id: Optional[int] = None
+
+
+# Gemini response schemas (OpenAPI subset) matching the models above
+RCA_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {key: {'type': 'STRING'} for key in WHY_KEYS},
+    'required': list(WHY_KEYS),
+}
+_ACTION_LIST_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {'langkah': {'type': 'STRING'}},
+        'required': ['langkah'],
+    },
+}
+ACTION_PLAN_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {'temporary_action': _ACTION_LIST_SCHEMA, 'preventive_action': _ACTION_LIST_SCHEMA},
+    'required': ['temporary_action', 'preventive_action'],
+}
+
+
+# --- Local repair ---
+
+def _extract_json_text(text):
+    """Strip code fences and surrounding prose, keeping the outermost JSON object."""
+    text = text.strip()
+    fenced = re.search(r'```(?:json)?\s*(.+?)\s*```', text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return text
+
+
+def _load_json(text):
+    """json.loads, retrying once without trailing commas."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(re.sub(r',\s*([}\]])', r'\1', text))
+
+
+def _normalise_rca_keys(data):
+    aliases = {'why5': 'root_cause', 'rootcause': 'root_cause', 'akarmasalah': 'root_cause'}
+    normalised = {}
+    for key, value in data.items():
+        compact = re.sub(r'[\s_\-]', '', str(key).lower())
+        normalised[aliases.get(compact, compact if compact in WHY_KEYS else key)] = value
+    return normalised
+
+
+def _rca_from_text(text):
+    """Pick the five answers out of a plain-text "Why 1: ..." style answer."""
+    structured_response = dict.fromkeys(WHY_KEYS, '')
+    current_why = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        lowered = line.lower()
+        for number, key in enumerate(WHY_KEYS, 1):
+            markers = ('root', 'root cause') if key == 'root_cause' else (key, f'why {number}')
+            if any(marker in lowered for marker in markers) or f'{number}.' in line:
+                current_why = key
+                # Content after the marker
+                structured_response[key] = line.split(':', 1)[1].strip() if ':' in line else \
+                    line.split(' ', 1)[1].strip() if ' ' in line else ''
+                break
+        else:
+            if current_why and structured_response[current_why] == '':
+                # In a section whose content has not been captured yet
+                structured_response[current_why] = line
+    return structured_response
+
+
+def _action_steps(value):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            value = [value]
+    if isinstance(value, (str, dict)):
+        value = [value]
+    steps = []
+    for item in value or []:
+        if isinstance(item, dict):
+            text = item.get('langkah')
+            if text is None:
+                # Any other key: take its first text value
+                text = next((v for v in item.values() if isinstance(v, str)), '')
+        else:
+            text = item
+        text = str(text).strip() if text is not None else ''
+        if text:
+            steps.append({'langkah': text})
+    return steps
+
+
+def parse_rca_suggestion(text):
+    """Turn the model's RCA answer into an RcaSuggestion.
+
+    Returns (suggestion, outcome) where outcome is 'json' (valid as returned), 'repaired'
+    (valid JSON after local fixes) or 'fallback_text' (read from a plain-text answer).
+    """
+    try:
+        return RcaSuggestion.model_validate_json(text), 'json'
+    except ValidationError:
+        pass
+
+    json_text = _extract_json_text(text)
+    try:
+        data = _load_json(json_text)
+    except json.JSONDecodeError:
+        logger.info("RCA answer is not JSON; reading the WHYs from the text")
+        structured_response = _rca_from_text(json_text)
+        if not any(structured_response.values()):
+            raise SuggestionParseError("No WHYs found in the RCA answer")
+        return RcaSuggestion(**structured_response), 'fallback_text'
+
+    if not isinstance(data, dict):
+        raise SuggestionParseError(f"Expected a JSON object, got {type(data).__name__}")
+    try:
+        return RcaSuggestion.model_validate(_normalise_rca_keys(data)), 'repaired'
+    except ValidationError as e:
+        raise SuggestionParseError(f"JSON response missing expected 5 Why keys: {e}") from e
+
+
+def parse_action_plan_suggestion(text):
+    """Turn the model's action-plan answer into an ActionPlanSuggestion; returns (suggestion, outcome)."""
+    try:
+        return ActionPlanSuggestion.model_validate_json(text), 'json'
+    except ValidationError:
+        pass
+
+    try:
+        data = _load_json(_extract_json_text(text))
+    except json.JSONDecodeError as e:
+        raise SuggestionParseError(f"Action plan answer is not JSON: {e}") from e
+    if not isinstance(data, dict) or not ('temporary_action' in data or 'preventive_action' in data):
+        raise SuggestionParseError("AI response missing expected action plan keys.")
+    return ActionPlanSuggestion(
+        temporary_action=_action_steps(data.get('temporary_action')),
+        preventive_action=_action_steps(data.get('preventive_action'))
+    ), 'repaired'
+
+
+def suggestion_json(suggestion):
+    """The JSON string stored in ai_suggested_rc_json / ai_suggested_actions_json."""
+    return json.dumps(suggestion.model_dump(exclude_none=True), indent=2, ensure_ascii=False)
@@ -1,27 +1,320 @@
 import json
+from collections import namedtuple
 from datetime import datetime
-import google.generativeai as genai
-from models import db, RootCause, ActionPlan
-from config import GOOGLE_API_KEY
-from ai_learning import get_relevant_rca_knowledge, get_relevant_action_plan_knowledge
+from models import db, ActionPlan, CapaIssue, GembaInvestigation, RootCause
+from config import (
+    AI_FAST_PATH_ENABLED,
+    AI_FAST_PATH_MIN_SIMILARITY,
+    AI_FAST_PATH_REFINE,
+    AI_JOB_WAIT_TIMEOUT_SECONDS,
+    FAKE_LLM_ERROR_RATE,
+    FAKE_LLM_LATENCY_JITTER_MS,
+    FAKE_LLM_LATENCY_MS,
+    FAKE_LLM_MALFORMED_RATE,
+    GEMINI_MODEL_NAME,
+    GOOGLE_API_KEY,
+    LLM_BACKEND,
+    LLM_BREAKER_COOLDOWN_SECONDS,
+    LLM_BREAKER_FAILURE_RATE,
+    LLM_BREAKER_MIN_CALLS,
+    LLM_BREAKER_WINDOW,
+    LLM_DEADLINE_SECONDS,
+    LLM_MAX_IN_FLIGHT,
+    LLM_MAX_IN_FLIGHT_PER_COMPANY,
+    LLM_MAX_RETRIES,
+    LLM_QUEUE_TIMEOUT_SECONDS,
+    LLM_RETRY_BACKOFF_MAX_SECONDS,
+    LLM_RETRY_BACKOFF_SECONDS,
+    LLM_STRUCTURED_OUTPUT,
+    LLM_TIMEOUT_SECONDS
+)
+from ai_learning import (
+    capa_issue_embedding,
+    capa_whys_embedding,
+    get_rca_knowledge_for_capa,
+    get_relevant_action_plan_knowledge
+)
+import logging
+
+from logging_config import PAYLOAD
+from metrics import ai_fast_path_total, ai_single_flight_shared_total, registry, span
+from llm_resilience import CircuitBreaker, ResilientLLMClient
+from ai_scheduler import BACKGROUND, INTERACTIVE, scheduler
+from single_flight import SingleFlight
+from ai_usage import measure_latency, record_usage, save_failed_call, start_ai_call
+from prompt_builder import (
+    KnowledgeSnippet,
+    assemble_prompt,
+    render_action_plan_snippet,
+    render_knowledge_snippets,
+    render_rca_snippet
+)
+from ai_schemas import (
+    ACTION_PLAN_RESPONSE_SCHEMA,
+    RCA_RESPONSE_SCHEMA,
+    WHY_KEYS,
+    ActionPlanSuggestion,
+    ActionStep,
+    RcaSuggestion,
+    SuggestionParseError,
+    parse_action_plan_suggestion,
+    parse_rca_suggestion,
+    suggestion_json
+)
+
+logger = logging.getLogger(__name__)
+
+
+# --- LLM clients ---
+# The AI flows only need `generate_content(prompt, response_schema=None, timeout=None)`
+# returning an object with `.text` and `.usage_metadata`, plus `model_name` and
+# `is_available`. LLM_BACKEND selects the implementation: the real Gemini API or the
+# offline fake in fake_llm.py. With a response schema the answer is requested as JSON
+# matching it. The client is wrapped in a ResilientLLMClient (llm_resilience.py) that adds
+# retries, a circuit breaker and concurrency limits.
+
+class LLMClient:
+    """Interface of the text-generation backend used by the RCA and action-plan flows."""
+
+    model_name = None
+    # False when the backend cannot be used (e.g. no API key); AI steps are then skipped
+    is_available = False
+    # Transient errors (rate limits, 5xx, timeouts) that are worth retrying
+    retryable_errors = ()
+
+    def generate_content(self, prompt, response_schema=None, timeout=None):
+        raise NotImplementedError
+
+
+class GeminiClient(LLMClient):
+    def __init__(self, model_name, api_key):
+        import google.generativeai as genai  # Only needed for the real backend
+        from google.api_core import exceptions as api_exceptions
+        self.model_name = model_name
+        self.retryable_errors = (
+            api_exceptions.TooManyRequests,
+            api_exceptions.ResourceExhausted,
+            api_exceptions.InternalServerError,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.DeadlineExceeded,
+        )
+        self.is_available = bool(api_key)
+        if not api_key:
+            logger.warning("GOOGLE_API_KEY not found in .env file. AI features will be disabled.")
+            # Prevent crash if key missing
+            genai.configure(api_key="DUMMY_KEY_SO_APP_DOESNT_CRASH")
+        else:
+            genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model_name)
+
+    def generate_content(self, prompt, response_schema=None, timeout=None):
+        request_options = {'timeout': timeout} if timeout is not None else None
+        if response_schema is None:
+            return self._model.generate_content(prompt, request_options=request_options)
+        return self._model.generate_content(prompt, generation_config={
+            'response_mime_type': 'application/json',
+            'response_schema': response_schema,
+        }, request_options=request_options)
+
+
+def create_llm_client(backend=LLM_BACKEND):
+    if backend == 'fake':
+        from fake_llm import FakeLLMClient
+        logger.warning("Using the fake LLM backend (LLM_BACKEND=fake); AI suggestions are canned.")
+        return FakeLLMClient(latency_ms=FAKE_LLM_LATENCY_MS,
+                             latency_jitter_ms=FAKE_LLM_LATENCY_JITTER_MS,
+                             error_rate=FAKE_LLM_ERROR_RATE,
+                             malformed_rate=FAKE_LLM_MALFORMED_RATE)
+    if backend != 'gemini':
+        raise ValueError(f"Unknown LLM_BACKEND '{backend}' (expected 'gemini' or 'fake')")
+    return GeminiClient(GEMINI_MODEL_NAME, GOOGLE_API_KEY)
+
+
+llm_client = ResilientLLMClient(
+    create_llm_client(),
+    timeout_seconds=LLM_TIMEOUT_SECONDS,
+    deadline_seconds=LLM_DEADLINE_SECONDS,
+    max_retries=LLM_MAX_RETRIES,
+    backoff_seconds=LLM_RETRY_BACKOFF_SECONDS,
+    backoff_max_seconds=LLM_RETRY_BACKOFF_MAX_SECONDS,
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+    max_in_flight_per_company=LLM_MAX_IN_FLIGHT_PER_COMPANY,
+    queue_timeout_seconds=LLM_QUEUE_TIMEOUT_SECONDS,
+    breaker=CircuitBreaker(window=LLM_BREAKER_WINDOW,
+                           failure_rate=LLM_BREAKER_FAILURE_RATE,
+                           min_calls=LLM_BREAKER_MIN_CALLS,
+                           cooldown_seconds=LLM_BREAKER_COOLDOWN_SECONDS)
+)
+
+registry.gauge('capa_llm_in_flight', 'LLM API calls in flight in this process.',
+               (), lambda: {(): llm_client.in_flight})
+registry.gauge('capa_llm_circuit_open', '1 while the LLM circuit breaker is open (failing fast).',
+               (), lambda: {(): int(llm_client.breaker.is_open)})
+
+
+def _schema(response_schema):
+    """The response schema to request, or None when structured output is switched off."""
+    return response_schema if LLM_STRUCTURED_OUTPUT else None
+
+
+# --- AI request phases ---
+# Both AI flows run in three phases so no database connection is held while the model thinks:
+#   1. snapshot: read the CAPA data into an immutable context (and retrieve knowledge),
+#      then end the transaction;
+#   2. generate: build the prompt, call the LLM and parse the answer, with no DB access;
+#   3. persist: re-read the CAPA under a row lock in a short transaction and store the
+#      suggestion only if the inputs it was generated from are unchanged.
+
+RcaContext = namedtuple('RcaContext', [
+    'capa_id', 'company_id', 'customer_name', 'item_involved', 'machine_name', 'batch_number',
+    'issue_description', 'gemba_findings', 'inputs'
+])
+ActionPlanContext = namedtuple('ActionPlanContext', [
+    'capa_id', 'company_id', 'customer_name', 'item_involved', 'machine_name', 'issue_description',
+    'final_root_cause', 'all_whys_data', 'inputs'
+])
+
+
+def _rca_inputs(issue, gemba):
+    """The CAPA data an RCA suggestion is derived from; a change makes the suggestion stale."""
+    return (issue.issue_description, issue.machine_name, gemba.findings if gemba else None)
+
+
+def _action_plan_inputs(issue, root_cause):
+    """The CAPA data an action-plan suggestion is derived from."""
+    return (issue.issue_description, root_cause.user_adjusted_root_cause if root_cause else None,
+            list(root_cause.user_adjusted_whys_json or []) if root_cause else [])
+
+
+def _release_db_connection():
+    """End the read transaction so the pooled connection is not held during a long LLM call.
+
+    Callers commit their own changes before triggering AI, so there is nothing to write here;
+    the next query simply checks a connection out again.
+    """
+    db.session.commit()
+
+
+# Concurrent triggers for the same CAPA and stage (a double-clicked form, two open tabs)
+# share one job in this process instead of each paying for retrieval and the LLM (and
+# instead of a second job occupying a scheduler worker while it waits for the first)
+_ai_flights = SingleFlight()
+
+
+def _lock_capa(capa_id):
+    """Re-read the CAPA with a row lock, so concurrent writers of its AI suggestions are serialised."""
+    return db.session.get(CapaIssue, capa_id, with_for_update=True, populate_existing=True)
+
+
+def _stale_reason(issue, expected_inputs, current_inputs):
+    """Why a suggestion generated from `expected_inputs` must not be stored, or None."""
+    if issue is None or issue.is_deleted:
+        return "CAPA was deleted during the AI call"
+    if issue.status == 'Closed':
+        return "CAPA was closed during the AI call"
+    if current_inputs != expected_inputs:
+        return "CAPA data changed during the AI call"
+    return None
+
+
+def _refinement_stale_reason(call_log, stored_suggestion, user_adjusted, replaces):
+    """Why a background refinement must not replace the fast-path suggestion `replaces`, or None."""
+    if replaces is None:
+        return None
+    if call_log.outcome == 'parse_error':
+        return "refined answer could not be parsed; keeping the copied suggestion"
+    if stored_suggestion != replaces or user_adjusted:
+        return "copied suggestion was replaced or reviewed during the AI call"
+    return None
+
+
+def _discard_stale_result(call_log, issue, reason, capa_id):
+    if call_log is None:
+        # Copied by the fast path: there is no LLM call to account for
+        logger.warning("Discarding copied AI suggestion for CAPA ID %s: %s", capa_id, reason)
+        return
+    logger.warning("Discarding AI %s suggestion for CAPA ID %s: %s", call_log.call_type, capa_id, reason)
+    call_log.outcome = 'stale'
+    call_log.error_message = reason
+    if issue is None:
+        call_log.capa_id = None  # The row is gone; keep the cost record without the reference
 
-# Initialize Gemini AI
-if not GOOGLE_API_KEY:
-    print("Warning: GOOGLE_API_KEY not found in .env file. AI features will be disabled.")
-    # Prevent crash if key missing
-    genai.configure(api_key="DUMMY_KEY_SO_APP_DOESNT_CRASH")
-else:
-    genai.configure(api_key=GOOGLE_API_KEY)
 
-# Select the model (adjust if needed, check Gemini documentation for available models)
-gemini_model = genai.GenerativeModel('models/gemini-2.5-flash-preview-05-20')
+def _store_rca_suggestion(snapshot, ai_suggestion_str, learning_examples_json, call_log, replaces=None):
+    """Phase 3 of the RCA flow. Returns False when the suggestion was discarded as stale.
+
+    `call_log` is None for a suggestion copied by the fast path; a background refinement
+    passes the copied suggestion as `replaces`.
+    """
+    issue = _lock_capa(snapshot.capa_id)
+    current_inputs = None
+    existing_rc = None
+    if issue is not None:
+        gemba = GembaInvestigation.query.filter_by(capa_id=snapshot.capa_id).first()
+        current_inputs = _rca_inputs(issue, gemba)
+        existing_rc = RootCause.query.filter_by(capa_id=snapshot.capa_id).first()
+    stale_reason = _stale_reason(issue, snapshot.inputs, current_inputs) or _refinement_stale_reason(
+        call_log, existing_rc.ai_suggested_rc_json if existing_rc else None,
+        existing_rc.user_adjusted_whys_json if existing_rc else None, replaces)
+
+    if stale_reason:
+        _discard_stale_result(call_log, issue, stale_reason, snapshot.capa_id)
+    else:
+        if existing_rc:
+            # Update existing record
+            existing_rc.ai_suggested_rc_json = ai_suggestion_str
+            existing_rc.rc_submission_timestamp = datetime.utcnow()  # Update timestamp
+            existing_rc.learning_examples_json = learning_examples_json
+        else:
+            # Create new record
+            db.session.add(RootCause(
+                capa_id=snapshot.capa_id,
+                ai_suggested_rc_json=ai_suggestion_str,
+                learning_examples_json=learning_examples_json
+            ))
+
+    if call_log is not None:
+        db.session.add(call_log)
+    db.session.commit()
+    return stale_reason is None
+
+
+def _store_action_plan_suggestion(snapshot, ai_suggestion_str, call_log, replaces=None):
+    """Phase 3 of the action-plan flow. Returns False when the suggestion was discarded as stale."""
+    issue = _lock_capa(snapshot.capa_id)
+    current_inputs = None
+    existing_ap = None
+    if issue is not None:
+        root_cause = RootCause.query.filter_by(capa_id=snapshot.capa_id).first()
+        current_inputs = _action_plan_inputs(issue, root_cause)
+        existing_ap = ActionPlan.query.filter_by(capa_id=snapshot.capa_id).first()
+    stale_reason = _stale_reason(issue, snapshot.inputs, current_inputs) or _refinement_stale_reason(
+        call_log, existing_ap.ai_suggested_actions_json if existing_ap else None,
+        existing_ap.user_adjusted_actions_json if existing_ap else None, replaces)
+
+    if stale_reason:
+        _discard_stale_result(call_log, issue, stale_reason, snapshot.capa_id)
+    else:
+        if existing_ap:
+            existing_ap.ai_suggested_actions_json = ai_suggestion_str
+            # Don't update timestamp here, wait for user submission
+        else:
+            db.session.add(ActionPlan(
+                capa_id=snapshot.capa_id,
+                ai_suggested_actions_json=ai_suggestion_str
+            ))
+
+    # Don't update issue status here, wait for user submission of action plan details
+    if call_log is not None:
+        db.session.add(call_log)
+    db.session.commit()
+    return stale_reason is None
 
 
 def _parse_action_list(json_str, capa_id_str, action_type_name):
     """Helper to parse action list JSON, handling plain strings and skipping empty/meaningless data."""
     if not json_str or (isinstance(json_str, str) and not json_str.strip()):
-        print(
-            f"Warning: Empty {action_type_name} data for CAPA ID {capa_id_str}")
+        logger.warning("Empty %s data for CAPA ID %s", action_type_name, capa_id_str)
         return []
 
     # Try JSON decode first
@@ -41,8 +334,7 @@ def _parse_action_list(json_str, capa_id_str, action_type_name):
             if result:
                 return result
 
-            print(
-                f"Warning: List in {action_type_name} for CAPA ID {capa_id_str} contains no meaningful items")
+            logger.warning("List in %s for CAPA ID %s contains no meaningful items", action_type_name, capa_id_str)
             return []
 
         elif isinstance(parsed_data, dict):
@@ -66,47 +358,304 @@ def _parse_action_list(json_str, capa_id_str, action_type_name):
         elif isinstance(parsed_data, str) and parsed_data.strip():
             return [parsed_data.strip()]
 
-        print(
-            f"Warning: Parsed {action_type_name} for CAPA ID {capa_id_str} has unexpected format: {type(parsed_data)}")
+        logger.warning("Parsed %s for CAPA ID %s has unexpected format: %s",
+                       action_type_name, capa_id_str, type(parsed_data))
         return []
 
     except (json.JSONDecodeError, TypeError) as e:
         if isinstance(json_str, str) and json_str.strip():
             # Accept any non-empty string
-            print(
-                f"Info: Accepting non-JSON {action_type_name} for CAPA ID {capa_id_str} as a single action: \"{json_str.strip()}\"")
+            logger.info("Accepting non-JSON %s for CAPA ID %s as a single action: \"%s\"",
+                        action_type_name, capa_id_str, json_str.strip())
             return [json_str.strip()]
         else:
-            print(
-                f"Warning: Could not parse {action_type_name} for CAPA ID {capa_id_str}: {e}")
+            logger.warning("Could not parse %s for CAPA ID %s: %s", action_type_name, capa_id_str, e)
             return []
 
 
-def trigger_rca_analysis(capa_id):
-    """Handles the entire RCA process for a CAPA issue: fetches data, gets AI suggestion, stores result."""
-    from models import CapaIssue, GembaInvestigation  # Import here to avoid circular imports
+# --- Prompt texts around the knowledge examples ---
+
+RCA_KNOWLEDGE_INTRO = """
+
+    PEMBELAJARAN DARI RCA SEBELUMNYA:
+    PENTING! SANGAT PRIORITASKAN penggunaan referensi berikut untuk membuat analisis 5 Whys!
+    Berikut adalah beberapa analisis Root Cause sebelumnya yang sangat relevan dengan kasus saat ini.
+    
+    PENTING: JANGAN PERNAH menyebutkan frasa seperti "Mengadaptasi dari contoh 1 & 2" atau sejenisnya dalam jawaban Anda.
+    Gunakan bahasa Anda sendiri dan integrasikan solusi dari contoh-contoh ini secara alami tanpa mereferensikan nomor contoh.
+    
+    Anda HARUS menggunakan referensi ini sebagai dasar utama analisis Anda - bukan hanya sebagai tambahan.
+    Adaptasikan referensi ini untuk kasus yang sedang dianalisis, JANGAN menciptakan analisis baru dari awal:
+"""
+RCA_PROMPT_TAIL = """
+
+    Lakukan analisis 5 Why berdasarkan Detail Masalah yang diberikan DAN hasil investigasi Gemba dari lapangan.
+    PENTING: Gunakan informasi hasil Gemba (terutama akar masalah yang dicurigai) sebagai masukan utama untuk analisis Anda,
+    tapi pastikan bahwa Anda melakukan analisis 5 Why yang logis dan mendalam.
+    Berikan semua hasil dalam Bahasa Indonesia, Berikan jawaban yang tegas dan spesifik tanpa keraguan,Hindari penggunaan tanda "/" dalam jawaban, 
+    Pilih satu istilah yang paling tepat, jangan memberikan alternatif.
+    """
 
-    if not GOOGLE_API_KEY:
-        print(f"Skipping AI RCA for CAPA ID {capa_id}: API Key not configured.")
+
+def _rca_knowledge_snippet(knowledge_item):
+    """Prompt lines for one retrieved RCA knowledge item, or None when it has no usable WHYs."""
+    try:
+        context_data_dict = knowledge_item.get('context', {})
+        source_capa_id_str = context_data_dict.get('source_capa_id', 'N/A')
+        rendered = knowledge_item.get('prompt_snippet')
+        if rendered is None:
+            # Entry without a current pre-rendered snippet: parse and render it now
+            whys_list = _knowledge_whys(knowledge_item.get('adjusted_whys'), source_capa_id_str)
+            rendered = render_rca_snippet(context_data_dict.get('issue_description'),
+                                          context_data_dict.get('machine_name'), whys_list)
+        if rendered is None:
+            return None
+        return KnowledgeSnippet(source_capa_id_str, context_data_dict.get('similarity_score'),
+                                rendered['lines'], rendered['dedupe_text'])
+    except Exception as e:  # Catch any other unexpected errors during processing
+        logger.warning("Unexpected error processing RCA knowledge item for prompt: %s", e)
+        return None
+
+
+def _knowledge_whys(adjusted_whys_json_str, source_capa_id_str):
+    """The meaningful WHYs of a knowledge entry's adjusted_whys_json."""
+    # Only use knowledge items where adjusted_whys_json_str is non-empty and contains at least some meaningful text
+    if not adjusted_whys_json_str or (isinstance(adjusted_whys_json_str, str) and not adjusted_whys_json_str.strip()):
+        return []
+    # Use improved _parse_action_list to get only meaningful whys
+    whys_list = _parse_action_list(adjusted_whys_json_str, source_capa_id_str, "adjusted_whys_json")
+    # If _parse_action_list returns nothing but the original string is non-empty, include it as a single why
+    if not whys_list and isinstance(adjusted_whys_json_str, str) and adjusted_whys_json_str.strip():
+        whys_list = [adjusted_whys_json_str.strip()]
+    return whys_list
+
+
+def render_knowledge_entry_snippets(entry):
+    """The prompt_snippets_json value of a knowledge entry, rendered from its stored JSON columns."""
+    return render_knowledge_snippets(
+        entry.issue_description, entry.machine_name,
+        _knowledge_whys(entry.adjusted_whys_json, entry.capa_id),
+        _parse_action_list(entry.adjusted_temporary_actions_json, entry.capa_id, "temporary actions"),
+        _parse_action_list(entry.adjusted_preventive_actions_json, entry.capa_id, "preventive actions"))
+
+
+def _learning_examples_json(knowledge_items):
+    """The RCA learning examples shown with the suggestion (learning_examples_json)."""
+    learning_examples = []
+    for i, knowledge_item in enumerate(knowledge_items, 1):
+        try:
+            adjusted_whys_json_str = knowledge_item.get('adjusted_whys')
+            context_data_dict = knowledge_item.get('context', {})
+            source_capa_id_str = context_data_dict.get(
+                'source_capa_id', 'N/A')
+            
+            if adjusted_whys_json_str and isinstance(adjusted_whys_json_str, str) and adjusted_whys_json_str.strip():
+                whys_list = _parse_action_list(
+                    adjusted_whys_json_str, source_capa_id_str, "adjusted_whys_json")
+                
+                if not whys_list and adjusted_whys_json_str.strip():
+                    whys_list = [adjusted_whys_json_str.strip()]
+                
+                if whys_list:
+                    example = {
+                        "id": i,
+                        "capa_id": source_capa_id_str,
+                        "description": context_data_dict.get('issue_description', 'Tidak tersedia'),
+                        "machine": context_data_dict.get('machine_name', 'Tidak tersedia'),
+                        "whys": []
+                    }
+                    
+                    for idx, why_text in enumerate(whys_list):
+                        example["whys"].append(
+                            {"number": idx + 1, "text": why_text})
+                    
+                    learning_examples.append(example)
+        except Exception as e:
+            logger.warning("Error processing learning example %s: %s", i, e)
+            continue
+    
+    return json.dumps(
+        learning_examples, ensure_ascii=False)
+
+
+# --- Repeat-issue fast path ---
+# A new CAPA matching a closed one of the same company and machine at least
+# AI_FAST_PATH_MIN_SIMILARITY gets that CAPA's user-adjusted WHYs / actions as its
+# suggestion right away, flagged with source_capa_id, instead of waiting for Gemini. The
+# LLM suggestion is then generated on a background thread and replaces the copy, unless
+# the user has submitted their analysis in the meantime (see _refinement_stale_reason).
+# Bulk re-generation passes use_fast_path=False: it is run to get fresh LLM suggestions.
+
+
+def _is_repeat_issue(snapshot, context_data_dict, score_keys):
+    if not AI_FAST_PATH_ENABLED or not snapshot.machine_name:
+        return False
+    # Keyword matches carry no scores and never qualify
+    return (context_data_dict.get('company_id') == snapshot.company_id
+            and context_data_dict.get('machine_name') == snapshot.machine_name
+            and all((context_data_dict.get(key) or 0) >= AI_FAST_PATH_MIN_SIMILARITY for key in score_keys))
+
+
+def _rca_fast_path_suggestion(snapshot, relevant_knowledge):
+    """The WHYs of a near-identical closed CAPA as (RcaSuggestion, knowledge item), or None."""
+    for knowledge_item in relevant_knowledge:
+        context_data_dict = knowledge_item.get('context', {})
+        if not _is_repeat_issue(snapshot, context_data_dict, ('similarity_score',)):
+            continue
+        source_capa_id = context_data_dict.get('source_capa_id')
+        whys = _knowledge_whys(knowledge_item.get('adjusted_whys'), source_capa_id)
+        if whys:
+            # Root cause as edit_rca stores it: the fifth WHY, or the last one of a shorter list
+            root_cause_index = 4 if len(whys) > 4 else len(whys) - 1
+            why_fields = whys[:root_cause_index] + [''] * (len(WHY_KEYS) - 1 - root_cause_index)
+            return RcaSuggestion(**dict(zip(WHY_KEYS, why_fields + [whys[root_cause_index]])),
+                                 source_capa_id=source_capa_id), knowledge_item
+    return None
+
+
+def _action_plan_fast_path_suggestion(snapshot, relevant_knowledge):
+    """The actions of a closed CAPA with a near-identical issue and WHYs as an ActionPlanSuggestion, or None."""
+    for knowledge_item in relevant_knowledge:
+        context_data_dict = knowledge_item.get('context', {})
+        if not _is_repeat_issue(snapshot, context_data_dict, ('issue_similarity_score', 'whys_similarity_score')):
+            continue
+        source_capa_id = context_data_dict.get('source_capa_id')
+        temp_actions = _parse_action_list(
+            knowledge_item.get('adjusted_temporary_actions'), source_capa_id, "temporary actions")
+        prev_actions = _parse_action_list(
+            knowledge_item.get('adjusted_preventive_actions'), source_capa_id, "preventive actions")
+        if temp_actions or prev_actions:
+            return ActionPlanSuggestion(
+                temporary_action=[ActionStep(langkah=action_text) for action_text in temp_actions],
+                preventive_action=[ActionStep(langkah=action_text) for action_text in prev_actions],
+                source_capa_id=source_capa_id)
+    return None
+
+
+def _log_refinement_failure(capa_id, future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Background refinement of the copied AI suggestion for CAPA ID %s failed: %s",
+                       capa_id, future.exception())
+
+
+def _schedule_refinement(trigger, snapshot, copied_suggestion):
+    """Generate the LLM suggestion for a CAPA served by the fast path in the background."""
+    if not AI_FAST_PATH_REFINE:
         return
+    future = trigger(snapshot.capa_id, refining=copied_suggestion, priority=BACKGROUND,
+                     company_id=snapshot.company_id, wait=False)
+    future.add_done_callback(lambda done: _log_refinement_failure(snapshot.capa_id, done))
+
+
+def _wait_for_job(stage, capa_id, future):
+    with span('ai.job_wait'):
+        try:
+            return future.result(timeout=AI_JOB_WAIT_TIMEOUT_SECONDS)
+        except TimeoutError:
+            if future.done():
+                raise  # Raised by the job itself
+            raise TimeoutError(f"AI {stage} job for CAPA ID {capa_id} is still running; "
+                               f"its suggestion will appear when it finishes") from None
+
+
+def _run_job(stage, job, capa_id, refining, priority, company_id, wait, use_fast_path):
+    """Queue `job(capa_id, refining, use_fast_path)` on the AI scheduler and wait for its result, or return its Future.
+
+    While a job for the same CAPA and stage is queued or running, its Future is shared
+    instead (refinements excepted).
+    """
+    if company_id is None:
+        company_id = db.session.query(CapaIssue.company_id).filter_by(capa_id=capa_id).scalar()
+    # The job reads the CAPA in its own session: make this request's changes visible to it
+    db.session.commit()
+
+    def submit():
+        return scheduler.submit(stage, capa_id, company_id, priority, job, capa_id, refining, use_fast_path)[1]
+
+    if refining is not None:
+        # A refinement replaces one particular copied suggestion, so it is never shared
+        future, shared = submit(), False
+    else:
+        future, shared = _ai_flights.share((stage, capa_id), submit)
+    if shared:
+        ai_single_flight_shared_total.inc(stage=stage)
+    if not wait:
+        return future
+    stored = _wait_for_job(stage, capa_id, future)
+    if shared and not stored:
+        # The shared job stored nothing, e.g. its result went stale because this request
+        # changed the CAPA meanwhile: run again for the current data
+        stored = _wait_for_job(stage, capa_id, _ai_flights.share((stage, capa_id), submit)[0])
+    return stored
+
+
+def trigger_rca_analysis(capa_id, refining=None, priority=INTERACTIVE, company_id=None, wait=True,
+                         use_fast_path=True):
+    """Handles the entire RCA process for a CAPA issue: fetches data, gets AI suggestion, stores result.
+
+    Runs as a job of the AI scheduler (ai_scheduler.py) with `priority`. Waits for it and
+    returns True when a suggestion was stored, or with wait=False returns the job's
+    Future at once. Concurrent runs for the same CAPA are shared. `refining` is set by
+    the background refinement of a fast-path suggestion: the copied suggestion JSON,
+    which the LLM suggestion replaces only while it is still unreviewed. With
+    use_fast_path=False the LLM is called even for a repeat issue (see the fast path above).
+    """
+    return _run_job('rca', _run_rca_analysis, capa_id, refining, priority, company_id, wait, use_fast_path)
+
 
-    # Get issue data and relevant AI knowledge for context
-    issue = CapaIssue.query.get(capa_id)
+def _run_rca_analysis(capa_id, refining=None, use_fast_path=True):
+    if not llm_client.is_available:
+        logger.info("Skipping AI RCA for CAPA ID %s: API Key not configured.", capa_id)
+        return False
+
+    # --- Phase 1: snapshot the CAPA data and retrieve relevant AI knowledge ---
+    issue = CapaIssue.query.options(db.undefer_group('embeddings')).get(capa_id)
     if not issue:
-        print(f"Error: CAPA ID {capa_id} not found")
-        return
+        logger.error("CAPA ID %s not found", capa_id)
+        return False
 
     gemba = GembaInvestigation.query.filter_by(capa_id=capa_id).first()
     if not gemba:
-        print(f"Error: Gemba investigation for CAPA ID {capa_id} not found")
-        return
+        logger.error("Gemba investigation for CAPA ID %s not found", capa_id)
+        return False
+
+    snapshot = RcaContext(
+        capa_id=issue.capa_id,
+        company_id=issue.company_id,
+        customer_name=issue.customer_name,
+        item_involved=issue.item_involved,
+        machine_name=issue.machine_name,
+        batch_number=issue.batch_number,
+        issue_description=issue.issue_description,
+        gemba_findings=gemba.findings,
+        inputs=_rca_inputs(issue, gemba)
+    )
 
-    # Get relevant knowledge for this case
-    relevant_knowledge = get_relevant_rca_knowledge(
-        current_capa_issue_description=issue.issue_description,
-        current_capa_machine_name=issue.machine_name,
-        limit=5  # Get more references for better learning examples
+    # Get relevant knowledge for this case (usually already retrieved when the CAPA was created)
+    relevant_knowledge = get_rca_knowledge_for_capa(
+        snapshot.capa_id,
+        snapshot.issue_description,
+        snapshot.machine_name,
+        limit=5,  # Get more references for better learning examples
+        issue_embedding=capa_issue_embedding(issue)
     )
+    _release_db_connection()
+
+    # Repeat issue: propose the WHYs of the matching closed CAPA without calling the LLM
+    fast_path = (_rca_fast_path_suggestion(snapshot, relevant_knowledge)
+                 if refining is None and use_fast_path else None)
+    if fast_path is not None:
+        suggestion, knowledge_item = fast_path
+        ai_suggestion_str = suggestion_json(suggestion)
+        if not _store_rca_suggestion(snapshot, ai_suggestion_str, _learning_examples_json([knowledge_item]), None):
+            return False
+        ai_fast_path_total.inc(stage='rca')
+        logger.info("RCA suggestion for CAPA ID %s copied from closed CAPA ID %s (similarity %s).",
+                    capa_id, suggestion.source_capa_id, knowledge_item['context'].get('similarity_score'))
+        _schedule_refinement(trigger_rca_analysis, snapshot, ai_suggestion_str)
+        return True
+
+    # --- Phase 2: build the prompt, call the LLM and parse the answer (no DB access) ---
 
     # --- Prepare Prompt in Bahasa Indonesia ---
     prompt = f"""
@@ -115,14 +664,14 @@ def trigger_rca_analysis(capa_id):
     PENTING: Berikan SEMUA TANGGAPAN dalam BAHASA INDONESIA.
 
     Detil Masalah:
-    Pelanggan: {issue.customer_name}
-    Item yang Terlibat: {issue.item_involved}
-    Mesin: {issue.machine_name or 'Tidak diketahui'}
-    Batch: {issue.batch_number or 'Tidak diketahui'}
-    Deskripsi Masalah: {issue.issue_description}
+    Pelanggan: {snapshot.customer_name}
+    Item yang Terlibat: {snapshot.item_involved}
+    Mesin: {snapshot.machine_name or 'Tidak diketahui'}
+    Batch: {snapshot.batch_number or 'Tidak diketahui'}
+    Deskripsi Masalah: {snapshot.issue_description}
 
     Hasil Investigasi Gemba (Data dari Lapangan):
-    {gemba.findings if gemba else 'Tidak ada data gemba'}
+    {snapshot.gemba_findings or 'Tidak ada data gemba'}
 
     Contoh Format Output JSON (setiap 'why' adalah pernyataan langsung penyebabnya):
     {{
@@ -134,300 +683,163 @@ def trigger_rca_analysis(capa_id):
     }}
     """
 
-    processed_knowledge_count = 0
-    # Add knowledge from previous relevant RCAs if available
-    if relevant_knowledge:
-        prompt += """
-
-    PEMBELAJARAN DARI RCA SEBELUMNYA:
-    PENTING! SANGAT PRIORITASKAN penggunaan referensi berikut untuk membuat analisis 5 Whys!
-    Berikut adalah beberapa analisis Root Cause sebelumnya yang sangat relevan dengan kasus saat ini.
-    
-    PENTING: JANGAN PERNAH menyebutkan frasa seperti "Mengadaptasi dari contoh 1 & 2" atau sejenisnya dalam jawaban Anda.
-    Gunakan bahasa Anda sendiri dan integrasikan solusi dari contoh-contoh ini secara alami tanpa mereferensikan nomor contoh.
-    
-    Anda HARUS menggunakan referensi ini sebagai dasar utama analisis Anda - bukan hanya sebagai tambahan.
-    Adaptasikan referensi ini untuk kasus yang sedang dianalisis, JANGAN menciptakan analisis baru dari awal:
-    """
-        for i, knowledge_item in enumerate(relevant_knowledge, 1):
-            try:
-                adjusted_whys_json_str = knowledge_item.get('adjusted_whys')
-                context_data_dict = knowledge_item.get('context', {})
-                source_capa_id_str = context_data_dict.get(
-                    'source_capa_id', 'N/A')  # For logging
-
-                # Only use knowledge items where adjusted_whys_json_str is non-empty and contains at least some meaningful text
-                if not adjusted_whys_json_str or (isinstance(adjusted_whys_json_str, str) and not adjusted_whys_json_str.strip()):
-                    continue
-
-                # Use improved _parse_action_list to get only meaningful whys
-                whys_list = _parse_action_list(
-                    adjusted_whys_json_str, source_capa_id_str, "adjusted_whys_json")
-
-                # If _parse_action_list returns nothing but the original string is non-empty, include it as a single why
-                if not whys_list and isinstance(adjusted_whys_json_str, str) and adjusted_whys_json_str.strip():
-                    whys_list = [adjusted_whys_json_str.strip()]
-
-                # Now format the whys_list (if valid) into the prompt
-                if whys_list:  # Ensure we have a list (even if single item)
-                    prompt += f"""
-    Contoh Pembelajaran {i} (dari CAPA ID: {source_capa_id_str}):
-    Konteks Masalah Sebelumnya:
-      Deskripsi: {context_data_dict.get('issue_description', 'Tidak tersedia')}
-      Mesin: {context_data_dict.get('machine_name', 'Tidak tersedia')}
-    Pembelajaran RCA (5 Whys yang disesuaikan pengguna):
-    """
-                    for idx, why_text in enumerate(whys_list):
-                        prompt += f"      Why {idx + 1}: {why_text}\n"
-                    prompt += "\n"
-                    processed_knowledge_count += 1  # Count successfully processed items
-                else:
-                    # This case should ideally not be reached if logic above is correct, but as fallback:
-                    prompt += f"""
-    Contoh Pembelajaran {i} (dari CAPA ID: {source_capa_id_str}):
-    Konteks Masalah Sebelumnya:
-      Deskripsi: {context_data_dict.get('issue_description', 'Tidak tersedia')}
-      Mesin: {context_data_dict.get('machine_name', 'Tidak tersedia')}
-    Pembelajaran RCA (5 Whys yang disesuaikan pengguna):
-          (Data 'why' tidak dapat diproses)\n
-    """
-                    prompt += "\n"
-
-            except Exception as e:  # Catch any other unexpected errors during processing
-                print(
-                    f"Unexpected error processing RCA knowledge item {i} for prompt: {e}")
-                continue
-
-    prompt += """
-
-    Lakukan analisis 5 Why berdasarkan Detail Masalah yang diberikan DAN hasil investigasi Gemba dari lapangan.
-    PENTING: Gunakan informasi hasil Gemba (terutama akar masalah yang dicurigai) sebagai masukan utama untuk analisis Anda,
-    tapi pastikan bahwa Anda melakukan analisis 5 Why yang logis dan mendalam.
-    Berikan semua hasil dalam Bahasa Indonesia, Berikan jawaban yang tegas dan spesifik tanpa keraguan,Hindari penggunaan tanda "/" dalam jawaban, 
-    Pilih satu istilah yang paling tepat, jangan memberikan alternatif.
-    """
-
-    # Log the knowledge enhancement using the count of successfully processed items
-    if processed_knowledge_count > 0:
-        print(
-            f"Enhanced RCA prompt with {processed_knowledge_count} relevant knowledge entries.")
+    # Learning examples from previous relevant RCAs, within the prompt's token budget
+    snippets = [snippet for snippet in map(_rca_knowledge_snippet, relevant_knowledge) if snippet]
+    prompt, used_snippets = assemble_prompt(
+        prompt, RCA_KNOWLEDGE_INTRO, snippets, "Contoh Pembelajaran {number} (dari CAPA ID: {source_capa_id}):",
+        RCA_PROMPT_TAIL)
+
+    # Log the knowledge enhancement using the count of examples that made it into the prompt
+    if used_snippets:
+        logger.info("Enhanced RCA prompt with %d relevant knowledge entries.", len(used_snippets))
+    elif relevant_knowledge:
+        logger.info("Relevant prior knowledge was found, but none could be used in the prompt.")
     else:
-        # Check if relevant_knowledge was initially found but none could be processed
-        if relevant_knowledge:
-            print(
-                "Relevant prior knowledge was found, but none could be successfully processed for the prompt.")
-        else:
-            print("No relevant prior knowledge found for enhancing RCA.")
+        logger.info("No relevant prior knowledge found for enhancing RCA.")
 
-    response = None
+    call_log = start_ai_call('rca', llm_client.model_name, snapshot)
     try:
-        print("\n================ AI RCA ANALYSIS DEBUG ================")
-        print(f"[PROMPT SENT to Gemini | CAPA ID {capa_id}]:\n{prompt}\n")
-        response = gemini_model.generate_content(prompt)
-        print(
-            f"[RAW AI RESPONSE]:\n{getattr(response, 'text', str(response))}\n")
-
-        # Attempt to parse the response, handling both JSON and text formats
+        logger.debug("RCA prompt sent to Gemini for CAPA ID %s:\n%s", capa_id, prompt, extra=PAYLOAD)
+        with span('llm.rca'), measure_latency(call_log):
+            response = llm_client.generate_content(prompt, response_schema=_schema(RCA_RESPONSE_SCHEMA),
+                                                   call_log=call_log)
+        record_usage(call_log, response)
+        logger.debug("Raw RCA response for CAPA ID %s:\n%s", capa_id,
+                     getattr(response, 'text', response), extra=PAYLOAD)
+
+        # Validate the (schema-constrained) answer, repairing formatting slips locally
         try:
-            # Gemini might wrap JSON in ```json ... ```, try to extract it
-            ai_suggestion_text = response.text.strip()
-
-            # First, try to clean up markdown code blocks if present
-            if "```json" in ai_suggestion_text:
-                # Extract content between ```json and ``` markers
-                import re
-                json_block_match = re.search(
-                    r'```json\s*(.+?)\s*```', ai_suggestion_text, re.DOTALL)
-                if json_block_match:
-                    ai_suggestion_text = json_block_match.group(1).strip()
-            elif "```" in ai_suggestion_text:
-                # Try to extract any code block even if not explicitly marked as JSON
-                import re
-                code_block_match = re.search(
-                    r'```\s*(.+?)\s*```', ai_suggestion_text, re.DOTALL)
-                if code_block_match:
-                    ai_suggestion_text = code_block_match.group(1).strip()
-
-            # Try to parse as JSON
-            try:
-                ai_suggestion_json = json.loads(ai_suggestion_text)
-                # Basic validation of expected keys
-                if all(k in ai_suggestion_json for k in ["why1", "why2", "why3", "why4", "root_cause"]):
-                    # If valid JSON with expected keys, use it directly
-                    ai_suggestion_str = json.dumps(
-                        ai_suggestion_json, indent=2, ensure_ascii=False)
-                    print(
-                        f"[PARSED AI RCA RESULT | JSON]:\n{ai_suggestion_str}\n")
-                else:
-                    # JSON format but missing required keys
-                    raise ValueError(
-                        "JSON response missing expected 5 Why keys")
-
-            except json.JSONDecodeError:
-                # If not valid JSON, extract information from text format
-                print(
-                    f"Response not in JSON format, extracting from text for CAPA ID {capa_id}")
-
-                # Define a structured format to extract from text
-                structured_response = {
-                    "why1": "",
-                    "why2": "",
-                    "why3": "",
-                    "why4": "",
-                    "root_cause": ""
-                }
-
-                # Extract each why from the text response
-                lines = ai_suggestion_text.split('\n')
-                current_why = None
-
-                for line in lines:
-                    line = line.strip()
-                    if not line:
-                        continue
-
-                    # Look for why1-why4 and root_cause indicators
-                    if "why1" in line.lower() or "1." in line or "why 1" in line.lower():
-                        current_why = "why1"
-                        # Extract content after the marker
-                        content = line.split(':', 1)[1].strip() if ':' in line else line.split(' ', 1)[
-                            1].strip() if ' ' in line else ""
-                        structured_response["why1"] = content
-                    elif "why2" in line.lower() or "2." in line or "why 2" in line.lower():
-                        current_why = "why2"
-                        content = line.split(':', 1)[1].strip() if ':' in line else line.split(' ', 1)[
-                            1].strip() if ' ' in line else ""
-                        structured_response["why2"] = content
-                    elif "why3" in line.lower() or "3." in line or "why 3" in line.lower():
-                        current_why = "why3"
-                        content = line.split(':', 1)[1].strip() if ':' in line else line.split(' ', 1)[
-                            1].strip() if ' ' in line else ""
-                        structured_response["why3"] = content
-                    elif "why4" in line.lower() or "4." in line or "why 4" in line.lower():
-                        current_why = "why4"
-                        content = line.split(':', 1)[1].strip() if ':' in line else line.split(' ', 1)[
-                            1].strip() if ' ' in line else ""
-                        structured_response["why4"] = content
-                    elif "root" in line.lower() or "5." in line or "root cause" in line.lower():
-                        current_why = "root_cause"
-                        content = line.split(':', 1)[1].strip() if ':' in line else line.split(' ', 1)[
-                            1].strip() if ' ' in line else ""
-                        structured_response["root_cause"] = content
-                    elif current_why and structured_response[current_why] == "":
-                        # If we're in a section but haven't captured content yet
-                        structured_response[current_why] = line
-
-                # Convert the structured response back to a JSON string
-                ai_suggestion_str = json.dumps(
-                    structured_response, indent=2, ensure_ascii=False)
-                print(
-                    f"[PARSED AI RCA RESULT | TEXT-TO-STRUCTURED]:\n{ai_suggestion_str}\n")
-
+            suggestion, call_log.outcome = parse_rca_suggestion(response.text)
+            ai_suggestion_str = suggestion_json(suggestion)
+            logger.debug("Parsed RCA result (%s) for CAPA ID %s:\n%s",
+                         call_log.outcome, capa_id, ai_suggestion_str, extra=PAYLOAD)
         except Exception as parse_error:
-            print(
-                f"[ERROR] Processing AI response for CAPA ID {capa_id}: {str(parse_error)}")
-            if response is not None:
-                print(
-                    f"[FALLBACK RAW AI RESPONSE]:\n{getattr(response, 'text', str(response))}\n")
-                ai_suggestion_str = f'{{"error": "Failed to parse AI response", "raw_response": {json.dumps(getattr(response, 'text', str(response)))} }}'
-            else:
-                print(
-                    "[FALLBACK RAW AI RESPONSE]: Gemini response was not generated due to earlier error.")
-                ai_suggestion_str = '{"error": "Failed to parse AI response", "raw_response": null}'
-            # Consider flashing a specific warning to the user later
-
-        # Prepare the learning examples in a structured format for storage
-        learning_examples = []
-        for i, knowledge_item in enumerate(relevant_knowledge, 1):
-            try:
-                adjusted_whys_json_str = knowledge_item.get('adjusted_whys')
-                context_data_dict = knowledge_item.get('context', {})
-                source_capa_id_str = context_data_dict.get(
-                    'source_capa_id', 'N/A')
-                
-                if adjusted_whys_json_str and isinstance(adjusted_whys_json_str, str) and adjusted_whys_json_str.strip():
-                    whys_list = _parse_action_list(
-                        adjusted_whys_json_str, source_capa_id_str, "adjusted_whys_json")
-                    
-                    if not whys_list and adjusted_whys_json_str.strip():
-                        whys_list = [adjusted_whys_json_str.strip()]
-                    
-                    if whys_list:
-                        example = {
-                            "id": i,
-                            "capa_id": source_capa_id_str,
-                            "description": context_data_dict.get('issue_description', 'Tidak tersedia'),
-                            "machine": context_data_dict.get('machine_name', 'Tidak tersedia'),
-                            "whys": []
-                        }
-                        
-                        for idx, why_text in enumerate(whys_list):
-                            example["whys"].append(
-                                {"number": idx + 1, "text": why_text})
-                        
-                        learning_examples.append(example)
-            except Exception as e:
-                print(f"Error processing learning example {i}: {e}")
-                continue
-        
-        # Store result in database
-        existing_rc = RootCause.query.filter_by(capa_id=capa_id).first()
-        learning_examples_json = json.dumps(
-            learning_examples, ensure_ascii=False)
-        
-        if existing_rc:
-            # Update existing record
-            existing_rc.ai_suggested_rc_json = ai_suggestion_str
-            existing_rc.rc_submission_timestamp = datetime.utcnow()  # Update timestamp
-            existing_rc.learning_examples_json = learning_examples_json
-        else:
-            # Create new record
-            new_rc = RootCause(
-                capa_id=capa_id,
-                ai_suggested_rc_json=ai_suggestion_str,
-                learning_examples_json=learning_examples_json
-            )
-            db.session.add(new_rc)
+            logger.error("Processing AI response for CAPA ID %s: %s", capa_id, parse_error)
+            call_log.outcome = 'parse_error'
+            logger.warning("Unparsed RCA response for CAPA ID %s:\n%s",
+                           capa_id, getattr(response, 'text', response))
+            ai_suggestion_str = f'{{"error": "Failed to parse AI response", "raw_response": {json.dumps(getattr(response, 'text', str(response)))} }}'
 
-        db.session.commit()
-        print(f"AI RCA Suggestion stored for CAPA ID {capa_id}.")
+        # Prepare the learning examples used in the prompt in a structured format for storage
+        used_capa_ids = {snippet.source_capa_id for snippet in used_snippets}
+        used_knowledge = [item for item in relevant_knowledge
+                          if item.get('context', {}).get('source_capa_id', 'N/A') in used_capa_ids]
+        learning_examples_json = _learning_examples_json(used_knowledge)
+
+        # --- Phase 3: store the result in a short transaction ---
+        if not _store_rca_suggestion(snapshot, ai_suggestion_str, learning_examples_json, call_log, replaces=refining):
+            return False
+        logger.info("AI RCA Suggestion stored for CAPA ID %s.", capa_id)
+        return True
 
     except Exception as e:
         # Handle potential API errors (rate limits, connection issues, etc.)
-        print(f"Error calling Gemini API for CAPA ID {capa_id}: {e}")
+        logger.error("Error calling Gemini API for CAPA ID %s: %s", capa_id, e)
+        save_failed_call(call_log, e)
         # Re-raise the exception so the calling function can handle it (e.g., flash message)
         raise e
 
 
-def trigger_action_plan_recommendation(capa_id):
-    """Fetches issue and RCA with all WHYs, calls Gemini for action plan, stores result."""
-    from models import CapaIssue  # Import here to avoid circular imports
+ACTION_PLAN_KNOWLEDGE_INTRO = """
 
-    if not GOOGLE_API_KEY:
-        print(
-            f"Skipping AI Action Plan for CAPA ID {capa_id}: API Key not configured.")
-        return
+    PEMBELAJARAN DARI RENCANA TINDAKAN SEBELUMNYA YANG SERUPA:
+    PERINTAH WAJIB UNTUK AI:
+    1. WAJIB menggunakan contoh-contoh berikut sebagai BASIS UTAMA rekomendasi Anda
+    2. DILARANG KERAS membuat rekomendasi baru yang tidak berdasarkan contoh di bawah ini
+    3. Setiap rekomendasi yang Anda buat HARUS merupakan adaptasi dari contoh-contoh berikut
+    4. Jika ada contoh yang sangat mirip dengan kasus ini, WAJIB menggunakan solusi yang sama
+    5. HANYA boleh memodifikasi contoh jika benar-benar diperlukan untuk menyesuaikan dengan kasus spesifik ini
+    6. DILARANG menyebutkan "berdasarkan contoh" atau sejenisnya dalam rekomendasi
+    
+    Berikut adalah Rencana Tindakan dari kasus-kasus sebelumnya yang telah TERBUKTI BERHASIL:
+"""
+ACTION_PLAN_NO_KNOWLEDGE = """
+    (Tidak ada pembelajaran dari Rencana Tindakan sebelumnya yang cocok ditemukan untuk kasus ini.)
+    """
+ACTION_PLAN_PROMPT_TAIL = """
+
+    Perhatikan! Berikan HANYA langkah tindakan untuk setiap item, tanpa indikator keberhasilan, penanggung jawab, atau deadline - itu akan ditambahkan oleh pengguna aplikasi.
+
+    OUTPUT harus merupakan JSON yang valid dan sederhana. Hanya berisi array langkah-langkah tindakan yang perlu dilakukan.
+    Buat 3-4 langkah tindakan sementara dan 2-3 langkah tindakan pencegahan yang spesifik dan relevan dengan masalah tersebut.
+    Pastikan semuanya dalam Bahasa Indonesia, Berikan jawaban yang tegas dan spesifik tanpa keraguan,Hindari penggunaan tanda "/" dalam jawaban, 
+    Pilih satu istilah yang paling tepat, jangan memberikan alternatif.
+    """
+
+
+def _action_plan_knowledge_snippet(knowledge_item):
+    """Prompt lines for one retrieved action-plan knowledge item, or None when it has no actions."""
+    try:
+        context_data_dict = knowledge_item.get('context', {})
+        source_capa_id_str = context_data_dict.get('source_capa_id', 'N/A')  # Get source ID for logging
+        rendered = knowledge_item.get('prompt_snippet')
+        if rendered is None:
+            # Entry without a current pre-rendered snippet: parse and render it now
+            rendered = render_action_plan_snippet(
+                context_data_dict.get('issue_description'), context_data_dict.get('machine_name'),
+                _parse_action_list(knowledge_item.get('adjusted_temporary_actions'), source_capa_id_str, "temporary actions"),
+                _parse_action_list(knowledge_item.get('adjusted_preventive_actions'), source_capa_id_str, "preventive actions"))
+        if rendered is None:
+            logger.info("Skipping knowledge item from CAPA ID %s for Action Plan prompt as parsing yielded no actions.",
+                        source_capa_id_str)
+            return None
+        # Ranked by WHYs similarity, then issue similarity (keyword matches carry no score)
+        score = None
+        if 'score' in knowledge_item:
+            score = (knowledge_item['score'], context_data_dict.get('issue_similarity_score', 0))
+        return KnowledgeSnippet(source_capa_id_str, score, rendered['lines'], rendered['dedupe_text'])
+    except Exception as e:  # This except catches errors for the whole item processing
+        logger.warning("Error processing Action Plan knowledge item for prompt: %s", e)
+        return None
+
+
+def trigger_action_plan_recommendation(capa_id, refining=None, priority=INTERACTIVE, company_id=None, wait=True,
+                                       use_fast_path=True):
+    """Fetches issue and RCA with all WHYs, calls Gemini for action plan, stores result.
+
+    Scheduling, concurrent triggers, `refining` and `use_fast_path` work as for trigger_rca_analysis.
+    """
+    return _run_job('action_plan', _run_action_plan_recommendation, capa_id, refining, priority, company_id, wait,
+                    use_fast_path)
+
+
+def _run_action_plan_recommendation(capa_id, refining=None, use_fast_path=True):
+    if not llm_client.is_available:
+        logger.info("Skipping AI Action Plan for CAPA ID %s: API Key not configured.", capa_id)
+        return False
 
+    # --- Phase 1: snapshot the CAPA data and retrieve relevant AI knowledge ---
     issue = CapaIssue.query.options(
-        db.joinedload(CapaIssue.root_cause)).get(capa_id)
+        db.joinedload(CapaIssue.root_cause),
+        db.undefer_group('embeddings')).get(capa_id)
     if not issue or not issue.root_cause or not issue.root_cause.user_adjusted_root_cause:
-        print(
-            f"Error: Cannot trigger Action Plan AI for CAPA ID {capa_id}. Missing issue or final root cause.")
-        return
+        logger.error("Cannot trigger Action Plan AI for CAPA ID %s. Missing issue or final root cause.", capa_id)
+        return False
+
+    snapshot = ActionPlanContext(
+        capa_id=issue.capa_id,
+        company_id=issue.company_id,
+        customer_name=issue.customer_name,
+        item_involved=issue.item_involved,
+        machine_name=issue.machine_name,
+        issue_description=issue.issue_description,
+        final_root_cause=issue.root_cause.user_adjusted_root_cause,
+        # A plain copy, so the snapshot does not follow later changes to the mutable column
+        all_whys_data=list(issue.root_cause.user_adjusted_whys_json or []),
+        inputs=_action_plan_inputs(issue, issue.root_cause)
+    )
 
     # This is the final "why" string
-    final_rc = issue.root_cause.user_adjusted_root_cause
-    # This is the JSON string of all whys
-    user_adjusted_whys_json_for_current_capa = issue.root_cause.user_adjusted_whys_json
+    final_rc = snapshot.final_root_cause
+    # The decoded list of all whys, plus its JSON string form for knowledge retrieval
+    all_whys_data = snapshot.all_whys_data
+    user_adjusted_whys_json_for_current_capa = json.dumps(
+        all_whys_data) if all_whys_data else None
 
-    # Parse all WHYs from JSON to incorporate in prompt
+    # Normalise all WHYs to incorporate in prompt
     all_whys = []
     try:
-        # First check if the JSON string is valid
-        if user_adjusted_whys_json_for_current_capa and user_adjusted_whys_json_for_current_capa.strip():
-            all_whys_data = json.loads(
-                user_adjusted_whys_json_for_current_capa)
-
+        if all_whys_data:
             # Handle different expected formats of the WHYs data
             if isinstance(all_whys_data, list):
                 # Format expected: List of dictionaries with why_question and why_answer
@@ -471,8 +883,7 @@ def trigger_action_plan_recommendation(capa_id):
                                 'answer': why_item
                             })
                         else:
-                            print(
-                                f"Warning: WHY item {i} is not a dictionary or string, skipping")
+                            logger.warning("WHY item %s is not a dictionary or string, skipping", i)
             elif isinstance(all_whys_data, dict):
                 # Alternative format: Dictionary with keys like why1, why2, etc.
                 # Map old format to new format
@@ -505,44 +916,54 @@ def trigger_action_plan_recommendation(capa_id):
                         'answer': all_whys_data[key]
                     })
             else:
-                print(
-                    f"Warning: Unexpected WHYs data format for CAPA ID {capa_id}")
+                logger.warning("Unexpected WHYs data format for CAPA ID %s", capa_id)
         else:
-            print(f"Warning: Empty WHYs JSON for CAPA ID {capa_id}")
+            logger.warning("Empty WHYs JSON for CAPA ID %s", capa_id)
 
-    except (json.JSONDecodeError, TypeError, ValueError) as e:
-        print(
-            f"Warning: Could not parse all WHYs JSON for CAPA ID {capa_id}: {e}")
+    except (TypeError, ValueError) as e:
+        logger.warning("Could not parse all WHYs JSON for CAPA ID %s: %s", capa_id, e)
         # Continue with empty list if parsing fails
 
     # Retrieve relevant knowledge from previous RCAs that match machine, issue desc, and 5 whys
-    print(f"\n================ RETRIEVING RELEVANT ACTION PLANS ================\n")
-    print(f"Searching for action plans with:")
-    print(f"- Issue description: {issue.issue_description}")
-    print(f"- Machine name: {issue.machine_name}")
-    print(f"- WHYs JSON: {user_adjusted_whys_json_for_current_capa[:100]}..." if len(
-        user_adjusted_whys_json_for_current_capa or '') > 100 else user_adjusted_whys_json_for_current_capa)
+    logger.info("Retrieving relevant action plans for CAPA ID %s (machine: %s)", capa_id, snapshot.machine_name)
+    logger.debug("Action plan retrieval input - issue: %s, WHYs: %s", snapshot.issue_description,
+                 user_adjusted_whys_json_for_current_capa, extra=PAYLOAD)
 
     relevant_knowledge = get_relevant_action_plan_knowledge(
-        current_capa_issue_description=issue.issue_description,
-        current_capa_machine_name=issue.machine_name,
+        current_capa_issue_description=snapshot.issue_description,
+        current_capa_machine_name=snapshot.machine_name,
         current_capa_user_adjusted_whys_json=user_adjusted_whys_json_for_current_capa,
-        limit=10  # Meningkatkan jumlah maksimum referensi yang diambil
+        limit=10,  # Meningkatkan jumlah maksimum referensi yang diambil
+        # Encoded once per CAPA and stored; the final WHYs are encoded when the RCA is submitted (edit_rca)
+        current_issue_embedding=capa_issue_embedding(issue),
+        current_whys_embedding=capa_whys_embedding(issue, all_whys_data)
     )
-
-    print(f"Found {len(relevant_knowledge)} relevant action plans")
+    _release_db_connection()
+
+    # Repeat issue with the same WHYs: propose the matching closed CAPA's actions without calling the LLM
+    suggestion = (_action_plan_fast_path_suggestion(snapshot, relevant_knowledge)
+                  if refining is None and use_fast_path else None)
+    if suggestion is not None:
+        ai_suggestion_str = suggestion_json(suggestion)
+        if not _store_action_plan_suggestion(snapshot, ai_suggestion_str, None):
+            return False
+        ai_fast_path_total.inc(stage='action_plan')
+        logger.info("Action Plan suggestion for CAPA ID %s copied from closed CAPA ID %s.",
+                    capa_id, suggestion.source_capa_id)
+        _schedule_refinement(trigger_action_plan_recommendation, snapshot, ai_suggestion_str)
+        return True
+
+    # --- Phase 2: build the prompt, call the LLM and parse the answer (no DB access) ---
+
+    logger.info("Found %d relevant action plans", len(relevant_knowledge))
     if not relevant_knowledge:
-        print("WARNING: No relevant action plans found. This may affect the quality of AI recommendations.")
-    else:
+        logger.warning("No relevant action plans found. This may affect the quality of AI recommendations.")
+    elif logger.isEnabledFor(logging.DEBUG):
         for i, knowledge_item in enumerate(relevant_knowledge):
             context = knowledge_item.get('context', {})
-            print(
-                f"Action Plan {i+1} from CAPA ID: {context.get('source_capa_id', 'N/A')}")
-            print(f"- Issue: {context.get('issue_description', 'N/A')}")
-            print(f"- Machine: {context.get('machine_name', 'N/A')}")
-            if 'similarity_score' in context:
-                print(f"- Similarity score: {context.get('similarity_score')}")
-            print("---")
+            logger.debug("Action Plan %d from CAPA ID %s (machine: %s, similarity: %s): %s",
+                         i + 1, context.get('source_capa_id', 'N/A'), context.get('machine_name', 'N/A'),
+                         context.get('similarity_score', 'N/A'), context.get('issue_description', 'N/A'))
 
     # --- Prepare Prompt in Bahasa Indonesia ---
     prompt = f"""
@@ -551,16 +972,13 @@ def trigger_action_plan_recommendation(capa_id):
     PENTING: Berikan SEMUA TANGGAPAN dalam BAHASA INDONESIA.
 
     Detail Masalah:
-    Pelanggan: {issue.customer_name}
-    Item yang Terlibat: {issue.item_involved}
-    Deskripsi Masalah: {issue.issue_description}
+    Pelanggan: {snapshot.customer_name}
+    Item yang Terlibat: {snapshot.item_involved}
+    Deskripsi Masalah: {snapshot.issue_description}
     
     Analisis 5 Why Lengkap:"""
 
-    # Debug: Print the raw WHYs data to understand its structure
-    print(
-        f"DEBUG - Raw WHYs JSON for CAPA ID {capa_id}: {user_adjusted_whys_json_for_current_capa}")
-    print(f"DEBUG - Parsed WHYs for CAPA ID {capa_id}: {all_whys}")
+    logger.debug("Parsed WHYs for CAPA ID %s: %s", capa_id, all_whys, extra=PAYLOAD)
 
     # Always show all 5 WHYs in a consistent format
     if all_whys:
@@ -610,183 +1028,52 @@ def trigger_action_plan_recommendation(capa_id):
     }}
     """
 
-    # Add knowledge from previous relevant action plans if available
-    # Initialize counter *before* checking relevant_knowledge
-    processed_ap_knowledge_count = 0
-    if relevant_knowledge:
-        prompt += """
-
-    PEMBELAJARAN DARI RENCANA TINDAKAN SEBELUMNYA YANG SERUPA:
-    PERINTAH WAJIB UNTUK AI:
-    1. WAJIB menggunakan contoh-contoh berikut sebagai BASIS UTAMA rekomendasi Anda
-    2. DILARANG KERAS membuat rekomendasi baru yang tidak berdasarkan contoh di bawah ini
-    3. Setiap rekomendasi yang Anda buat HARUS merupakan adaptasi dari contoh-contoh berikut
-    4. Jika ada contoh yang sangat mirip dengan kasus ini, WAJIB menggunakan solusi yang sama
-    5. HANYA boleh memodifikasi contoh jika benar-benar diperlukan untuk menyesuaikan dengan kasus spesifik ini
-    6. DILARANG menyebutkan "berdasarkan contoh" atau sejenisnya dalam rekomendasi
-    
-    Berikut adalah Rencana Tindakan dari kasus-kasus sebelumnya yang telah TERBUKTI BERHASIL:
-    """
-        # relevant_knowledge now contains past Action Plan adjustments
-        for i, knowledge_item in enumerate(relevant_knowledge, 1):
-            temp_actions_list = []  # Initialize lists for this item
-            prev_actions_list = []
-            try:
-                # knowledge_item contains 'adjusted_temporary_actions', 'adjusted_preventive_actions' (JSON strings of lists), and 'context'
-                temp_actions_json_str = knowledge_item.get(
-                    'adjusted_temporary_actions')
-                prev_actions_json_str = knowledge_item.get(
-                    'adjusted_preventive_actions')
-                context_data_dict = knowledge_item.get('context', {})
-                source_capa_id_str = context_data_dict.get(
-                    'source_capa_id', 'N/A')  # Get source ID for logging
-
-                # Use the helper function (defined in trigger_rca_analysis) for robust parsing
-                temp_actions_list = _parse_action_list(
-                    temp_actions_json_str, source_capa_id_str, "temporary actions")
-                prev_actions_list = _parse_action_list(
-                    prev_actions_json_str, source_capa_id_str, "preventive actions")
-
-                # Only add to prompt if we successfully parsed something
-                if temp_actions_list or prev_actions_list:
-                    prompt += f"""
-    Contoh Pembelajaran Rencana Tindakan {i} (dari CAPA ID: {source_capa_id_str}):
-    Konteks Masalah Sebelumnya:
-      Deskripsi: {context_data_dict.get('issue_description', 'Tidak tersedia')}
-      Mesin: {context_data_dict.get('machine_name', 'Tidak tersedia')}
-
-    Tindakan Sementara yang telah disesuaikan pengguna sebelumnya:
-    """
-                    if temp_actions_list:
-                        for j, action_text in enumerate(temp_actions_list, 1):
-                            prompt += f"      {j}. {action_text}\n"
-                    else:
-                        prompt += "      (Tidak ada tindakan sementara yang tersimpan)\n"
-
-                    prompt += f"""
-    Tindakan Pencegahan yang telah disesuaikan pengguna sebelumnya:
-    """
-                    if prev_actions_list:
-                        for j, action_text in enumerate(prev_actions_list, 1):
-                            prompt += f"      {j}. {action_text}\n"
-                    else:
-                        # Corrected placeholder
-                        prompt += "      (Tidak ada tindakan pencegahan yang tersimpan)\n"
-                    prompt += "\n"
-                    processed_ap_knowledge_count += 1  # Increment count here
-                else:
-                    # Optional: Log if an item was retrieved but parsing resulted in empty lists for both
-                    print(
-                        f"Info: Skipping knowledge item {i} for Action Plan prompt as parsing yielded no actions.")
-
-            except Exception as e:  # This except catches errors for the whole item processing
-                print(
-                    f"Error processing Action Plan knowledge item {i} for prompt: {e}")
-                continue  # Continue to next knowledge_item
-    # This else corresponds to 'if relevant_knowledge:'
-    else:
-        prompt += """
-    (Tidak ada pembelajaran dari Rencana Tindakan sebelumnya yang cocok ditemukan untuk kasus ini.)
-    """
-    prompt += """
-
-    Perhatikan! Berikan HANYA langkah tindakan untuk setiap item, tanpa indikator keberhasilan, penanggung jawab, atau deadline - itu akan ditambahkan oleh pengguna aplikasi.
-
-    OUTPUT harus merupakan JSON yang valid dan sederhana. Hanya berisi array langkah-langkah tindakan yang perlu dilakukan.
-    Buat 3-4 langkah tindakan sementara dan 2-3 langkah tindakan pencegahan yang spesifik dan relevan dengan masalah tersebut.
-    Pastikan semuanya dalam Bahasa Indonesia, Berikan jawaban yang tegas dan spesifik tanpa keraguan,Hindari penggunaan tanda "/" dalam jawaban, 
-    Pilih satu istilah yang paling tepat, jangan memberikan alternatif.
-    """
-
-    # Log the knowledge enhancement using the count of successfully processed items
-    if processed_ap_knowledge_count > 0:
-        print(
-            f"Enhanced Action Plan prompt with {processed_ap_knowledge_count} relevant knowledge entries.")
+    # Learning examples from previous relevant action plans, within the prompt's token budget
+    snippets = [snippet for snippet in map(_action_plan_knowledge_snippet, relevant_knowledge) if snippet]
+    prompt, used_snippets = assemble_prompt(
+        prompt, ACTION_PLAN_KNOWLEDGE_INTRO, snippets,
+        "Contoh Pembelajaran Rencana Tindakan {number} (dari CAPA ID: {source_capa_id}):",
+        ACTION_PLAN_PROMPT_TAIL, no_knowledge_text=ACTION_PLAN_NO_KNOWLEDGE)
+
+    # Log the knowledge enhancement using the count of examples that made it into the prompt
+    if used_snippets:
+        logger.info("Enhanced Action Plan prompt with %d relevant knowledge entries.", len(used_snippets))
+    elif relevant_knowledge:
+        logger.info("Relevant prior Action Plan knowledge was found, but none could be used in the prompt.")
     else:
-        # Check if relevant_knowledge was initially found but none could be processed
-        if relevant_knowledge:
-            print("Relevant prior Action Plan knowledge was found, but none could be successfully processed for the prompt.")
-        else:
-            print("No relevant prior knowledge found for enhancing Action Plan.")
+        logger.info("No relevant prior knowledge found for enhancing Action Plan.")
 
+    call_log = start_ai_call('action_plan', llm_client.model_name, snapshot)
     try:
-        print("\n================ AI ACTION PLAN DEBUG ================")
-        print(f"[PROMPT SENT to Gemini | CAPA ID {capa_id}]:\n{prompt}\n")
-        response = gemini_model.generate_content(prompt)
-        print(
-            f"[RAW AI RESPONSE]:\n{getattr(response, 'text', str(response))}\n")
-
-        # Attempt to parse JSON
+        logger.debug("Action Plan prompt sent to Gemini for CAPA ID %s:\n%s", capa_id, prompt, extra=PAYLOAD)
+        with span('llm.action_plan'), measure_latency(call_log):
+            response = llm_client.generate_content(prompt, response_schema=_schema(ACTION_PLAN_RESPONSE_SCHEMA),
+                                                   call_log=call_log)
+        record_usage(call_log, response)
+        logger.debug("Raw Action Plan response for CAPA ID %s:\n%s", capa_id,
+                     getattr(response, 'text', response), extra=PAYLOAD)
+
+        # Validate the (schema-constrained) answer, repairing formatting slips locally
         try:
-            ai_suggestion_text = response.text.strip()
-            if ai_suggestion_text.startswith("```json"):
-                ai_suggestion_text = ai_suggestion_text[7:]
-            if ai_suggestion_text.endswith("```"):
-                ai_suggestion_text = ai_suggestion_text[:-3]
-
-            ai_suggestion_json = json.loads(ai_suggestion_text.strip())
-            if not all(k in ai_suggestion_json for k in ["temporary_action", "preventive_action"]):
-                raise ValueError(
-                    "AI response missing expected action plan keys.")
-
-            # Validasi bahwa temporary_action dan preventive_action adalah array
-            temp_actions = ai_suggestion_json["temporary_action"]
-            prev_actions = ai_suggestion_json["preventive_action"]
-
-            if not isinstance(temp_actions, list) or not isinstance(prev_actions, list):
-                # Jika masih dalam string, coba parse lagi
-                if isinstance(temp_actions, str):
-                    try:
-                        temp_actions = json.loads(temp_actions)
-                    except:
-                        temp_actions = [{"langkah": temp_actions}]
-
-                if isinstance(prev_actions, str):
-                    try:
-                        prev_actions = json.loads(prev_actions)
-                    except:
-                        prev_actions = [{"langkah": prev_actions}]
-
-                ai_suggestion_json["temporary_action"] = temp_actions
-                ai_suggestion_json["preventive_action"] = prev_actions
-
-            # Pastikan setiap item memiliki properti langkah
-            for action_list in [temp_actions, prev_actions]:
-                for i, action in enumerate(action_list):
-                    if not isinstance(action, dict):
-                        action_list[i] = {"langkah": str(action)}
-                    elif "langkah" not in action:
-                        action["langkah"] = "Tindakan " + str(i+1)
-
-            ai_suggestion_str = json.dumps(
-                ai_suggestion_json, indent=2, ensure_ascii=False)
-            print(f"[PARSED AI ACTION PLAN | JSON]:\n{ai_suggestion_str}\n")
-
-        except (json.JSONDecodeError, ValueError) as parse_error:
-            print(
-                f"[ERROR] Parsing AI Action Plan response for CAPA ID {capa_id}: {parse_error}")
-            print(
-                f"[FALLBACK RAW AI RESPONSE]:\n{getattr(response, 'text', str(response))}\n")
+            suggestion, call_log.outcome = parse_action_plan_suggestion(response.text)
+            ai_suggestion_str = suggestion_json(suggestion)
+            logger.debug("Parsed Action Plan result (%s) for CAPA ID %s:\n%s",
+                         call_log.outcome, capa_id, ai_suggestion_str, extra=PAYLOAD)
+        except SuggestionParseError as parse_error:
+            logger.error("Parsing AI Action Plan response for CAPA ID %s: %s", capa_id, parse_error)
+            call_log.outcome = 'parse_error'
+            logger.warning("Unparsed Action Plan response for CAPA ID %s:\n%s",
+                           capa_id, getattr(response, 'text', response))
             ai_suggestion_str = f'{{"error": "Failed to parse AI response", "raw_response": {json.dumps(getattr(response, 'text', str(response)))} }}'
 
-        # Store the result
-        existing_ap = ActionPlan.query.filter_by(capa_id=capa_id).first()
-        if existing_ap:
-            existing_ap.ai_suggested_actions_json = ai_suggestion_str
-            # Don't update timestamp here, wait for user submission
-        else:
-            new_ap = ActionPlan(
-                capa_id=capa_id,
-                ai_suggested_actions_json=ai_suggestion_str
-            )
-            db.session.add(new_ap)
-
-        # Don't update issue status here, wait for user submission of action plan details
-        db.session.commit()
-        print(f"AI Action Plan Suggestion stored for CAPA ID {capa_id}.")
+        # --- Phase 3: store the result in a short transaction ---
+        if not _store_action_plan_suggestion(snapshot, ai_suggestion_str, call_log, replaces=refining):
+            return False
+        logger.info("AI Action Plan Suggestion stored for CAPA ID %s.", capa_id)
+        return True
 
     except Exception as e:
-        print(
-            f"Error calling Gemini API for Action Plan (CAPA ID {capa_id}): {e}")
+        logger.error("Error calling Gemini API for Action Plan (CAPA ID %s): %s", capa_id, e)
+        save_failed_call(call_log, e)
         # Re-raise the exception so the calling function flashes a warning
         raise e
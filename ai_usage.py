@@ -0,0 +1,64 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from models import db, AICallLog
+
+logger = logging.getLogger(__name__)
+
+# --- Gemini call accounting ---
+# Every generate_content call gets an AICallLog row with its token usage, latency,
+# retries and outcome, tagged with the CAPA and company. ai_cost_report.py turns
+# these rows into monthly cost projections and latency percentiles.
+
+
+def start_ai_call(call_type, model_name, issue):
+    """Create (but do not add) the log row for a call made on behalf of `issue`."""
+    return AICallLog(
+        call_type=call_type,
+        model_name=model_name,
+        capa_id=issue.capa_id if issue is not None else None,
+        company_id=issue.company_id if issue is not None else None,
+        retries=0,
+        outcome='error'
+    )
+
+
+@contextmanager
+def measure_latency(call_log):
+    """Time the API call itself (not prompt building or parsing) into `call_log.latency_ms`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        call_log.latency_ms = int((time.perf_counter() - start) * 1000)
+
+
+def record_usage(call_log, response):
+    """Copy the token counts from a Gemini response's usage metadata, when present."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    call_log.prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    # Thinking tokens are billed at the output rate
+    output_tokens = (getattr(usage, 'candidates_token_count', 0) or 0) + \
+        (getattr(usage, 'thoughts_token_count', 0) or 0)
+    call_log.output_tokens = output_tokens
+    call_log.total_tokens = getattr(usage, 'total_token_count', None)
+
+
+def save_failed_call(call_log, error):
+    """Persist the log of a call whose request or result handling raised `error`.
+
+    The caller's transaction is rolled back first; failures here are logged, never raised,
+    so accounting cannot hide the original error.
+    """
+    try:
+        db.session.rollback()
+        call_log.outcome = 'error'
+        call_log.error_message = str(error)[:500]
+        db.session.add(call_log)
+        db.session.commit()
+    except Exception as log_error:
+        db.session.rollback()
+        logger.error("Could not save AI call log for CAPA ID %s: %s", call_log.capa_id, log_error)
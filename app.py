@@ -9,8 +9,15 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-from config import SECRET_KEY, SQLALCHEMY_DATABASE_URI, SQLALCHEMY_TRACK_MODIFICATIONS, UPLOAD_FOLDER, MAX_CONTENT_LENGTH
-from models import db, User
+# Configure logging before the app modules are imported so their import-time messages are formatted too
+from logging_config import configure_logging
+configure_logging()
+
+from config import SECRET_KEY, SQLALCHEMY_DATABASE_URI, SQLALCHEMY_ENGINE_OPTIONS, SQLALCHEMY_TRACK_MODIFICATIONS, UPLOAD_FOLDER, MAX_CONTENT_LENGTH
+from models import db
+from caches import load_user_cached, register_cache_invalidation
+from metrics import TimedQueuePool, init_metrics
+from query_inspector import init_query_inspector
 # Removed: from routes import register_routes
 from flask_bootstrap import Bootstrap
 from utils import from_json_filter, nl2br_filter
@@ -35,6 +42,8 @@ mail = Mail() # Initialize without app
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = SQLALCHEMY_TRACK_MODIFICATIONS
+# Pool sizing / recycling from config, with a pool that reports checkout waits to /metrics
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(SQLALCHEMY_ENGINE_OPTIONS, poolclass=TimedQueuePool)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
@@ -48,6 +57,14 @@ app.jinja_env.filters['nl2br'] = nl2br_filter
 # Initialize the database with the app
 db.init_app(app)
 
+# Drop cached lookup data (e.g. the company list) when the underlying rows change
+register_cache_invalidation()
+
+# Request timing, SQL statement counts and the /metrics endpoint
+init_metrics(app)
+# Opt-in N+1 / slow-query detector (QUERY_INSPECTOR_ENABLED)
+init_query_inspector(app)
+
 # Initialize Flask-Migrate
 migrate = Migrate(app, db)
 
@@ -64,7 +81,8 @@ login_manager.login_view = 'login'  # The name of the view to redirect to when l
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from a short-TTL cache so static-like requests (e.g. /uploads) skip the DB
+    return load_user_cached(int(user_id))
 
 # Import and register routes after all core app objects are initialized
 from routes import register_routes
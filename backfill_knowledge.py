@@ -0,0 +1,85 @@
+# Encode and store the description / WHYs embeddings of existing CAPAs and knowledge
+# entries, so retrieval does not encode them on every AI call, and pre-render the
+# knowledge entries' prompt snippets. Rows whose stored embeddings and snippets are up
+# to date are skipped, so the script can be re-run at any time (e.g. after changing the
+# embedding model or bumping PROMPT_SNIPPET_VERSION).
+#
+# Usage: python backfill_knowledge.py [--batch-size 256] [--company-id N]
+
+import argparse
+import os
+import sys
+import time
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+from app import app  # Import your Flask app
+from ai_learning import _extract_text_from_whys_json_str, embed_rows, embedding_model, whys_text
+from ai_service import render_knowledge_entry_snippets
+from models import db, AIKnowledgeBase, CapaIssue
+from prompt_builder import PROMPT_SNIPPET_VERSION
+
+
+def _batches(model, pk_column, company_id, batch_size, *options):
+    """Yield the rows of `model` in primary-key order, `batch_size` at a time."""
+    last_pk = 0
+    while True:
+        query = model.query.options(db.undefer_group('embeddings'), *options).filter(pk_column > last_pk)
+        if company_id is not None:
+            query = query.filter(model.company_id == company_id)
+        rows = query.order_by(pk_column).limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last_pk = getattr(rows[-1], pk_column.key)
+
+
+def _refresh_prompt_snippets(entries):
+    for entry in entries:
+        if (entry.prompt_snippets_json or {}).get('version') != PROMPT_SNIPPET_VERSION:
+            entry.prompt_snippets_json = render_knowledge_entry_snippets(entry)
+
+
+def _backfill(label, batches, issue_texts, whys_texts, refresh=None):
+    start = time.perf_counter()
+    seen = updated = 0
+    for rows in batches:
+        embed_rows(rows, 'issue_embedding', [issue_texts(row) for row in rows], store=True)
+        embed_rows(rows, 'whys_embedding', [whys_texts(row) for row in rows], store=True)
+        if refresh is not None:
+            refresh(rows)
+        seen += len(rows)
+        updated += len(db.session.dirty)
+        db.session.commit()
+        print(f"  {label}: {seen} rows checked, {updated} updated", end='\r')
+    print(f"  {label}: {seen} rows checked, {updated} updated in {time.perf_counter() - start:.1f} s")
+
+
+def backfill(batch_size, company_id):
+    if embedding_model is None:
+        print("The embedding model could not be loaded; nothing to do.")
+        return False
+    with app.app_context():
+        _backfill('CAPA issues',
+                  _batches(CapaIssue, CapaIssue.capa_id, company_id, batch_size,
+                           db.joinedload(CapaIssue.root_cause)),
+                  lambda issue: issue.issue_description,
+                  lambda issue: whys_text(issue.root_cause.user_adjusted_whys_json) if issue.root_cause else '')
+        _backfill('knowledge entries',
+                  _batches(AIKnowledgeBase, AIKnowledgeBase.knowledge_id, company_id, batch_size),
+                  lambda entry: entry.issue_description,
+                  lambda entry: _extract_text_from_whys_json_str(entry.adjusted_whys_json),
+                  _refresh_prompt_snippets)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Store missing or outdated embeddings and prompt snippets of CAPAs and knowledge entries.")
+    parser.add_argument('--batch-size', type=int, default=256, help="Rows encoded per model call (default: 256)")
+    parser.add_argument('--company-id', type=int, default=None, help="Only backfill this company")
+    args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error("--batch-size must be positive")
+    sys.exit(0 if backfill(args.batch_size, args.company_id) else 1)
@@ -0,0 +1,381 @@
+# Retrieval micro-benchmark for get_relevant_rca_knowledge and
+# get_relevant_action_plan_knowledge.
+#
+# Seeds ai_knowledge_base with synthetic entries (several companies, machines and defect
+# types, growing to each requested size), then runs a fixed set of synthetic queries and
+# measures, per size and function:
+#   - latency (mean / p50 / p95 / max) of the real retrieval function,
+#   - peak Python memory allocated during one call (tracemalloc) and process max RSS,
+#   - recall@k against a brute-force baseline that ranks every candidate the function
+#     is allowed to see by exact cosine similarity (RCA: issue description; action
+#     plans: mean of issue-description and 5-Whys similarity).
+#
+# All synthetic rows are written inside one transaction that is rolled back at the end,
+# so nothing is committed. Use a development database anyway: with the real embedding
+# model the 100k size encodes every candidate on every query and takes a long time.
+#
+# Usage: python benchmark_retrieval.py [--sizes 1000 10000 100000] [--queries 20] [--k 5]
+#                                      [--output retrieval_benchmark.json] [--compare PREVIOUS.json]
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime
+
+import numpy as np
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+from app import app  # Import your Flask app
+import ai_learning
+from models import db, AIKnowledgeBase, CapaIssue, Company
+from stats import percentile
+
+COMPANY_CODE_PREFIX = 'BENCH-'
+COMPANIES = 3
+MACHINES = ['Flexo 1', 'Flexo 2', 'Die Cut 1', 'Die Cut 2', 'Folder Gluer 1',
+            'Folder Gluer 2', 'Laminating 1', 'Corrugator']
+ITEMS = ['Box 24x18', 'Carton RSC 40x30', 'Sleeve 12oz', 'Tray 6 pack', 'Display stand']
+INSERT_CHUNK = 5000
+
+# Each defect type has several phrasings: entries use some, queries use the others,
+# so queries are paraphrases rather than copies of stored descriptions.
+DEFECTS = [
+    {
+        'phrasings': ['Lem tidak menempel sempurna pada flap box', 'Flap box terbuka karena lem kurang kuat',
+                      'Glue flap lepas setelah proses lipat', 'Daya rekat lem pada flap rendah'],
+        'whys': ['Lem tidak merekat', 'Jumlah lem kurang', 'Nozzle lem tersumbat',
+                 'Nozzle tidak dibersihkan', 'Belum ada jadwal pembersihan nozzle'],
+        'temporary': ['Sortir ulang box dengan flap terbuka'],
+        'preventive': ['Buat jadwal pembersihan nozzle lem tiap shift'],
+    },
+    {
+        'phrasings': ['Warna cetakan tidak sesuai standar pelanggan', 'Shade warna berbeda dari approval sample',
+                      'Hasil print terlalu pucat dibanding standar', 'Delta E warna di luar toleransi'],
+        'whys': ['Warna tidak sesuai', 'Viskositas tinta berubah', 'Tinta tidak dicek saat start',
+                 'Tidak ada alat ukur viskositas di mesin', 'Standar cek tinta belum ada'],
+        'temporary': ['Hold dan cek warna semua pallet terdampak'],
+        'preventive': ['Cek viskositas tinta tiap awal job'],
+    },
+    {
+        'phrasings': ['Ukuran die cut tidak presisi, lipatan miring', 'Hasil potong die cut bergeser dari garis',
+                      'Creasing tidak lurus sehingga box miring', 'Dimensi potongan melebihi toleransi'],
+        'whys': ['Potongan bergeser', 'Register kertas tidak stabil', 'Feeder slip',
+                 'Karet feeder aus', 'Penggantian karet feeder tidak terjadwal'],
+        'temporary': ['Ukur ulang sampel tiap 500 lembar'],
+        'preventive': ['Masukkan karet feeder ke jadwal preventive maintenance'],
+    },
+    {
+        'phrasings': ['Terdapat goresan pada permukaan laminasi', 'Laminasi tergores saat keluar mesin',
+                      'Scratch di permukaan film laminasi', 'Permukaan glossy ada baret'],
+        'whys': ['Film tergores', 'Ada benda asing di roller', 'Roller kotor',
+                 'Roller tidak dibersihkan saat ganti job', 'Checklist pergantian job tidak lengkap'],
+        'temporary': ['Sortir lembar laminasi yang tergores'],
+        'preventive': ['Tambahkan pembersihan roller pada checklist ganti job'],
+    },
+    {
+        'phrasings': ['Box penyok saat proses stacking di gudang', 'Tumpukan box ambruk di gudang',
+                      'Box rusak tertekan saat penyimpanan', 'Kekuatan tumpuk box kurang'],
+        'whys': ['Box penyok', 'Tumpukan terlalu tinggi', 'Batas tumpukan tidak diketahui',
+                 'Tidak ada label batas tumpukan', 'Standar penyimpanan belum dibuat'],
+        'temporary': ['Turunkan tinggi tumpukan box di gudang'],
+        'preventive': ['Pasang label batas tumpukan pada pallet'],
+    },
+    {
+        'phrasings': ['Kertas bergelombang setelah proses corrugating', 'Warp pada lembaran karton',
+                      'Lembar karton melengkung tidak rata', 'Board melengkung keluar dari corrugator'],
+        'whys': ['Board melengkung', 'Kadar air kertas tidak seimbang', 'Preheater tidak stabil',
+                 'Sensor suhu preheater rusak', 'Kalibrasi sensor tidak dilakukan'],
+        'temporary': ['Press ulang board yang melengkung'],
+        'preventive': ['Kalibrasi sensor suhu preheater tiap bulan'],
+    },
+    {
+        'phrasings': ['Cetakan double image pada hasil print', 'Gambar cetak berbayang',
+                      'Ghosting pada area solid', 'Hasil cetak terlihat dobel'],
+        'whys': ['Gambar berbayang', 'Plate bergeser', 'Tekanan plate tidak rata',
+                 'Tape plate sudah aus', 'Tidak ada standar penggantian tape'],
+        'temporary': ['Ganti tape plate dan cek hasil cetak'],
+        'preventive': ['Tetapkan umur pakai tape plate'],
+    },
+    {
+        'phrasings': ['Jumlah box dalam bundle kurang dari standar', 'Isi bundle tidak sesuai jumlah',
+                      'Counting box per bundle salah', 'Bundle kurang isi saat dicek pelanggan'],
+        'whys': ['Isi bundle kurang', 'Counter mesin salah hitung', 'Sensor counter kotor',
+                 'Sensor tidak masuk checklist', 'Checklist harian belum lengkap'],
+        'temporary': ['Hitung ulang isi semua bundle di gudang'],
+        'preventive': ['Tambahkan pembersihan sensor counter ke checklist harian'],
+    },
+]
+ENTRY_PHRASINGS = 2  # Phrasings 0-1 are stored, 2-3 are used for queries
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- Synthetic data ---
+
+def create_bench_companies():
+    """One company and one placeholder CAPA per synthetic company (knowledge rows need a capa_id)."""
+    capas = []
+    for index in range(1, COMPANIES + 1):
+        company = Company(company_code=f"{COMPANY_CODE_PREFIX}{index}", name=f"Benchmark Company {index}")
+        db.session.add(company)
+        db.session.flush()
+        capa = CapaIssue(customer_name='Benchmark', issue_date=date.today(), item_involved='Benchmark',
+                         issue_description='Benchmark placeholder', status='Closed', company_id=company.id)
+        db.session.add(capa)
+        db.session.flush()
+        capas.append(capa)
+    return capas
+
+
+def synthetic_rows(start, stop, capas, rng):
+    """Knowledge rows with unique descriptions, stored the way store_knowledge_on_capa_close stores them."""
+    rows = []
+    for number in range(start, stop):
+        defect = rng.choice(DEFECTS)
+        capa = capas[number % len(capas)]
+        phrasing = defect['phrasings'][rng.randrange(ENTRY_PHRASINGS)]
+        rows.append({
+            'capa_id': capa.capa_id,
+            'company_id': capa.company_id,
+            'machine_name': rng.choice(MACHINES),
+            'issue_description': f"{phrasing} pada {rng.choice(ITEMS)}, batch B{number:06d}",
+            'adjusted_whys_json': json.dumps(defect['whys']),
+            'adjusted_temporary_actions_json': json.dumps(defect['temporary']),
+            'adjusted_preventive_actions_json': json.dumps(defect['preventive']),
+            'created_at': datetime.utcnow(),
+            'is_active': True,
+        })
+    return rows
+
+
+def grow_knowledge_base(current_size, target_size, capas, rng):
+    for start in range(current_size, target_size, INSERT_CHUNK):
+        db.session.execute(db.insert(AIKnowledgeBase),
+                           synthetic_rows(start, min(start + INSERT_CHUNK, target_size), capas, rng))
+    db.session.flush()
+
+
+def synthetic_queries(count, rng):
+    queries = []
+    for _ in range(count):
+        defect = rng.choice(DEFECTS)
+        queries.append({
+            'issue_description': f"{rng.choice(defect['phrasings'][ENTRY_PHRASINGS:])} pada {rng.choice(ITEMS)}",
+            'machine_name': rng.choice(MACHINES),
+            'whys': defect['whys'],
+        })
+    return queries
+
+
+# --- Brute-force baseline ---
+
+class BaselineEncoder:
+    """Embeddings for the baseline, cached by text so each text is encoded once per run."""
+
+    def __init__(self, model):
+        self.model = model
+        self.cache = {}
+
+    def encode(self, texts):
+        missing = list({text for text in texts if text not in self.cache})
+        for start in range(0, len(missing), 1024):
+            batch = missing[start:start + 1024]
+            for text, vector in zip(batch, self.model.encode(batch, convert_to_tensor=False)):
+                self.cache[text] = vector / (np.linalg.norm(vector) or 1.0)
+        return np.array([self.cache[text] for text in texts])
+
+
+def whys_text(whys_json):
+    return ' '.join(json.loads(whys_json)) if whys_json else ''
+
+
+def baseline_rca(encoder, query, k):
+    """Top-k candidates of get_relevant_rca_knowledge by exact issue-description similarity."""
+    entries = AIKnowledgeBase.query.filter_by(is_active=True, machine_name=query['machine_name']).filter(
+        db.func.length(db.func.replace(AIKnowledgeBase.adjusted_whys_json, ' ', '')) >= 10).all()
+    if not entries:
+        return []
+    issue_scores = encoder.encode([e.issue_description for e in entries]) @ \
+        encoder.encode([query['issue_description']])[0]
+    return [entries[i].issue_description for i in np.argsort(-issue_scores)[:k]]
+
+
+def baseline_action_plan(encoder, query, k):
+    """Top-k candidates of get_relevant_action_plan_knowledge by exact mean issue and 5-Whys similarity."""
+    entries = AIKnowledgeBase.query.filter_by(machine_name=query['machine_name']).filter(
+        (AIKnowledgeBase.adjusted_temporary_actions_json != None) |
+        (AIKnowledgeBase.adjusted_preventive_actions_json != None)
+    ).all()
+    if not entries:
+        return []
+    issue_scores = encoder.encode([e.issue_description for e in entries]) @ \
+        encoder.encode([query['issue_description']])[0]
+    whys_scores = encoder.encode([whys_text(e.adjusted_whys_json) for e in entries]) @ \
+        encoder.encode([' '.join(query['whys'])])[0]
+    scores = (issue_scores + whys_scores) / 2
+    return [entries[i].issue_description for i in np.argsort(-scores)[:k]]
+
+
+# --- Measurement ---
+
+FUNCTIONS = {
+    'get_relevant_rca_knowledge': (
+        lambda query, k: ai_learning.get_relevant_rca_knowledge(
+            query['issue_description'], query['machine_name'], limit=k),
+        baseline_rca,
+    ),
+    'get_relevant_action_plan_knowledge': (
+        lambda query, k: ai_learning.get_relevant_action_plan_knowledge(
+            query['issue_description'], query['machine_name'], json.dumps(query['whys']), limit=k),
+        baseline_action_plan,
+    ),
+}
+
+
+def benchmark_function(name, queries, k, encoder):
+    retrieve, baseline = FUNCTIONS[name]
+    retrieve(queries[0], k)  # Warm-up (model and query caches)
+
+    latencies = []
+    recalls = []
+    empty_results = 0
+    for query in queries:
+        start = time.perf_counter()
+        results = retrieve(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        expected = baseline(encoder, query, k)
+        retrieved = {result['context']['issue_description'] for result in results}
+        if not results:
+            empty_results += 1
+        if expected:
+            recalls.append(len(retrieved & set(expected)) / len(expected))
+
+    # Peak memory is measured on a separate call: tracemalloc slows the timed runs down
+    tracemalloc.start()
+    retrieve(queries[0], k)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 2),
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'max': round(latencies[-1], 2),
+        },
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+        'recall_at_k': round(sum(recalls) / len(recalls), 4) if recalls else None,
+        'empty_results': empty_results,
+    }
+
+
+def run_benchmark(sizes, query_count, k, seed):
+    rng = random.Random(seed)
+    queries = synthetic_queries(query_count, rng)
+    report = {
+        'benchmark': 'retrieval',
+        'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'git_commit': git_commit(),
+        'embedding_model': ai_learning.embedding_model_name,
+        'python': platform.python_version(),
+        'k': k,
+        'queries': query_count,
+        'seed': seed,
+        'results': [],
+    }
+    encoder = BaselineEncoder(ai_learning.embedding_model)
+
+    with app.app_context():
+        try:
+            existing = AIKnowledgeBase.query.count()
+            capas = create_bench_companies()
+            current_size = 0
+            for size in sorted(sizes):
+                grow_knowledge_base(current_size, size, capas, rng)
+                current_size = size
+                for name in FUNCTIONS:
+                    print(f"Benchmarking {name} with {size:,} synthetic entries ({existing:,} existing)...")
+                    result = benchmark_function(name, queries, k, encoder)
+                    result.update({
+                        'size': size,
+                        'function': name,
+                        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                    })
+                    report['results'].append(result)
+        finally:
+            db.session.rollback()  # Nothing synthetic is ever committed
+    return report
+
+
+def print_report(report, previous=None):
+    previous_results = {(r['function'], r['size']): r for r in (previous or {}).get('results', [])}
+    print()
+    print(f"Retrieval benchmark @ {report['git_commit'] or 'unknown commit'}: "
+          f"{report['queries']} queries, recall@{report['k']} vs brute-force baseline")
+    if previous:
+        print(f"Compared with {previous.get('git_commit') or 'unknown commit'} ({previous.get('created_at')})")
+    header = (f"{'function':<36} {'size':>8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'peak MB':>8} {'recall':>7} {'empty':>6}")
+    print(header)
+    print('-' * len(header))
+    for result in report['results']:
+        recall = f"{result['recall_at_k']:.3f}" if result['recall_at_k'] is not None else '-'
+        print(f"{result['function']:<36} {result['size']:>8,} {result['latency_ms']['mean']:>9} "
+              f"{result['latency_ms']['p50']:>9} {result['latency_ms']['p95']:>9} "
+              f"{result['peak_memory_mb']:>8} {recall:>7} {result['empty_results']:>6}")
+        before = previous_results.get((result['function'], result['size']))
+        if before:
+            p50_change = (result['latency_ms']['p50'] / before['latency_ms']['p50'] - 1) * 100 \
+                if before['latency_ms']['p50'] else 0.0
+            recall_change = (result['recall_at_k'] or 0) - (before['recall_at_k'] or 0)
+            print(f"{'  vs previous':<36} {'':>8} {'':>9} {p50_change:>+8.1f}% {'':>9} "
+                  f"{result['peak_memory_mb'] - before['peak_memory_mb']:>+8.2f} {recall_change:>+7.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark knowledge-base retrieval on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Knowledge base sizes to benchmark (default: 1000 10000 100000)")
+    parser.add_argument('--queries', type=int, default=20, help="Queries per size and function (default: 20)")
+    parser.add_argument('--k', type=int, default=5, help="Results per query, and k for recall@k (default: 5)")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed for the synthetic data")
+    parser.add_argument('--output', default='retrieval_benchmark.json', help="Where to write the JSON results")
+    parser.add_argument('--compare', help="Previous results file to compare against")
+    args = parser.parse_args()
+    if args.queries <= 0 or args.k <= 0 or any(size <= 0 for size in args.sizes):
+        parser.error("--sizes, --queries and --k must be positive")
+    if ai_learning.embedding_model is None:
+        parser.error("The embedding model could not be loaded; see the log above")
+
+    # The retrieval functions log every call at INFO level
+    logging.getLogger('ai_learning').setLevel(logging.WARNING)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    report = run_benchmark(args.sizes, args.queries, args.k, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print_report(report, previous)
+    print(f"\nResults written to {args.output}")
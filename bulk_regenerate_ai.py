@@ -0,0 +1,272 @@
+# Re-generate the AI suggestions of many CAPAs at once (ai_suggested_rc_json and / or
+# ai_suggested_actions_json), e.g. after a prompt or model change.
+#
+# The selected CAPAs are processed in batches. The knowledge retrieval of a batch runs at
+# once (embeddings encoded in one model call, knowledge entries loaded once per machine),
+# then its LLM calls run concurrently as bulk jobs of the AI scheduler, so interactive
+# requests are not delayed, started at most --rate per minute. The repeat-issue fast path
+# is skipped, so every CAPA gets a fresh LLM suggestion and --rate covers every LLM call
+# the command makes. Progress is saved to
+# --state-file after every CAPA: started again with the same selection, an interrupted run
+# skips the CAPAs already done and retries the failed ones.
+#
+# Usage: python bulk_regenerate_ai.py [--stage rca|action_plan|both] [--company-id N]
+#                                     [--status STATUS ...] [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+#                                     [--batch-size 50] [--concurrency 4] [--rate 30]
+#                                     [--state-file bulk_regenerate_ai.state.json] [--restart] [--dry-run]
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import date, datetime
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+from app import app  # Import your Flask app
+from ai_learning import embed_rows, prefetch_rca_knowledge_batch, whys_text
+from ai_scheduler import BULK, scheduler
+from ai_service import llm_client, trigger_action_plan_recommendation, trigger_rca_analysis
+from config import LLM_MAX_IN_FLIGHT, LLM_MAX_IN_FLIGHT_PER_COMPANY
+from models import db, AICallLog, CapaIssue, GembaInvestigation, RootCause
+
+STAGES = ('rca', 'action_plan')
+TRIGGERS = {'rca': trigger_rca_analysis, 'action_plan': trigger_action_plan_recommendation}
+REPORT_INTERVAL_SECONDS = 10
+
+
+class RateLimiter:
+    """Spaces calls at least 60 / `per_minute` seconds apart (no limit for 0)."""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+
+class RunState:
+    """CAPAs done per stage, kept in a JSON file so an interrupted run can resume."""
+
+    def __init__(self, path, selection, restart):
+        self.path = path
+        self.selection = selection
+        self.done = {stage: set() for stage in STAGES}
+        if restart or not os.path.exists(path):
+            return
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('selection') != selection:
+            raise SystemExit(f"{path} belongs to another selection ({saved.get('selection')}); "
+                             f"use another --state-file, or --restart to discard it.")
+        for stage in STAGES:
+            self.done[stage] = set(saved.get('done', {}).get(stage, []))
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'selection': self.selection,
+                       'done': {stage: sorted(capa_ids) for stage, capa_ids in self.done.items()},
+                       'updated_at': datetime.utcnow().isoformat()}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Progress:
+    def __init__(self, stage, total):
+        self.stage = stage
+        self.total = total
+        self.stored = self.skipped = self.failed = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+
+    @property
+    def finished(self):
+        return self.stored + self.skipped + self.failed
+
+    def line(self):
+        elapsed = time.monotonic() - self.start
+        per_minute = self.finished / elapsed * 60 if elapsed > 0 else 0.0
+        eta = f"{(self.total - self.finished) / per_minute:.1f} min" if per_minute > 0 else '-'
+        return (f"  {self.stage}: {self.finished}/{self.total} ({self.stored} stored, {self.skipped} skipped, "
+                f"{self.failed} failed) in {elapsed:.0f} s, {per_minute:.1f} CAPA/min, ETA {eta}")
+
+    def report_if_due(self):
+        if time.monotonic() - self._last_report >= REPORT_INTERVAL_SECONDS:
+            self._last_report = time.monotonic()
+            print(self.line())
+
+
+def select_capa_ids(stage, company_id, statuses, since, until):
+    query = db.session.query(CapaIssue.capa_id).filter(CapaIssue.is_deleted.is_(False))
+    if stage == 'rca':
+        # The RCA prompt needs the Gemba findings
+        query = query.join(GembaInvestigation, GembaInvestigation.capa_id == CapaIssue.capa_id)
+    else:
+        # The action plan is built on the user-adjusted root cause
+        query = query.join(RootCause, RootCause.capa_id == CapaIssue.capa_id) \
+            .filter(RootCause.user_adjusted_root_cause.isnot(None), RootCause.user_adjusted_root_cause != '')
+    if company_id is not None:
+        query = query.filter(CapaIssue.company_id == company_id)
+    if statuses:
+        query = query.filter(CapaIssue.status.in_(statuses))
+    else:
+        query = query.filter(CapaIssue.status != 'Closed')
+    if since is not None:
+        query = query.filter(CapaIssue.issue_date >= since)
+    if until is not None:
+        query = query.filter(CapaIssue.issue_date <= until)
+    return [capa_id for (capa_id,) in query.distinct().order_by(CapaIssue.capa_id).all()]
+
+
+def prepare_batch(stage, capa_ids):
+    """Run the knowledge retrieval of a batch of CAPAs at once; returns the CAPAs."""
+    options = [db.undefer_group('embeddings')]
+    if stage == 'action_plan':
+        options.append(db.joinedload(CapaIssue.root_cause))
+    issues = CapaIssue.query.options(*options).filter(CapaIssue.capa_id.in_(capa_ids)) \
+        .order_by(CapaIssue.capa_id).all()
+    if stage == 'rca':
+        prefetch_rca_knowledge_batch(issues)
+    else:
+        # Stored on the CAPAs, so each job's retrieval only scores the knowledge entries
+        embed_rows(issues, 'issue_embedding', [issue.issue_description for issue in issues], store=True)
+        embed_rows(issues, 'whys_embedding', [whys_text(issue.root_cause.user_adjusted_whys_json or [])
+                                              for issue in issues], store=True)
+    db.session.commit()
+    return issues
+
+
+def collect(in_flight, progress, state, timeout=None):
+    """Record the outcome of the jobs finished within `timeout`."""
+    finished, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in finished:
+        capa_id = in_flight.pop(future)
+        try:
+            stored = future.result()
+        except Exception as e:
+            progress.failed += 1
+            print(f"  {progress.stage}: CAPA ID {capa_id} failed: {e}")
+            continue
+        if stored:
+            progress.stored += 1
+        else:
+            # Not applicable any more or changed meanwhile; re-running would not help
+            progress.skipped += 1
+        state.done[progress.stage].add(capa_id)
+    if finished:
+        state.save()
+    progress.report_if_due()
+
+
+def usage_summary(stage, capa_ids, since):
+    logs = AICallLog.query.filter(AICallLog.call_type == stage, AICallLog.created_at >= since,
+                                  AICallLog.capa_id.in_(capa_ids)).all() if capa_ids else []
+    latencies = [log.latency_ms for log in logs if log.latency_ms is not None]
+    average = f"{sum(latencies) / len(latencies):,.0f} ms" if latencies else '-'
+    return (f"  {stage}: {len(logs)} LLM calls, {sum(log.retries or 0 for log in logs)} retries, "
+            f"{sum(log.prompt_tokens or 0 for log in logs):,} prompt / {sum(log.output_tokens or 0 for log in logs):,} "
+            f"output tokens, average latency {average}")
+
+
+def run_stage(stage, capa_ids, state, args):
+    pending = [capa_id for capa_id in capa_ids if capa_id not in state.done[stage]]
+    print(f"{stage}: {len(capa_ids)} CAPAs selected, {len(capa_ids) - len(pending)} already done, "
+          f"{len(pending)} to go")
+    if not pending:
+        return True
+    started_at = datetime.utcnow()
+    progress = Progress(stage, len(pending))
+    limiter = RateLimiter(args.rate)
+    in_flight = {}  # Future -> capa_id
+    try:
+        for offset in range(0, len(pending), args.batch_size):
+            for issue in prepare_batch(stage, pending[offset:offset + args.batch_size]):
+                while len(in_flight) >= args.concurrency:
+                    collect(in_flight, progress, state, timeout=REPORT_INTERVAL_SECONDS)
+                limiter.wait()
+                future = TRIGGERS[stage](issue.capa_id, priority=BULK, company_id=issue.company_id, wait=False,
+                                         use_fast_path=False)
+                in_flight[future] = issue.capa_id
+        while in_flight:
+            collect(in_flight, progress, state, timeout=REPORT_INTERVAL_SECONDS)
+    except KeyboardInterrupt:
+        db.session.rollback()
+        print(f"\nInterrupted: cancelled {scheduler.cancel_queued()} queued jobs; "
+              f"waiting for the running ones (Ctrl-C again to abort)...")
+        for future in [future for future in in_flight if future.cancelled()]:
+            in_flight.pop(future)
+        while in_flight:
+            collect(in_flight, progress, state)
+        print(progress.line())
+        print(f"Progress saved to {state.path}; run the same command again to continue.")
+        return False
+    print(progress.line())
+    print(usage_summary(stage, pending, started_at))
+    return True
+
+
+def parse_date(value):
+    return date.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-generate the AI RCA / action-plan suggestions of many CAPAs.")
+    parser.add_argument('--stage', choices=STAGES + ('both',), default='both', help="Suggestions to re-generate (default: both).")
+    parser.add_argument('--company-id', type=int, default=None, help="Only CAPAs of this company.")
+    parser.add_argument('--status', action='append', default=None,
+                        help="Only CAPAs with this status; repeatable (default: every status except Closed).")
+    parser.add_argument('--since', type=parse_date, default=None, help="Only CAPAs with issue_date on or after this date.")
+    parser.add_argument('--until', type=parse_date, default=None, help="Only CAPAs with issue_date on or before this date.")
+    parser.add_argument('--batch-size', type=int, default=50, help="CAPAs whose retrieval runs at once (default: 50).")
+    parser.add_argument('--concurrency', type=int, default=4, help="LLM calls in flight (default: 4).")
+    parser.add_argument('--rate', type=float, default=30, help="LLM calls started per minute at most; 0 for no limit (default: 30).")
+    parser.add_argument('--state-file', default='bulk_regenerate_ai.state.json',
+                        help="Progress file used to resume an interrupted run.")
+    parser.add_argument('--restart', action='store_true', help="Ignore the progress saved in --state-file.")
+    parser.add_argument('--dry-run', action='store_true', help="Only show how many CAPAs would be processed.")
+    args = parser.parse_args()
+
+    # The LLM client queues calls beyond its limits; more jobs in flight would only wait there
+    max_concurrency = LLM_MAX_IN_FLIGHT if args.company_id is None else min(LLM_MAX_IN_FLIGHT, LLM_MAX_IN_FLIGHT_PER_COMPANY)
+    if args.concurrency > max_concurrency:
+        print(f"--concurrency lowered to {max_concurrency} (LLM_MAX_IN_FLIGHT / LLM_MAX_IN_FLIGHT_PER_COMPANY).")
+        args.concurrency = max_concurrency
+    args.concurrency = max(1, args.concurrency)
+    # No interactive requests in this process: the bulk jobs may use every scheduler worker
+    scheduler.workers = scheduler.max_other_running = args.concurrency
+
+    stages = STAGES if args.stage == 'both' else (args.stage,)
+    selection = {'company_id': args.company_id, 'statuses': sorted(args.status or []),
+                 'since': args.since.isoformat() if args.since else None,
+                 'until': args.until.isoformat() if args.until else None}
+    with app.app_context():
+        if not llm_client.is_available:
+            print("The LLM is not available (GOOGLE_API_KEY not configured); nothing to do.")
+            return 1
+        capa_ids = {stage: select_capa_ids(stage, args.company_id, args.status, args.since, args.until)
+                    for stage in stages}
+        if args.dry_run:
+            for stage in stages:
+                preview = ', '.join(str(capa_id) for capa_id in capa_ids[stage][:20])
+                more = ', ...' if len(capa_ids[stage]) > 20 else ''
+                print(f"{stage}: {len(capa_ids[stage])} CAPAs ({preview}{more})")
+            return 0
+
+        state = RunState(args.state_file, selection, args.restart)
+        for stage in stages:
+            if not run_stage(stage, capa_ids[stage], state, args):
+                return 130
+    print(f"Done; progress kept in {args.state_file} (delete it, or use --restart, to process everything again).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+import bisect
+import threading
+import uuid
+from collections import namedtuple
+
+from cachetools import TTLCache
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from config import (
+    AUTOCOMPLETE_CACHE_TTL_SECONDS,
+    COMPANY_CACHE_TTL_SECONDS,
+    USER_CACHE_MAX_ENTRIES,
+    USER_CACHE_TTL_SECONDS
+)
+
+# --- Commit-aware invalidation ---
+# Model events fire during flush, before the data is visible to other connections.
+# Invalidating at that point lets a concurrent request re-cache the old rows, so
+# callbacks are parked on the session and only run once the transaction commits.
+
+
+def invalidate_on_commit(session, callback):
+    """Run `callback` after `session` commits (or immediately if there is no session)."""
+    if session is None:
+        callback()
+        return
+    session.info.setdefault('cache_invalidations', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_pending_invalidations(session):
+    callbacks = session.info.pop('cache_invalidations', [])
+    for callback in callbacks:
+        callback()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_invalidations(session):
+    session.info.pop('cache_invalidations', None)
+
+
+# --- Company list cache ---
+# Companies change rarely but are needed on every rendered page (company selector)
+# and in most routes for company scoping. Keep a process-wide snapshot as plain
+# tuples so it can be shared safely between request threads and sessions.
+
+CompanyRef = namedtuple('CompanyRef', ['id', 'company_code', 'name'])
+
+_company_cache = TTLCache(maxsize=1, ttl=COMPANY_CACHE_TTL_SECONDS)
+_company_cache_lock = threading.Lock()
+
+
+def _load_companies():
+    from models import Company  # Import here to avoid circular imports
+    rows = Company.query.with_entities(
+        Company.id, Company.company_code, Company.name).order_by(Company.name).all()
+    companies = [CompanyRef(*row) for row in rows]
+    return {
+        'list': companies,
+        'by_id': {company.id: company for company in companies}
+    }
+
+
+def _get_company_snapshot():
+    with _company_cache_lock:
+        snapshot = _company_cache.get('companies')
+    if snapshot is None:
+        snapshot = _load_companies()
+        with _company_cache_lock:
+            _company_cache['companies'] = snapshot
+    return snapshot
+
+
+def get_companies():
+    """Return all companies ordered by name (cached process-wide)."""
+    return _get_company_snapshot()['list']
+
+
+def get_company(company_id):
+    """Return the cached CompanyRef for `company_id`, or None if it does not exist."""
+    if company_id is None:
+        return None
+    try:
+        company_id = int(company_id)
+    except (TypeError, ValueError):
+        return None
+    return _get_company_snapshot()['by_id'].get(company_id)
+
+
+def invalidate_companies():
+    with _company_cache_lock:
+        _company_cache.clear()
+
+
+# --- Logged-in user cache ---
+# Flask-Login reloads the user on every authenticated request, including each image
+# served from /uploads. Keep the user's column values for a short time and rebuild a
+# session-attached User from them, so no SELECT is needed while the entry is fresh.
+
+_user_cache = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+_user_cache_lock = threading.Lock()
+
+
+def load_user_cached(user_id):
+    """Return the User for `user_id`, using the short-lived cache when possible."""
+    from models import db, User  # Import here to avoid circular imports
+    with _user_cache_lock:
+        values = _user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            values = {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+            with _user_cache_lock:
+                _user_cache[user_id] = values
+        return user
+
+    # Rebuild a detached instance with the cached state and attach it without a round-trip
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+# --- Autocomplete value indexes ---
+# The machine/customer name fields call the autocomplete APIs on every keystroke.
+# Each index keeps the distinct values of one column per company (key None = all
+# companies) as a case-insensitively sorted list, so prefix lookups are a bisect.
+# New values are added as CAPA/knowledge rows are committed; the TTL rebuild drops
+# values that no longer exist and picks up writes made by other processes.
+
+
+class SortedValues:
+    """A case-insensitively sorted list of distinct strings with a version tag.
+
+    Readers never lock: `add` builds new lists and swaps them in with a single assignment.
+    """
+
+    def __init__(self, values):
+        pairs = sorted({(value.lower(), value) for value in values if value})
+        self._data = ([key for key, _ in pairs], [value for _, value in pairs])
+        self._load_id = uuid.uuid4().hex[:12]
+        self.revision = 0
+
+    @property
+    def values(self):
+        return self._data[1]
+
+    @property
+    def version(self):
+        return f"{self._load_id}-{self.revision}"
+
+    def add(self, value):
+        """Insert `value` if missing (callers serialise writes); returns True when the list changed."""
+        keys, values = self._data
+        key = value.lower()
+        index = bisect.bisect_left(keys, key)
+        while index < len(keys) and keys[index] == key:
+            if values[index] == value:
+                return False
+            index += 1
+        self._data = (keys[:index] + [key] + keys[index:], values[:index] + [value] + values[index:])
+        self.revision += 1
+        return True
+
+    def with_prefix(self, prefix, limit=None):
+        """Values starting with `prefix` (case-insensitive), in sorted order.
+
+        `limit` (None = no limit) returns at most that many values, and at least one.
+        """
+        keys, values = self._data
+        if limit is not None:
+            limit = max(1, limit)
+        if not prefix:
+            return values[:limit]
+        key = prefix.lower()
+        start = bisect.bisect_left(keys, key)
+        matches = []
+        for index in range(start, len(keys)):
+            if not keys[index].startswith(key):
+                break
+            matches.append(values[index])
+            if limit is not None and len(matches) >= limit:
+                break
+        return matches
+
+
+class DistinctValueIndex:
+    """Per-company cache of `SELECT DISTINCT <column>` for one model column."""
+
+    def __init__(self, model_name, column_name):
+        self.model_name = model_name
+        self.column_name = column_name
+        self._entries = TTLCache(maxsize=256, ttl=AUTOCOMPLETE_CACHE_TTL_SECONDS)
+        self._lock = threading.Lock()
+
+    def _load(self, company_id):
+        import models  # Import here to avoid circular imports
+        model = getattr(models, self.model_name)
+        column = getattr(model, self.column_name)
+        query = models.db.session.query(column).distinct().filter(column.isnot(None), column != '')
+        if company_id is not None:
+            query = query.filter(model.company_id == company_id)
+        return SortedValues(row[0] for row in query.all())
+
+    def get(self, company_id):
+        """Return the SortedValues for `company_id` (None = all companies), loading it if needed."""
+        with self._lock:
+            entry = self._entries.get(company_id)
+        if entry is None:
+            entry = self._load(company_id)
+            with self._lock:
+                entry = self._entries.setdefault(company_id, entry)
+        return entry
+
+    def add(self, company_id, value):
+        """Record `value` for `company_id` in every loaded entry it belongs to."""
+        if not value:
+            return
+        with self._lock:
+            for key in (company_id, None):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.add(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+autocomplete_indexes = {
+    'capa_machine_names': DistinctValueIndex('CapaIssue', 'machine_name'),
+    'capa_customer_names': DistinctValueIndex('CapaIssue', 'customer_name'),
+    'knowledge_machine_names': DistinctValueIndex('AIKnowledgeBase', 'machine_name'),
+}
+
+
+def register_cache_invalidation():
+    """Hook model events so cached data is dropped when the underlying rows change."""
+    from models import AIKnowledgeBase, CapaIssue, Company, User  # Import here to avoid circular imports
+
+    def _company_changed(mapper, connection, target):
+        invalidate_on_commit(object_session(target), invalidate_companies)
+
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(Company, event_name, _company_changed)
+
+    # Any change to a user (password, role, company, active flag) drops the cached entry
+    def _user_changed(mapper, connection, target):
+        user_id = target.id
+        invalidate_on_commit(object_session(target), lambda: invalidate_user(user_id))
+
+    for event_name in ('after_update', 'after_delete'):
+        event.listen(User, event_name, _user_changed)
+
+    # New CAPA / knowledge values are added to the autocomplete indexes once committed
+    def _index_values(index_names_by_column):
+        def _row_written(mapper, connection, target):
+            company_id = target.company_id
+            for column_name, index_name in index_names_by_column.items():
+                value = getattr(target, column_name)
+                if value:
+                    invalidate_on_commit(
+                        object_session(target),
+                        lambda index=autocomplete_indexes[index_name], v=value: index.add(company_id, v))
+        return _row_written
+
+    capa_written = _index_values({'machine_name': 'capa_machine_names',
+                                  'customer_name': 'capa_customer_names'})
+    knowledge_written = _index_values({'machine_name': 'knowledge_machine_names'})
+    for event_name in ('after_insert', 'after_update'):
+        event.listen(CapaIssue, event_name, capa_written)
+        event.listen(AIKnowledgeBase, event_name, knowledge_written)
@@ -0,0 +1,124 @@
+from flask import current_app, flash, g, session
+from flask_login import current_user
+
+from caches import get_companies, get_company
+
+ALL_COMPANIES = 'all'
+ALL_COMPANIES_NAME = "All Companies"
+
+
+class CompanyContext:
+    """The company scope of the current request, as shown in the navbar and used to filter data."""
+
+    def __init__(self, selected_company_id=None, selected_company_name=ALL_COMPANIES_NAME,
+                 available_companies=None, assigned_company=None):
+        # 'all', a company id, or None when the context could not be resolved
+        self.selected_company_id = selected_company_id
+        self.selected_company_name = selected_company_name
+        self.available_companies = available_companies or []
+        self.assigned_company = assigned_company
+
+    @property
+    def is_all(self):
+        return self.selected_company_id == ALL_COMPANIES
+
+    @property
+    def filter_company_id(self):
+        """
+        Company id to filter queries by: None means no filter (super admin viewing all companies),
+        -1 means the context is invalid and queries should match nothing.
+        """
+        if self.is_all:
+            return None
+        if self.selected_company_id is None:
+            return -1
+        return self.selected_company_id
+
+    def apply_filter(self, query, company_column):
+        """Scope `query` to the selected company using `company_column` (e.g. CapaIssue.company_id)."""
+        company_id = self.filter_company_id
+        if company_id is None:
+            return query
+        return query.filter(company_column == company_id)
+
+    def as_template_context(self):
+        return dict(
+            available_companies=self.available_companies,
+            selected_company_id=self.selected_company_id,
+            selected_company_name=self.selected_company_name,
+            assigned_company=self.assigned_company
+        )
+
+
+def _select(company_id, company_name):
+    # Only touch the session when the value changes so the cookie is not re-issued on every page
+    if session.get('selected_company_id') != company_id:
+        session['selected_company_id'] = company_id
+    if session.get('selected_company_name') != company_name:
+        session['selected_company_name'] = company_name
+
+
+def _resolve_company_context():
+    if not current_user.is_authenticated:
+        return CompanyContext()
+
+    assigned_company = get_company(current_user.company_id)
+
+    if current_user.role == 'super_admin':
+        context = CompanyContext(available_companies=get_companies(),
+                                 assigned_company=assigned_company)
+        session_company_id = session.get('selected_company_id')
+        if session_company_id and session_company_id != ALL_COMPANIES:
+            company = get_company(session_company_id)
+            if company:
+                context.selected_company_id = company.id
+                context.selected_company_name = company.name
+                return context
+            current_app.logger.warning(
+                "Super admin %s selected unknown company ID %s. Defaulting to 'All Companies'.",
+                current_user.username, session_company_id)
+        elif session_company_id == ALL_COMPANIES:
+            context.selected_company_id = ALL_COMPANIES
+            return context
+        # If nothing (valid) in session for super_admin, default to their own company or 'All Companies'
+        elif assigned_company:
+            _select(assigned_company.id, assigned_company.name)
+            context.selected_company_id = assigned_company.id
+            context.selected_company_name = assigned_company.name
+            return context
+        elif current_user.company_id:
+            current_app.logger.warning(
+                "Super admin %s assigned company ID %s not found during context injection. Defaulting to 'All Companies'.",
+                current_user.username, current_user.company_id)
+        _select(ALL_COMPANIES, ALL_COMPANIES_NAME)
+        context.selected_company_id = ALL_COMPANIES
+        return context
+
+    # Regular user: always scoped to their own company
+    context = CompanyContext(assigned_company=assigned_company)
+    if assigned_company:
+        context.available_companies = [assigned_company]  # Only their own company
+        context.selected_company_id = assigned_company.id
+        context.selected_company_name = assigned_company.name
+        _select(assigned_company.id, assigned_company.name)
+    elif current_user.company_id:
+        # Should not happen if data is consistent
+        flash('Error: Your assigned company is not found. Please contact support.', 'danger')
+        context.selected_company_name = "Error: Company Not Found"
+    else:
+        # User not assigned to any company - critical issue
+        flash('Critical Error: You are not assigned to any company. Please contact support.', 'danger')
+        context.selected_company_name = "Error: No Company Assigned"
+    return context
+
+
+def get_company_context():
+    """Resolve the company context once per request; later calls reuse the result stored on `g`."""
+    if 'company_context' not in g:
+        g.company_context = _resolve_company_context()
+    return g.company_context
+
+
+def reset_company_context():
+    """Forget the resolved context, e.g. after the selection in the session changed."""
+    g.pop('company_context', None)
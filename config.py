@@ -12,11 +12,165 @@ DB_USERNAME = os.getenv('DB_USERNAME', 'root')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 DB_HOST = os.getenv('DB_HOST', 'localhost')
 DB_NAME = os.getenv('DB_NAME', 'capa_ai_system')
-SQLALCHEMY_DATABASE_URI = f'mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
+# DATABASE_URL overrides the MySQL settings (e.g. the in-memory SQLite database of the tests)
+SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL') or f'mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# --- Database connection pool ---
+# Sizes are per process (every pre-fork worker has its own pool). Keep DB_POOL_SIZE +
+# DB_MAX_OVERFLOW at or above WAITRESS_THREADS, and the total over all workers below
+# MySQL's max_connections.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+# Seconds a request waits for a free connection before failing, rather than stalling
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 10))
+# Connections are replaced after this many seconds; keep it below MySQL's wait_timeout
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+# Test each connection on checkout so ones dropped by the server are replaced transparently
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING,
+}
 UPLOAD_FOLDER = 'uploads'  # Folder to store uploaded images
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # Limit file upload size (e.g., 16MB)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 # --- Gemini AI Configuration ---
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+
+# --- Caching ---
+# How long the process-wide company list is kept before it is re-read (it is also
+# dropped whenever a company row is changed through the ORM).
+COMPANY_CACHE_TTL_SECONDS = int(os.getenv('COMPANY_CACHE_TTL_SECONDS', 300))
+
+# Logged-in users are re-read from the database at most this often; changes made
+# through the ORM (password, role, company) drop the cached entry immediately.
+USER_CACHE_TTL_SECONDS = int(os.getenv('USER_CACHE_TTL_SECONDS', 60))
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 1024))
+
+# Autocomplete lists (machine and customer names) are rebuilt from the database at
+# most this often; values from new CAPAs are added as soon as they are committed.
+AUTOCOMPLETE_CACHE_TTL_SECONDS = int(os.getenv('AUTOCOMPLETE_CACHE_TTL_SECONDS', 600))
+# Browser cache lifetime for autocomplete responses (revalidated with ETags afterwards)
+AUTOCOMPLETE_MAX_AGE_SECONDS = int(os.getenv('AUTOCOMPLETE_MAX_AGE_SECONDS', 60))
+# Upper bound for the `limit` query argument of the autocomplete endpoints
+AUTOCOMPLETE_MAX_LIMIT = int(os.getenv('AUTOCOMPLETE_MAX_LIMIT', 500))
+
+# --- Prompt size ---
+# Estimated token ceiling (~4 characters per token) for the RCA and action-plan prompts.
+# Knowledge examples are added, most relevant first, only while the prompt stays below it.
+PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', 4000))
+# Each example is cut to this many tokens, and each of its lines to the line budget
+PROMPT_SNIPPET_MAX_TOKENS = int(os.getenv('PROMPT_SNIPPET_MAX_TOKENS', 400))
+PROMPT_SNIPPET_LINE_MAX_TOKENS = int(os.getenv('PROMPT_SNIPPET_LINE_MAX_TOKENS', 80))
+# Examples whose WHYs / actions share at least this fraction of words with a more relevant
+# example are left out as near-duplicates
+PROMPT_DEDUPE_SIMILARITY = float(os.getenv('PROMPT_DEDUPE_SIMILARITY', 0.8))
+
+# --- Speculative RCA retrieval ---
+# Knowledge retrieval for a new CAPA's RCA runs in the background as soon as the CAPA is
+# created, so submitting the Gemba investigation only waits for the LLM. Results are kept
+# per process until the CAPA description or the knowledge base changes.
+RCA_PREFETCH_ENABLED = os.getenv('RCA_PREFETCH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RCA_PREFETCH_WORKERS = int(os.getenv('RCA_PREFETCH_WORKERS', 1))
+RCA_PREFETCH_CACHE_MAX_ENTRIES = int(os.getenv('RCA_PREFETCH_CACHE_MAX_ENTRIES', 1000))
+# Gemba investigations are usually done within a day of the CAPA being opened
+RCA_PREFETCH_CACHE_TTL_SECONDS = int(os.getenv('RCA_PREFETCH_CACHE_TTL_SECONDS', 86400))
+
+# --- Logging ---
+# Default level for all loggers (DEBUG, INFO, WARNING, ERROR)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Per-module overrides, e.g. "ai_learning=DEBUG,ai_service=INFO,sqlalchemy.engine=WARNING"
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+# 'json' (one JSON object per line, for log shippers) or 'text' (human readable)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Fraction of large DEBUG payloads (prompts, raw AI responses, embeddings) that are emitted
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))
+
+# --- Metrics ---
+# When set, /metrics (and /_debug/queries) require "Authorization: Bearer <token>".
+# When empty, they are only served to loopback clients (e.g. a Prometheus or reverse proxy
+# on the same host) and answer 404 to anyone else.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Opt out of the loopback restriction when no token is set, e.g. on a private network
+# where Prometheus scrapes from another host: METRICS_ALLOW_REMOTE=true
+METRICS_ALLOW_REMOTE = os.getenv('METRICS_ALLOW_REMOTE', '').lower() in ('1', 'true', 'yes')
+
+# --- Query inspector (development / staging) ---
+# Records every SQL statement per request, flags N+1 patterns and slow queries with the
+# calling line of code, and serves a per-endpoint report at /_debug/queries.
+QUERY_INSPECTOR_ENABLED = os.getenv('QUERY_INSPECTOR_ENABLED', '').lower() in ('1', 'true', 'yes')
+QUERY_INSPECTOR_SLOW_QUERY_MS = float(os.getenv('QUERY_INSPECTOR_SLOW_QUERY_MS', 100))
+# Identical statements issued this many times in one request are reported as a likely N+1
+QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD = int(os.getenv('QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD', 3))
+
+# --- AI cost accounting ---
+# Gemini list prices in USD per 1M tokens, used by ai_cost_report.py for cost projections
+GEMINI_INPUT_PRICE_PER_MTOK = float(os.getenv('GEMINI_INPUT_PRICE_PER_MTOK', 0.15))
+GEMINI_OUTPUT_PRICE_PER_MTOK = float(os.getenv('GEMINI_OUTPUT_PRICE_PER_MTOK', 0.60))
+
+# --- LLM backend ---
+# 'gemini' (default) calls the Google API; 'fake' uses fake_llm.FakeLLMClient, which returns
+# templated RCA / action-plan JSON offline for load and regression testing.
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini').lower()
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'models/gemini-2.5-flash-preview-05-20')
+# Request RCA / action-plan answers as schema-constrained JSON (response_mime_type +
+# response_schema); turn off only for models without structured-output support
+LLM_STRUCTURED_OUTPUT = os.getenv('LLM_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+# Fake backend behaviour: response delay (+/- jitter), share of calls that raise, and share
+# of calls that return non-JSON text
+FAKE_LLM_LATENCY_MS = float(os.getenv('FAKE_LLM_LATENCY_MS', 800))
+FAKE_LLM_LATENCY_JITTER_MS = float(os.getenv('FAKE_LLM_LATENCY_JITTER_MS', 200))
+FAKE_LLM_ERROR_RATE = float(os.getenv('FAKE_LLM_ERROR_RATE', 0.0))
+FAKE_LLM_MALFORMED_RATE = float(os.getenv('FAKE_LLM_MALFORMED_RATE', 0.0))
+
+# --- LLM call resilience (see llm_resilience.py) ---
+# Timeout of one API attempt, and deadline of a whole call including retries
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', 60))
+LLM_DEADLINE_SECONDS = float(os.getenv('LLM_DEADLINE_SECONDS', 120))
+# Retries of rate-limit / 5xx / timeout errors, with full-jitter exponential backoff
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BACKOFF_SECONDS = float(os.getenv('LLM_RETRY_BACKOFF_SECONDS', 1.0))
+LLM_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_RETRY_BACKOFF_MAX_SECONDS', 10.0))
+# Calls in flight per process and per company; a call waits at most LLM_QUEUE_TIMEOUT_SECONDS for a slot
+LLM_MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', 8))
+LLM_MAX_IN_FLIGHT_PER_COMPANY = int(os.getenv('LLM_MAX_IN_FLIGHT_PER_COMPANY', 4))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv('LLM_QUEUE_TIMEOUT_SECONDS', 30))
+# The circuit breaker opens when LLM_BREAKER_FAILURE_RATE of the last LLM_BREAKER_WINDOW attempts
+# (at least LLM_BREAKER_MIN_CALLS) failed, and lets a probe call through after the cooldown
+LLM_BREAKER_WINDOW = int(os.getenv('LLM_BREAKER_WINDOW', 20))
+LLM_BREAKER_MIN_CALLS = int(os.getenv('LLM_BREAKER_MIN_CALLS', 10))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv('LLM_BREAKER_FAILURE_RATE', 0.5))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv('LLM_BREAKER_COOLDOWN_SECONDS', 30))
+
+# --- Repeat-issue fast path ---
+# When a closed CAPA of the same company and machine matches a new one at least this
+# closely (cosine similarity of the issue descriptions, and of the WHYs for the action
+# plan), its user-adjusted WHYs / actions are proposed right away instead of calling
+# Gemini. With AI_FAST_PATH_REFINE the LLM suggestion is then generated in the background
+# and replaces the copied one, as long as the user has not submitted their analysis yet.
+AI_FAST_PATH_ENABLED = os.getenv('AI_FAST_PATH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+AI_FAST_PATH_MIN_SIMILARITY = float(os.getenv('AI_FAST_PATH_MIN_SIMILARITY', 0.95))
+AI_FAST_PATH_REFINE = os.getenv('AI_FAST_PATH_REFINE', 'true').lower() in ('1', 'true', 'yes')
+
+# --- AI job scheduler (see ai_scheduler.py) ---
+# Threads per process running AI jobs. Background and bulk jobs only start while
+# AI_SCHEDULER_INTERACTIVE_RESERVED of them stay free for interactive requests.
+AI_SCHEDULER_WORKERS = int(os.getenv('AI_SCHEDULER_WORKERS', 8))
+AI_SCHEDULER_INTERACTIVE_RESERVED = int(os.getenv('AI_SCHEDULER_INTERACTIVE_RESERVED', 2))
+# How long a request waits for its AI job; the job keeps running after that. The job's LLM
+# call gives up after LLM_DEADLINE_SECONDS (slot waits and retries included), so the wait
+# is that deadline plus an allowance for the scheduler queue and the knowledge retrieval.
+# A longer wait only holds a Waitress thread (WAITRESS_THREADS per worker process); a
+# shorter one sends users away while their suggestion is still on its way.
+AI_JOB_QUEUE_ALLOWANCE_SECONDS = float(os.getenv('AI_JOB_QUEUE_ALLOWANCE_SECONDS', 15))
+AI_JOB_WAIT_TIMEOUT_SECONDS = float(os.getenv('AI_JOB_WAIT_TIMEOUT_SECONDS',
+                                              LLM_DEADLINE_SECONDS + AI_JOB_QUEUE_ALLOWANCE_SECONDS))
+
+# --- Duplicate form submissions ---
+# How long the idempotency keys of submitted forms are kept (see idempotency.py)
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', 86400))
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+# --- Offline stand-in for Gemini ---
+# Selected with LLM_BACKEND=fake. Returns templated RCA / action-plan JSON shaped like
+# the real model's output, after a configurable delay and with configurable error and
+# malformed-response rates, so the RCA flow can be load- and regression-tested without
+# network access or an API key. Token counts are estimated (~4 characters per token).
+# With a response schema (structured output) the answer is bare JSON, and "malformed"
+# answers are JSON that needs local repair, as schema-constrained models still produce.
+
+
+class FakeLLMError(RuntimeError):
+    """Simulated API failure (rate limit, timeout, 5xx...)."""
+
+
+class FakeLLMTimeout(FakeLLMError, TimeoutError):
+    """Simulated request timeout: the latency exceeded the caller's timeout."""
+
+
+def _field(prompt, label):
+    match = re.search(rf'{label}:\s*(.+)', prompt)
+    return match.group(1).strip() if match else ''
+
+
+def _rca_response(prompt):
+    issue = _field(prompt, 'Deskripsi Masalah') or 'masalah kualitas'
+    machine = _field(prompt, 'Mesin') or 'mesin'
+    return {
+        "why1": f"{issue} terjadi pada proses di {machine}",
+        "why2": f"Parameter {machine} tidak sesuai standar saat produksi",
+        "why3": "Setting parameter tidak diverifikasi saat pergantian job",
+        "why4": "Tidak ada checklist verifikasi setting di awal shift",
+        "root_cause": "Belum ada standar kerja untuk verifikasi setting mesin"
+    }
+
+
+def _action_plan_response(prompt):
+    machine = _field(prompt, 'Mesin') or 'mesin'
+    return {
+        "temporary_action": [
+            {"langkah": f"Sortir ulang produk yang diproduksi di {machine} pada batch terdampak"},
+            {"langkah": f"Verifikasi dan koreksi setting {machine} sebelum produksi dilanjutkan"}
+        ],
+        "preventive_action": [
+            {"langkah": f"Buat checklist verifikasi setting {machine} di awal shift"},
+            {"langkah": "Latih operator tentang standar kerja verifikasi setting"}
+        ]
+    }
+
+
+def _repairable_response(data):
+    """Schema-mode slip: renamed keys or bare-string actions, plus a trailing comma."""
+    if 'why1' in data:
+        data = {key.replace('why', 'Why '): value for key, value in data.items()}
+    else:
+        data = {key: [step['langkah'] for step in steps] for key, steps in data.items()}
+    return json.dumps(data, indent=2, ensure_ascii=False)[:-2] + ',\n}'
+
+
+def _text_rca_response(prompt):
+    """Plain-text (non-JSON) answer, to exercise the RCA text fallback parser."""
+    data = _rca_response(prompt)
+    return '\n'.join([
+        f"Why 1: {data['why1']}",
+        f"Why 2: {data['why2']}",
+        f"Why 3: {data['why3']}",
+        f"Why 4: {data['why4']}",
+        f"Root Cause: {data['root_cause']}",
+    ])
+
+
+class FakeLLMClient:
+    """Drop-in for the Gemini client used by ai_service (see ai_service.LLMClient)."""
+
+    is_available = True
+    retryable_errors = (FakeLLMError,)
+
+    def __init__(self, model_name='fake-gemini', latency_ms=800, latency_jitter_ms=200,
+                 error_rate=0.0, malformed_rate=0.0, seed=None):
+        self.model_name = model_name
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        with self._lock:
+            return (self._random.random(),
+                    self._random.random(),
+                    self._random.uniform(-self.latency_jitter_ms, self.latency_jitter_ms))
+
+    def generate_content(self, prompt, response_schema=None, timeout=None):
+        error_roll, malformed_roll, jitter = self._roll()
+        latency = max(0.0, self.latency_ms + jitter) / 1000
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise FakeLLMTimeout(f"Simulated LLM request timed out after {timeout:.1f} s")
+        time.sleep(latency)
+        if error_roll < self.error_rate:
+            raise FakeLLMError("Simulated LLM backend error (503 Service Unavailable)")
+
+        is_action_plan = '"temporary_action"' in prompt
+        data = _action_plan_response(prompt) if is_action_plan else _rca_response(prompt)
+        if response_schema is not None:
+            text = _repairable_response(data) if malformed_roll < self.malformed_rate else json.dumps(data, ensure_ascii=False)
+        elif malformed_roll < self.malformed_rate:
+            text = _text_rca_response(prompt) if not is_action_plan else "Maaf, saya tidak dapat membuat rencana tindakan."
+        else:
+            text = "```json\n" + json.dumps(data, indent=2, ensure_ascii=False) + "\n```"
+
+        prompt_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(text) // 4)
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                thoughts_token_count=0,
+                total_token_count=prompt_tokens + output_tokens
+            ),
+            # Stable id so repeated prompts can be recognised in logs
+            response_id=hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]
+        )
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import request
+from sqlalchemy.exc import IntegrityError
+from wtforms import HiddenField
+
+from config import IDEMPOTENCY_KEY_TTL_SECONDS
+from metrics import duplicate_submissions_total
+from models import db, IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# --- Idempotent form submissions ---
+# Forms that start AI work carry a random idempotency key, rendered by hidden_tag(). The
+# first POST with a key records it in idempotency_keys; a duplicate (a double click, a
+# re-sent page) finds it there, in whichever worker process it lands, and is redirected
+# instead of being processed again. Requests without a key are processed as before.
+# Routes claim the key once the submission is valid, and release it again when saving
+# fails and the form is re-rendered with the same key, so the corrected retry goes through.
+# Keys older than IDEMPOTENCY_KEY_TTL_SECONDS are purged from time to time.
+
+FORM_FIELD = 'idempotency_key'
+PURGE_INTERVAL_SECONDS = 600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
+def idempotency_key_field():
+    """Hidden form field holding a fresh key each time the form is rendered."""
+    return HiddenField(default=new_idempotency_key)
+
+
+def _purge_expired_keys():
+    global _last_purge
+    with _purge_lock:
+        if time.monotonic() - _last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        _last_purge = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+    try:
+        deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            logger.debug("Purged %d expired idempotency keys", deleted)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Could not purge expired idempotency keys: %s", e)
+
+
+def claim_submission():
+    """Record the posted form's idempotency key; False if this submission was already received.
+
+    Commits the current session, so call it before making any changes.
+    """
+    key = request.form.get(FORM_FIELD)
+    if not key:
+        return True
+    db.session.add(IdempotencyKey(key=key[:64], endpoint=request.endpoint))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        duplicate_submissions_total.inc(endpoint=request.endpoint)
+        logger.info("Ignoring duplicate submission to %s (idempotency key %s)", request.endpoint, key)
+        return False
+    _purge_expired_keys()
+    return True
+
+
+def release_submission():
+    """Forget the posted form's idempotency key after the submission failed.
+
+    Call it after rolling back; commits the current session.
+    """
+    key = request.form.get(FORM_FIELD)
+    if not key:
+        return
+    try:
+        IdempotencyKey.query.filter_by(key=key[:64]).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Could not release idempotency key %s of %s: %s", key, request.endpoint, e)
@@ -0,0 +1,200 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from metrics import llm_attempts_total, llm_rejected_total
+
+logger = logging.getLogger(__name__)
+
+# --- Resilient LLM calls ---
+# ResilientLLMClient wraps the Gemini (or fake) client so one slow or failing upstream
+# cannot pin every Waitress thread:
+#   - every attempt has a timeout and the whole call, retries included, a deadline;
+#   - retryable errors (rate limits, 5xx, timeouts) are retried with full-jitter
+#     exponential backoff while the deadline allows;
+#   - a circuit breaker opens when the recent attempts' error rate spikes, so calls fail
+#     fast during an outage and one probe call is let through after the cooldown;
+#   - semaphores cap the calls in flight per process and per company, so one company's
+#     batch cannot take every slot; a call waiting too long for a slot fails.
+# The state is per process; each worker process has its own limits and breaker.
+
+
+class LLMUnavailableError(RuntimeError):
+    """The call was not made: the circuit breaker is open or no call slot became free in time."""
+
+
+class CircuitBreaker:
+    """Opens when at least `failure_rate` of the last `window` attempts failed."""
+
+    def __init__(self, window, failure_rate, min_calls, cooldown_seconds):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown_seconds = cooldown_seconds
+        self._outcomes = deque(maxlen=window)  # True for a failed attempt
+        self._opened_at = None
+        self._probing = None  # Thread making the probe attempt while open
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """Whether an attempt may be made now; after the cooldown one probe is let through."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing is not None or time.monotonic() - self._opened_at < self.cooldown_seconds:
+                return False
+            self._probing = threading.get_ident()
+            return True
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.cooldown_seconds - (time.monotonic() - self._opened_at))
+
+    def release_probe(self):
+        """Let another probe through if this thread's probe ended without a recorded outcome.
+
+        Called in a `finally`, so a probe interrupted by a BaseException (KeyboardInterrupt,
+        SystemExit, a cancelled worker) does not keep the breaker open for good.
+        """
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = None
+
+    def record(self, failed):
+        with self._lock:
+            if self._opened_at is not None:
+                if self._probing != threading.get_ident():
+                    return  # An attempt started before the breaker opened
+                self._probing = None
+                if failed:
+                    self._opened_at = time.monotonic()
+                    logger.warning("LLM circuit breaker: probe failed, staying open for %s s", self.cooldown_seconds)
+                else:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    logger.warning("LLM circuit breaker closed: probe call succeeded")
+                return
+
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_rate * len(self._outcomes):
+                self._opened_at = time.monotonic()
+                logger.error("LLM circuit breaker opened: %d of the last %d attempts failed; failing fast for %s s",
+                             failures, len(self._outcomes), self.cooldown_seconds)
+
+
+class ResilientLLMClient:
+    """LLMClient wrapper adding timeouts, retries, a circuit breaker and concurrency limits."""
+
+    def __init__(self, client, timeout_seconds, deadline_seconds, max_retries, backoff_seconds,
+                 backoff_max_seconds, max_in_flight, max_in_flight_per_company, queue_timeout_seconds,
+                 breaker):
+        self._client = client
+        self.timeout_seconds = timeout_seconds
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.max_in_flight_per_company = max_in_flight_per_company
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.breaker = breaker
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._company_slots = {}  # company_id -> BoundedSemaphore
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Errors worth retrying, as declared by the backend; timeouts and connection errors always are
+        self._retryable = tuple(getattr(client, 'retryable_errors', ())) + (TimeoutError, ConnectionError)
+
+    @property
+    def model_name(self):
+        return self._client.model_name
+
+    @property
+    def is_available(self):
+        return self._client.is_available
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _company_semaphore(self, company_id):
+        with self._lock:
+            semaphore = self._company_slots.get(company_id)
+            if semaphore is None:
+                semaphore = self._company_slots[company_id] = threading.BoundedSemaphore(
+                    self.max_in_flight_per_company)
+            return semaphore
+
+    def _acquire(self, semaphore, deadline, scope):
+        if not semaphore.acquire(timeout=max(0.0, min(self.queue_timeout_seconds, deadline - time.monotonic()))):
+            llm_rejected_total.inc(reason=f'busy_{scope}')
+            raise LLMUnavailableError(f"AI service busy: no free {scope} slot for an LLM call within "
+                                      f"{self.queue_timeout_seconds} s; please try again later")
+
+    def _attempt(self, prompt, response_schema, company_id, timeout):
+        company_semaphore = self._company_semaphore(company_id)
+        deadline = time.monotonic() + timeout
+        self._acquire(company_semaphore, deadline, 'company')
+        try:
+            self._acquire(self._slots, deadline, 'process')
+            try:
+                # Checked once a slot is held, so an allowed probe is always actually made
+                if not self.breaker.allow():
+                    llm_rejected_total.inc(reason='circuit_open')
+                    raise LLMUnavailableError(f"AI service temporarily unavailable after repeated errors; "
+                                              f"retrying in {self.breaker.retry_in():.0f} s")
+                with self._lock:
+                    self._in_flight += 1
+                try:
+                    response = self._client.generate_content(
+                        prompt, response_schema=response_schema,
+                        timeout=max(1.0, deadline - time.monotonic()))
+                except self._retryable:
+                    self.breaker.record(failed=True)
+                    llm_attempts_total.inc(result='retryable_error')
+                    raise
+                except Exception:
+                    # A request the API rejects (bad input, auth) says nothing about its health
+                    self.breaker.record(failed=False)
+                    llm_attempts_total.inc(result='error')
+                    raise
+                finally:
+                    with self._lock:
+                        self._in_flight -= 1
+                self.breaker.record(failed=False)
+                llm_attempts_total.inc(result='ok')
+                return response
+            finally:
+                self.breaker.release_probe()
+                self._slots.release()
+        finally:
+            company_semaphore.release()
+
+    def generate_content(self, prompt, response_schema=None, call_log=None):
+        """Call the backend with retries; `call_log` (an AICallLog) gives the company and gets the retry count."""
+        company_id = call_log.company_id if call_log is not None else None
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(prompt, response_schema, company_id,
+                                     min(self.timeout_seconds, deadline - time.monotonic()))
+            except self._retryable as e:
+                backoff = random.uniform(0, min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt))
+                if attempt >= self.max_retries or time.monotonic() + backoff + 1.0 >= deadline:
+                    raise
+                attempt += 1
+                if call_log is not None:
+                    call_log.retries = attempt
+                logger.warning("LLM call failed (%s: %s); retry %d of %d in %.1f s",
+                               type(e).__name__, e, attempt, self.max_retries, backoff)
+                time.sleep(backoff)
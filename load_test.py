@@ -0,0 +1,379 @@
+# End-to-end load test for the CAPA workflow.
+#
+# Drives the full flow (new CAPA with photos -> Gemba -> RCA edit -> action plan ->
+# evidence -> close -> PDF) with many concurrent users against a running server,
+# and reports throughput, latency percentiles per step and the server-side DB /
+# embedding / LLM time breakdown taken from each response's Server-Timing header.
+#
+# 1. Point the app at a dedicated test database and start it with the LLM stubbed:
+#        LLM_BACKEND=fake DB_NAME=capa_loadtest python run_production.py
+# 2. Create the synthetic companies and users (same .env / DB settings):
+#        python load_test.py seed --companies 3 --users-per-company 10
+# 3. Run the load:
+#        python load_test.py run --base-url http://127.0.0.1:5000 --concurrency 10 --flows 200
+#
+# Synthetic data is marked with the LT- company code prefix and loadtest_ usernames.
+# Do not run this against a production database.
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+
+from stats import percentile
+
+LOADTEST_PASSWORD = 'loadtest-password'
+COMPANY_CODE_PREFIX = 'LT-'
+USERNAME_PREFIX = 'loadtest_'
+
+MACHINES = ['Flexo 1', 'Flexo 2', 'Die Cut 1', 'Folder Gluer 3', 'Laminating 2']
+CUSTOMERS = ['PT Sinar Jaya', 'PT Maju Bersama', 'PT Indo Pangan', 'CV Karya Abadi']
+ITEMS = ['Box 24x18', 'Carton RSC 40x30', 'Sleeve 12oz', 'Tray 6 pack']
+ISSUES = [
+    'Lem tidak menempel sempurna pada flap box',
+    'Warna cetakan tidak sesuai standar pelanggan',
+    'Ukuran die cut tidak presisi, lipatan miring',
+    'Terdapat goresan pada permukaan laminasi',
+    'Box penyok saat proses stacking di gudang',
+]
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+CAPA_ID_PATTERN = re.compile(r'/gemba/(\d+)')
+
+
+# --- Seeding ---
+
+def seed(companies, users_per_company):
+    """Create synthetic companies and users directly in the configured database."""
+    project_root = os.path.abspath(os.path.dirname(__file__))
+    sys.path.insert(0, project_root)
+    from app import app  # Import here so `run` does not need the app's dependencies
+    from models import db, Company, User
+
+    with app.app_context():
+        created_users = 0
+        for company_index in range(1, companies + 1):
+            code = f"{COMPANY_CODE_PREFIX}{company_index:03d}"
+            company = Company.query.filter_by(company_code=code).first()
+            if company is None:
+                company = Company(company_code=code, name=f"Load Test Company {company_index}")
+                db.session.add(company)
+                db.session.flush()
+            for user_index in range(1, users_per_company + 1):
+                username = f"{USERNAME_PREFIX}{company_index:03d}_{user_index:03d}"
+                if User.query.filter_by(username=username).first():
+                    continue
+                user = User(username=username, email=f"{username}@loadtest.invalid",
+                            role='user', company_id=company.id)
+                user.set_password(LOADTEST_PASSWORD)
+                db.session.add(user)
+                created_users += 1
+        db.session.commit()
+        print(f"Seeded {companies} companies and {created_users} new users "
+              f"(password '{LOADTEST_PASSWORD}').")
+
+
+def loadtest_usernames():
+    project_root = os.path.abspath(os.path.dirname(__file__))
+    sys.path.insert(0, project_root)
+    from app import app
+    from models import User
+
+    with app.app_context():
+        return [user.username for user in
+                User.query.filter(User.username.like(f"{USERNAME_PREFIX}%")).order_by(User.username).all()]
+
+
+# --- Measurements ---
+
+def parse_server_timing(header):
+    """'total;dur=12.3, db;dur=4.5;desc="7 queries"' -> {'total': 12.3, 'db': 4.5, 'db_queries': 7}"""
+    timings = {}
+    for entry in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, *params = entry.split(';')
+        for param in params:
+            key, _, value = param.partition('=')
+            if key == 'dur':
+                timings[name] = float(value)
+            elif key == 'desc' and name == 'db':
+                match = re.match(r'"?(\d+) queries', value)
+                if match:
+                    timings['db_queries'] = int(match.group(1))
+    return timings
+
+
+class Results:
+    def __init__(self):
+        self.samples = defaultdict(list)  # step -> [(latency_ms, ok, server_timings)]
+        self.flows_completed = 0
+        self.flows_failed = 0
+        self._lock = threading.Lock()
+
+    def record(self, step, latency_ms, ok, timings):
+        with self._lock:
+            self.samples[step].append((latency_ms, ok, timings))
+
+    def flow_finished(self, ok):
+        with self._lock:
+            if ok:
+                self.flows_completed += 1
+            else:
+                self.flows_failed += 1
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def build_report(results, elapsed):
+    steps = {}
+    total_requests = 0
+    for step, samples in results.samples.items():
+        latencies = sorted(latency for latency, _, _ in samples)
+        server = [timings for _, _, timings in samples]
+        total_requests += len(samples)
+        steps[step] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, ok, _ in samples if not ok),
+            'p50_ms': round(percentile(latencies, 0.50, default=0.0), 1),
+            'p95_ms': round(percentile(latencies, 0.95, default=0.0), 1),
+            'p99_ms': round(percentile(latencies, 0.99, default=0.0), 1),
+            'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+            'server_ms': round(mean([t.get('total', 0.0) for t in server]), 1),
+            'db_ms': round(mean([t.get('db', 0.0) for t in server]), 1),
+            'db_queries': round(mean([t.get('db_queries', 0) for t in server]), 1),
+            'embedding_ms': round(mean([t.get('embedding-encode', 0.0) for t in server]), 1),
+            'retrieval_ms': round(mean([t.get('retrieval-rca', 0.0) + t.get('retrieval-action_plan', 0.0)
+                                        for t in server]), 1),
+            'llm_ms': round(mean([t.get('llm-rca', 0.0) + t.get('llm-action_plan', 0.0) for t in server]), 1),
+            'pdf_ms': round(mean([t.get('pdf-render', 0.0) for t in server]), 1),
+            'template_ms': round(mean([t.get('render_template', 0.0) for t in server]), 1),
+        }
+    return {
+        'elapsed_seconds': round(elapsed, 2),
+        'flows_completed': results.flows_completed,
+        'flows_failed': results.flows_failed,
+        'flows_per_second': round(results.flows_completed / elapsed, 3) if elapsed else 0.0,
+        'requests': total_requests,
+        'requests_per_second': round(total_requests / elapsed, 2) if elapsed else 0.0,
+        'steps': steps,
+    }
+
+
+def print_report(report):
+    print()
+    print(f"Elapsed: {report['elapsed_seconds']} s  |  flows completed: {report['flows_completed']}  "
+          f"failed: {report['flows_failed']}  |  {report['flows_per_second']} flows/s, "
+          f"{report['requests_per_second']} req/s")
+    print()
+    header = (f"{'step':<16} {'reqs':>6} {'err':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} "
+              f"{'server':>8} {'db':>7} {'qry':>5} {'embed':>7} {'retr':>7} {'llm':>7} {'pdf':>7} {'tmpl':>7}")
+    print(header)
+    print('-' * len(header))
+    for step, s in report['steps'].items():
+        print(f"{step:<16} {s['requests']:>6} {s['errors']:>5} {s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} "
+              f"{s['max_ms']:>8} {s['server_ms']:>8} {s['db_ms']:>7} {s['db_queries']:>5} {s['embedding_ms']:>7} "
+              f"{s['retrieval_ms']:>7} {s['llm_ms']:>7} {s['pdf_ms']:>7} {s['template_ms']:>7}")
+    print()
+    print("Client latencies (p50..max) and server-side means are in milliseconds; "
+          "'qry' is the mean number of SQL statements per request.")
+
+
+# --- Workflow driver ---
+
+class FlowError(Exception):
+    pass
+
+
+class VirtualUser:
+    """One logged-in browser session running complete CAPA flows."""
+
+    def __init__(self, base_url, username, results, photo_bytes, include_pdf, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.results = results
+        self.photo_bytes = photo_bytes
+        self.include_pdf = include_pdf
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.csrf_token = None
+
+    def _request(self, step, method, path, expect=(200, 302), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, allow_redirects=False,
+                                            timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.results.record(step, (time.perf_counter() - start) * 1000, False, {})
+            raise FlowError(f"{step}: {e}") from e
+        latency_ms = (time.perf_counter() - start) * 1000
+        # A redirect to the login page means the session was lost
+        ok = response.status_code in expect and '/login' not in response.headers.get('Location', '')
+        self.results.record(step, latency_ms, ok, parse_server_timing(response.headers.get('Server-Timing')))
+        if not ok:
+            raise FlowError(f"{step}: HTTP {response.status_code} {response.headers.get('Location', '')}")
+        return response
+
+    def _photo(self, name):
+        return (name, io.BytesIO(self.photo_bytes), 'image/jpeg')
+
+    def login(self):
+        page = self._request('login_page', 'GET', '/login', expect=(200,))
+        match = CSRF_PATTERN.search(page.text)
+        if not match:
+            raise FlowError("login: CSRF token not found")
+        self._request('login', 'POST', '/login', expect=(302,), data={
+            'csrf_token': match.group(1), 'username': self.username, 'password': LOADTEST_PASSWORD})
+        form_page = self._request('new_capa_form', 'GET', '/new', expect=(200,))
+        match = CSRF_PATTERN.search(form_page.text)
+        if not match:
+            raise FlowError("new_capa_form: CSRF token not found")
+        self.csrf_token = match.group(1)
+
+    def run_flow(self, rng):
+        today = date.today()
+        response = self._request('new_capa', 'POST', '/new', expect=(302,), data={
+            'csrf_token': self.csrf_token,
+            'customer_name': rng.choice(CUSTOMERS),
+            'item_involved': rng.choice(ITEMS),
+            'issue_date': (today - timedelta(days=rng.randint(0, 30))).isoformat(),
+            'issue_description': rng.choice(ISSUES),
+            'machine_name': rng.choice(MACHINES),
+            'batch_number': f"B{rng.randint(1000, 9999)}",
+        }, files=[('initial_photos[]', self._photo('initial_1.jpg')),
+                  ('initial_photos[]', self._photo('initial_2.jpg'))])
+        match = CAPA_ID_PATTERN.search(response.headers.get('Location', ''))
+        if not match:
+            raise FlowError(f"new_capa: unexpected redirect {response.headers.get('Location')}")
+        capa_id = match.group(1)
+
+        # Gemba submission triggers retrieval + the RCA LLM call
+        self._request('gemba', 'POST', f'/gemba/{capa_id}', data={
+            'csrf_token': self.csrf_token,
+            'gemba_findings': 'Ditemukan setting mesin berubah dari standar saat pergantian job.',
+        }, files=[('gemba_photos[]', self._photo('gemba.jpg'))])
+
+        # RCA edit triggers retrieval + the action-plan LLM call
+        self._request('edit_rca', 'POST', f'/edit_rca/{capa_id}', data={
+            'csrf_token': self.csrf_token,
+            'why_1': 'Setting mesin tidak sesuai standar',
+            'why_2': 'Tidak ada verifikasi setting saat pergantian job',
+            'why_3': 'Checklist awal shift belum tersedia',
+            'why_4': 'Standar kerja belum diperbarui',
+            'why_5': 'Belum ada prosedur kontrol perubahan setting',
+        })
+
+        due = (today + timedelta(days=7)).isoformat()
+        self._request('edit_action_plan', 'POST', f'/edit_action_plan/{capa_id}', data={
+            'csrf_token': self.csrf_token,
+            'temp_action_text[]': ['Sortir ulang produk terdampak'],
+            'temp_action_indicator[]': ['0 produk NG terkirim'],
+            'temp_action_pic[]': ['QC'],
+            'temp_action_due_date[]': [due],
+            'prev_action_text[]': ['Buat checklist verifikasi setting'],
+            'prev_action_indicator[]': ['Checklist dipakai tiap shift'],
+            'prev_action_pic[]': ['Produksi'],
+            'prev_action_due_date[]': [due],
+        })
+
+        for action_type in ('temporary', 'preventive'):
+            self._request('submit_evidence', 'POST', f'/submit_evidence/{capa_id}', data={
+                'csrf_token': self.csrf_token,
+                'evidence_description': f'Bukti tindakan {action_type}',
+                'action_type': action_type,
+                'action_index': '0',
+            }, files=[('evidence_photo', self._photo(f'evidence_{action_type}.jpg'))])
+
+        self._request('view_capa', 'GET', f'/view/{capa_id}', expect=(200,))
+        self._request('close_capa', 'POST', f'/close_capa/{capa_id}', data={'csrf_token': self.csrf_token})
+        if self.include_pdf:
+            self._request('pdf_report', 'GET', f'/report/{capa_id}/pdf', expect=(200,))
+        self._request('index', 'GET', '/', expect=(200,))
+
+
+def make_photo(kilobytes):
+    """A JPEG of roughly `kilobytes` KB (random noise compresses poorly, like real photos)."""
+    from PIL import Image
+    side = max(16, int((kilobytes * 1024 / 1.5) ** 0.5))
+    image = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def run(base_url, usernames, concurrency, flows, photo_kb, include_pdf, timeout, seed_value):
+    results = Results()
+    photo_bytes = make_photo(photo_kb)
+    remaining = iter(range(flows))
+    remaining_lock = threading.Lock()
+
+    def next_flow():
+        with remaining_lock:
+            return next(remaining, None)
+
+    def worker(worker_index):
+        rng = random.Random(seed_value + worker_index)
+        user = VirtualUser(base_url, usernames[worker_index % len(usernames)], results,
+                           photo_bytes, include_pdf, timeout)
+        try:
+            user.login()
+        except FlowError as e:
+            print(f"[worker {worker_index}] login failed: {e}")
+            return
+        while next_flow() is not None:
+            try:
+                user.run_flow(rng)
+                results.flow_finished(True)
+            except FlowError as e:
+                results.flow_finished(False)
+                print(f"[worker {worker_index}] flow failed: {e}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return build_report(results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the CAPA workflow end to end.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help="Create synthetic companies and users in the configured DB")
+    seed_parser.add_argument('--companies', type=int, default=3)
+    seed_parser.add_argument('--users-per-company', type=int, default=10)
+
+    run_parser = subparsers.add_parser('run', help="Run concurrent CAPA flows against a server")
+    run_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--concurrency', type=int, default=10, help="Concurrent virtual users")
+    run_parser.add_argument('--flows', type=int, default=100, help="Total CAPA flows to run")
+    run_parser.add_argument('--photo-kb', type=int, default=300, help="Approximate size of each uploaded photo")
+    run_parser.add_argument('--no-pdf', action='store_true', help="Skip the PDF report step")
+    run_parser.add_argument('--timeout', type=float, default=120.0, help="Per-request timeout in seconds")
+    run_parser.add_argument('--seed', type=int, default=1, help="Random seed for synthetic CAPA content")
+    run_parser.add_argument('--users', nargs='*', help="Usernames to log in as (default: all seeded users)")
+    run_parser.add_argument('--json', help="Also write the report as JSON to this file")
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args.companies, args.users_per_company)
+    else:
+        usernames = args.users or loadtest_usernames()
+        if not usernames:
+            parser.error("No load test users found; run 'python load_test.py seed' first")
+        report = run(args.base_url, usernames, args.concurrency, args.flows, args.photo_kb,
+                     not args.no_pdf, args.timeout, args.seed)
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {args.json}")
@@ -0,0 +1,98 @@
+import json
+import logging
+import random
+import sys
+from datetime import datetime, timezone
+
+from config import LOG_DEBUG_SAMPLE_RATE, LOG_FORMAT, LOG_LEVEL, LOG_LEVELS
+
+# Pass as `extra=PAYLOAD` on DEBUG records that carry large payloads (prompts, raw
+# AI responses, embedding vectors); only LOG_DEBUG_SAMPLE_RATE of them are emitted.
+PAYLOAD = {'payload': True}
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is
+# added to the JSON output as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key != 'payload':
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class PayloadSampler(logging.Filter):
+    """Lets through only a sample of the records marked with `extra=PAYLOAD`."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'payload', False):
+            return random.random() < self.rate
+        return True
+
+
+class Lazy:
+    """Defers an expensive computation until the log message is actually formatted.
+
+    Usage: logger.debug("Prompt: %s", Lazy(build_prompt_text, issue))
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def describe_array(array):
+    """Short description of an embedding array (type, shape, dtype) instead of its values."""
+    shape = getattr(array, 'shape', None)
+    if shape is None:
+        return f"{type(array).__name__}(len={len(array) if array is not None else 0})"
+    return f"{type(array).__name__}(shape={shape}, dtype={array.dtype})"
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Install the root handler and levels from config. Safe to call more than once."""
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    handler.addFilter(PayloadSampler(LOG_DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
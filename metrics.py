@@ -0,0 +1,387 @@
+import bisect
+import functools
+import hmac
+import ipaddress
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+from flask import template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+
+from config import METRICS_ALLOW_REMOTE, METRICS_TOKEN
+
+# --- Prometheus-format metrics ---
+# A small in-process registry (counters, histograms and gauges with labels) rendered in the
+# Prometheus text exposition format at /metrics. Values are per process; when the
+# app runs several worker processes, scrape each one or aggregate in Prometheus.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, ('le', '+Inf'))
+            lines.append(f'{self.name}_bucket{labels} {series[-1]}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(float(series[-2]))}')
+            lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+
+class Gauge:
+    """A value read when /metrics is rendered: `callback()` returns {label values tuple: value}."""
+
+    def __init__(self, name, documentation, labelnames, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.callback().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames, callback):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests_total = registry.counter(
+    'capa_http_requests_total', 'HTTP requests handled.', ('method', 'endpoint', 'status'))
+http_request_duration = registry.histogram(
+    'capa_http_request_duration_seconds', 'Time spent handling HTTP requests.', ('method', 'endpoint'))
+db_queries_per_request = registry.histogram(
+    'capa_db_queries_per_request', 'SQL statements executed per HTTP request.', ('endpoint',), COUNT_BUCKETS)
+db_time_per_request = registry.histogram(
+    'capa_db_time_per_request_seconds', 'Time spent in SQL statements per HTTP request.', ('endpoint',))
+db_query_duration = registry.histogram(
+    'capa_db_query_duration_seconds', 'Duration of individual SQL statements.', ('statement',))
+span_duration = registry.histogram(
+    'capa_span_duration_seconds', 'Duration of named spans (retrieval, LLM calls, PDF rendering, uploads...).', ('span',))
+span_errors_total = registry.counter(
+    'capa_span_errors_total', 'Spans that ended with an exception.', ('span',))
+db_pool_checkout_wait = registry.histogram(
+    'capa_db_pool_checkout_wait_seconds',
+    'Time spent waiting for a pooled database connection (including opening new ones).', (), WAIT_BUCKETS)
+db_pool_checkout_timeouts_total = registry.counter(
+    'capa_db_pool_checkout_timeouts_total', 'Connection checkouts that failed after DB_POOL_TIMEOUT.')
+rca_prefetch_lookups_total = registry.counter(
+    'capa_rca_prefetch_lookups_total',
+    'RCA knowledge lookups by outcome of the speculative retrieval (hit, waited, stale, miss).', ('result',))
+ai_fast_path_total = registry.counter(
+    'capa_ai_fast_path_total',
+    'AI suggestions copied from a near-identical closed CAPA instead of calling the LLM.', ('stage',))
+ai_single_flight_shared_total = registry.counter(
+    'capa_ai_single_flight_shared_total',
+    'AI triggers that joined a run already in progress for the same CAPA instead of starting one.', ('stage',))
+duplicate_submissions_total = registry.counter(
+    'capa_duplicate_submissions_total',
+    'Form submissions ignored because their idempotency key was already received.', ('endpoint',))
+ai_jobs_total = registry.counter(
+    'capa_ai_jobs_total', 'Finished AI jobs by priority and status (done, failed, cancelled).',
+    ('priority', 'status'))
+ai_job_queue_wait = registry.histogram(
+    'capa_ai_job_queue_wait_seconds', 'Time AI jobs waited in the scheduler queue.', ('priority',))
+llm_attempts_total = registry.counter(
+    'capa_llm_attempts_total', 'LLM API attempts by result (ok, retryable_error, error).', ('result',))
+llm_rejected_total = registry.counter(
+    'capa_llm_rejected_total',
+    'LLM calls failed without an attempt (circuit_open, busy_company, busy_process).', ('reason',))
+db_pool_hold_duration = registry.histogram(
+    'capa_db_pool_connection_hold_seconds',
+    'How long a connection stayed checked out, by the endpoint that checked it out.', ('endpoint',))
+
+
+# --- Spans ---
+
+@contextmanager
+def span(name):
+    """Time a block of work under `name`; also shown per request in the Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        span_errors_total.inc(span=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        span_duration.observe(elapsed, span=name)
+        if has_request_context():
+            spans = g.setdefault('metrics_spans', {})
+            spans[name] = spans.get(name, 0.0) + elapsed
+
+
+def timed(name):
+    """Decorator form of `span`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Connection pool ---
+
+_pools = weakref.WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sa_exc.TimeoutError:
+            db_pool_checkout_timeouts_total.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            db_pool_checkout_wait.observe(elapsed)
+            if has_request_context() and 'metrics_start' in g:
+                spans = g.setdefault('metrics_spans', {})
+                spans['db.pool_wait'] = spans.get('db.pool_wait', 0.0) + elapsed
+
+
+def _pool_connections():
+    totals = {'checked_out': 0, 'idle': 0, 'overflow': 0}
+    for pool in list(_pools):
+        totals['checked_out'] += pool.checkedout()
+        totals['idle'] += pool.checkedin()
+        totals['overflow'] += max(0, pool.overflow())
+    return {(state,): value for state, value in totals.items()}
+
+
+registry.gauge('capa_db_pool_connections',
+               'Connections in the database pool by state (checked_out, idle, overflow).',
+               ('state',), _pool_connections)
+registry.gauge('capa_db_pool_size', 'Configured size of the database pool (excluding overflow).',
+               (), lambda: {(): sum(pool.size() for pool in list(_pools))})
+
+
+@event.listens_for(Pool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    endpoint = (request.endpoint or 'unmatched') if has_request_context() else 'background'
+    connection_record.info['metrics_checkout'] = (time.perf_counter(), endpoint)
+
+
+@event.listens_for(Pool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    checkout = connection_record.info.pop('metrics_checkout', None)
+    if checkout is not None:
+        db_pool_hold_duration.observe(time.perf_counter() - checkout[0], endpoint=checkout[1])
+
+
+# --- SQLAlchemy statement timing ---
+
+def _statement_kind(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    db_query_duration.observe(elapsed, statement=_statement_kind(statement))
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_time += elapsed
+
+
+# --- Request middleware ---
+
+def _record_request(status):
+    if g.get('metrics_recorded') or 'metrics_start' not in g:
+        return None
+    g.metrics_recorded = True
+    elapsed = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or 'unmatched'
+    http_requests_total.inc(method=request.method, endpoint=endpoint, status=status)
+    http_request_duration.observe(elapsed, method=request.method, endpoint=endpoint)
+    db_queries_per_request.observe(g.metrics_db_queries, endpoint=endpoint)
+    db_time_per_request.observe(g.metrics_db_time, endpoint=endpoint)
+    return elapsed
+
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+
+def require_metrics_access():
+    """Abort the request unless it may read the operational endpoints (/metrics, /_debug/queries).
+
+    With METRICS_TOKEN set the request needs "Authorization: Bearer <token>" (403 otherwise);
+    without one, only loopback clients are served (404 otherwise) unless METRICS_ALLOW_REMOTE.
+    """
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+            abort(403)
+    elif not METRICS_ALLOW_REMOTE and not _is_loopback(request.remote_addr):
+        abort(404)
+
+
+def init_metrics(app):
+    """Install request timing, template-render spans and the /metrics endpoint on `app`."""
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_db_queries = 0
+        g.metrics_db_time = 0.0
+
+    @app.after_request
+    def _finish_request_timer(response):
+        elapsed = _record_request(response.status_code)
+        if elapsed is not None:
+            timings = [f'total;dur={elapsed * 1000:.1f}',
+                       f'db;dur={g.metrics_db_time * 1000:.1f};desc="{g.metrics_db_queries} queries"']
+            timings.extend(f'{name.replace(".", "-")};dur={value * 1000:.1f}'
+                           for name, value in g.get('metrics_spans', {}).items())
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    @app.teardown_request
+    def _record_failed_request(exc):
+        # after_request does not run for unhandled exceptions
+        if exc is not None:
+            _record_request(500)
+
+    # Template rendering is timed through Flask's signals so every render_template is covered
+    def _template_started(sender, template, context, **extra):
+        g.setdefault('metrics_template_starts', []).append(time.perf_counter())
+
+    def _template_finished(sender, template, context, **extra):
+        starts = g.get('metrics_template_starts')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        span_duration.observe(elapsed, span='render_template')
+        spans = g.setdefault('metrics_spans', {})
+        spans['render_template'] = spans.get('render_template', 0.0) + elapsed
+
+    before_render_template.connect(_template_started, app, weak=False)
+    template_rendered.connect(_template_finished, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        require_metrics_access()
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,52 @@
+"""Store photo lists, WHYs and action plans in native JSON columns
+
+Revision ID: 3b9d0c4f7a21
+Revises: e71563afe6b2
+Create Date: 2026-10-19 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+# revision identifiers, used by Alembic.
+revision = '3b9d0c4f7a21'
+down_revision = 'e71563afe6b2'
+branch_labels = None
+depends_on = None
+
+JSON_COLUMNS = [
+    ('capa_issues', 'initial_photos_json'),
+    ('gemba_investigations', 'gemba_photos_json'),
+    ('root_causes', 'user_adjusted_whys_json'),
+    ('action_plans', 'user_adjusted_actions_json'),
+]
+
+
+def upgrade():
+    # Empty strings are not valid JSON; MySQL refuses the conversion unless they are NULL
+    for table, column in JSON_COLUMNS:
+        op.execute(f"UPDATE {table} SET {column} = NULL WHERE {column} = ''")
+
+    if op.get_bind().dialect.name != 'mysql':
+        # Other backends keep TEXT; the JSONText model type encodes/decodes in Python
+        return
+
+    for table, column in JSON_COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(column,
+                   existing_type=mysql.TEXT(),
+                   type_=mysql.JSON(),
+                   existing_nullable=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'mysql':
+        return
+
+    for table, column in JSON_COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(column,
+                   existing_type=mysql.JSON(),
+                   type_=mysql.TEXT(),
+                   existing_nullable=True)
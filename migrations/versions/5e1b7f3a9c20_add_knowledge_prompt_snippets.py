@@ -0,0 +1,28 @@
+"""Store pre-rendered prompt snippets with each knowledge entry
+
+Revision ID: 5e1b7f3a9c20
+Revises: c4a9e2d71b53
+Create Date: 2026-10-19 15:40:07.562193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+# revision identifiers, used by Alembic.
+revision = '5e1b7f3a9c20'
+down_revision = 'c4a9e2d71b53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Native JSON on MySQL, TEXT elsewhere (see models.JSONText)
+    column_type = mysql.JSON() if op.get_bind().dialect.name == 'mysql' else sa.Text()
+    with op.batch_alter_table('ai_knowledge_base', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('prompt_snippets_json', column_type, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('ai_knowledge_base', schema=None) as batch_op:
+        batch_op.drop_column('prompt_snippets_json')
@@ -0,0 +1,46 @@
+"""Add ai_call_logs for Gemini token, latency and cost accounting
+
+Revision ID: 8f2c61d4e0b7
+Revises: 3b9d0c4f7a21
+Create Date: 2026-10-19 10:05:12.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2c61d4e0b7'
+down_revision = '3b9d0c4f7a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ai_call_logs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('call_type', sa.String(length=50), nullable=False),
+    sa.Column('model_name', sa.String(length=100), nullable=False),
+    sa.Column('capa_id', sa.Integer(), nullable=True),
+    sa.Column('company_id', sa.Integer(), nullable=True),
+    sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+    sa.Column('output_tokens', sa.Integer(), nullable=True),
+    sa.Column('total_tokens', sa.Integer(), nullable=True),
+    sa.Column('latency_ms', sa.Integer(), nullable=True),
+    sa.Column('retries', sa.Integer(), nullable=False),
+    sa.Column('outcome', sa.String(length=20), nullable=False),
+    sa.Column('error_message', sa.String(length=500), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['capa_id'], ['capa_issues.capa_id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['company_id'], ['companies.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('ai_call_logs', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_ai_call_logs_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('ai_call_logs', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_ai_call_logs_created_at'))
+
+    op.drop_table('ai_call_logs')
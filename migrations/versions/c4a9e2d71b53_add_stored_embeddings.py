@@ -0,0 +1,40 @@
+"""Store description and WHYs embeddings on CAPA issues and knowledge entries
+
+Revision ID: c4a9e2d71b53
+Revises: 8f2c61d4e0b7
+Create Date: 2026-10-19 14:22:41.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e2d71b53'
+down_revision = '8f2c61d4e0b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('capa_issues', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('issue_embedding', sa.LargeBinary(), nullable=True))
+        batch_op.add_column(sa.Column('whys_embedding', sa.LargeBinary(), nullable=True))
+        batch_op.add_column(sa.Column('embedding_model', sa.String(length=200), nullable=True))
+
+    with op.batch_alter_table('ai_knowledge_base', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('issue_embedding', sa.LargeBinary(), nullable=True))
+        batch_op.add_column(sa.Column('whys_embedding', sa.LargeBinary(), nullable=True))
+        batch_op.add_column(sa.Column('embedding_model', sa.String(length=200), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('ai_knowledge_base', schema=None) as batch_op:
+        batch_op.drop_column('embedding_model')
+        batch_op.drop_column('whys_embedding')
+        batch_op.drop_column('issue_embedding')
+
+    with op.batch_alter_table('capa_issues', schema=None) as batch_op:
+        batch_op.drop_column('embedding_model')
+        batch_op.drop_column('whys_embedding')
+        batch_op.drop_column('issue_embedding')
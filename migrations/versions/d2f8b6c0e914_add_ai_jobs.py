@@ -0,0 +1,46 @@
+"""Add ai_jobs for inspecting and cancelling scheduled AI jobs
+
+Revision ID: d2f8b6c0e914
+Revises: a7d3e9f25b41
+Create Date: 2026-10-19 18:40:12.531904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f8b6c0e914'
+down_revision = 'a7d3e9f25b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ai_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('stage', sa.String(length=50), nullable=False),
+    sa.Column('priority', sa.String(length=20), nullable=False),
+    sa.Column('capa_id', sa.Integer(), nullable=True),
+    sa.Column('company_id', sa.Integer(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('worker', sa.String(length=100), nullable=False),
+    sa.Column('error_message', sa.String(length=500), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['capa_id'], ['capa_issues.capa_id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['company_id'], ['companies.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('ai_jobs', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_ai_jobs_created_at'), ['created_at'], unique=False)
+        batch_op.create_index('ix_ai_jobs_status_priority', ['status', 'priority'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('ai_jobs', schema=None) as batch_op:
+        batch_op.drop_index('ix_ai_jobs_status_priority')
+        batch_op.drop_index(batch_op.f('ix_ai_jobs_created_at'))
+
+    op.drop_table('ai_jobs')
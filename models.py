@@ -1,13 +1,55 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 import json
+import logging
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.dialects import mysql
+from sqlalchemy.ext.mutable import MutableDict, MutableList
+from sqlalchemy.orm import deferred
 
 db = SQLAlchemy()
 
+logger = logging.getLogger(__name__)
+
+# Characters of an undecodable JSON column value quoted in the warning
+LOGGED_VALUE_PREVIEW_CHARS = 100
+
+
+# --- Column Types ---
+
+
+class JSONText(db.TypeDecorator):
+    """
+    JSON document column: native JSON on MySQL, TEXT with JSON encoding elsewhere.
+    Values are decoded once when the row is loaded and kept on the instance; wrap the
+    type with MutableList/MutableDict so in-place changes are written back on commit.
+    """
+    impl = db.Text
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.JSON(none_as_null=True))
+        return dialect.type_descriptor(db.Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'mysql':
+            return value  # mysql.JSON serialises the value itself
+        return json.dumps(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'mysql':
+            return value  # mysql.JSON already decoded it
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            logger.warning("Could not decode JSON column value (%d characters): %r",
+                           len(str(value)), str(value)[:LOGGED_VALUE_PREVIEW_CHARS], exc_info=True)
+            return None
+
 # --- Database Models ---
 
 
@@ -23,7 +65,7 @@ class CapaIssue(db.Model):
     # Batch information
     batch_number = db.Column(db.String(100))
     # Paths to initial issue photos (stored as JSON array)
-    initial_photos_json = db.Column(db.Text)  # Changed from String(300) to Text
+    initial_photos_json = db.Column(MutableList.as_mutable(JSONText))
     submission_timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     # e.g., 'Open', 'Gemba Pending', 'RCA Pending', 'Action Pending', 'Evidence Pending', 'Closed'
     status = db.Column(db.String(50), default='Open', nullable=False)
@@ -31,6 +73,12 @@ class CapaIssue(db.Model):
     is_deleted = db.Column(db.Boolean, default=False, nullable=False)
     deleted_at = db.Column(db.DateTime, nullable=True)
     created_by_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True) # Nullable True for now for existing data
+    # Sentence embeddings of the issue description and the final WHYs, computed once and
+    # reused by every AI stage (see ai_learning.embed_rows); tagged with the model that made them.
+    # Deferred so CAPA lists and pages do not load the blobs.
+    issue_embedding = deferred(db.Column(db.LargeBinary, nullable=True), group='embeddings')
+    whys_embedding = deferred(db.Column(db.LargeBinary, nullable=True), group='embeddings')
+    embedding_model = deferred(db.Column(db.String(200), nullable=True), group='embeddings')
 
     # Relationships
     company = db.relationship('Company', backref=db.backref('capa_issues', lazy='dynamic'))
@@ -44,15 +92,18 @@ class CapaIssue(db.Model):
     evidence = db.relationship(
         'Evidence', backref='capa_issue', cascade="all, delete-orphan")  # One-to-many
 
+    @classmethod
+    def query_for(cls, profile):
+        """Query CAPA issues with the eager-loading options of a named profile (see CAPA_LOADER_PROFILES)."""
+        return cls.query.options(*CAPA_LOADER_PROFILES[profile])
+
     @property
     def initial_photos(self):
-        if self.initial_photos_json:
-            return json.loads(self.initial_photos_json)
-        return []
+        return self.initial_photos_json or []
 
     @initial_photos.setter
     def initial_photos(self, photo_list):
-        self.initial_photos_json = json.dumps(photo_list)
+        self.initial_photos_json = list(photo_list)
 
 
 class RootCause(db.Model):
@@ -62,8 +113,8 @@ class RootCause(db.Model):
         'capa_issues.capa_id'), nullable=False, unique=True)
     # Store AI's 5 Why suggestion as JSON string
     ai_suggested_rc_json = db.Column(db.Text)
-    # Store user's adjusted whys as JSON string to support variable number of whys
-    user_adjusted_whys_json = db.Column(db.Text)
+    # Store user's adjusted whys as a JSON array to support variable number of whys
+    user_adjusted_whys_json = db.Column(MutableList.as_mutable(JSONText))
     # Store the learning examples used by the AI for generating suggestions
     learning_examples_json = db.Column(db.Text)
     # Keep original columns for backward compatibility
@@ -78,7 +129,7 @@ class RootCause(db.Model):
     def user_adjusted_whys(self):
         """Get the list of user adjusted whys"""
         if self.user_adjusted_whys_json:
-            return json.loads(self.user_adjusted_whys_json)
+            return self.user_adjusted_whys_json
         # For backward compatibility, convert old format to new format
         elif self.user_adjusted_why1:
             whys = []
@@ -98,7 +149,7 @@ class RootCause(db.Model):
     @user_adjusted_whys.setter
     def user_adjusted_whys(self, whys_list):
         """Set the list of user adjusted whys"""
-        self.user_adjusted_whys_json = json.dumps(whys_list)
+        self.user_adjusted_whys_json = list(whys_list)
         # Also update individual columns for backward compatibility
         if len(whys_list) > 0:
             self.user_adjusted_why1 = whys_list[0]
@@ -119,8 +170,8 @@ class ActionPlan(db.Model):
         'capa_issues.capa_id'), nullable=False, unique=True)
     # Store AI's action suggestions as JSON string
     ai_suggested_actions_json = db.Column(db.Text)
-    # Store user adjusted actions as JSON string with PIC and due date for each action
-    user_adjusted_actions_json = db.Column(db.Text)
+    # Store user adjusted actions as a JSON object with PIC and due date for each action
+    user_adjusted_actions_json = db.Column(MutableDict.as_mutable(JSONText))
     # Jangan hapus kolom lama untuk menjaga kompatibilitas dengan data yang sudah ada
     user_adjusted_temp_action = db.Column(db.Text)
     user_adjusted_prev_action = db.Column(db.Text)
@@ -151,19 +202,17 @@ class GembaInvestigation(db.Model):
         'capa_issues.capa_id'), nullable=False, unique=True)
     # Text of the findings, including suspected causes and factors
     findings = db.Column(db.Text, nullable=False)
-    gemba_photos_json = db.Column(db.Text)  # Store photo paths as JSON array
+    gemba_photos_json = db.Column(MutableList.as_mutable(JSONText))  # Store photo paths as JSON array
     gemba_submission_timestamp = db.Column(
         db.DateTime, default=datetime.utcnow)
 
     @property
     def gemba_photos(self):
-        if self.gemba_photos_json:
-            return json.loads(self.gemba_photos_json)
-        return []
+        return self.gemba_photos_json or []
 
     @gemba_photos.setter
     def gemba_photos(self, photo_list):
-        self.gemba_photos_json = json.dumps(photo_list)
+        self.gemba_photos_json = list(photo_list)
 
 
 class AIKnowledgeBase(db.Model):
@@ -191,12 +240,77 @@ class AIKnowledgeBase(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
 
+    # The entry rendered once for the RCA and action-plan prompts, so prompt assembly only
+    # concatenates text (see prompt_builder.render_knowledge_snippets)
+    prompt_snippets_json = db.Column(JSONText)
+
+    # Embeddings of issue_description and the WHYs, copied from the source CAPA on close
+    issue_embedding = deferred(db.Column(db.LargeBinary, nullable=True), group='embeddings')
+    whys_embedding = deferred(db.Column(db.LargeBinary, nullable=True), group='embeddings')
+    embedding_model = deferred(db.Column(db.String(200), nullable=True), group='embeddings')
+
     # Relationship to CapaIssue
     company = db.relationship('Company', backref=db.backref('ai_knowledge_base_entries', lazy='dynamic'))
     capa_issue = db.relationship('CapaIssue', backref=db.backref(
         'knowledge_entries', lazy='dynamic'))
 
 
+class AICallLog(db.Model):
+    """One Gemini request: token usage, latency and outcome, for cost and latency reporting."""
+    __tablename__ = 'ai_call_logs'
+    id = db.Column(db.Integer, primary_key=True)
+    # 'rca' or 'action_plan'
+    call_type = db.Column(db.String(50), nullable=False)
+    model_name = db.Column(db.String(100), nullable=False)
+    capa_id = db.Column(db.Integer, db.ForeignKey('capa_issues.capa_id', ondelete='SET NULL'), nullable=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=True)
+    prompt_tokens = db.Column(db.Integer, nullable=True)
+    # Billed output tokens, including the model's thinking tokens
+    output_tokens = db.Column(db.Integer, nullable=True)
+    total_tokens = db.Column(db.Integer, nullable=True)
+    latency_ms = db.Column(db.Integer, nullable=True)
+    retries = db.Column(db.Integer, default=0, nullable=False)
+    # 'json', 'repaired' (valid after local fixes), 'fallback_text', 'parse_error', 'error', or
+    # 'stale' (result discarded because the CAPA changed during the call)
+    outcome = db.Column(db.String(20), nullable=False)
+    error_message = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class IdempotencyKey(db.Model):
+    """A form submission already received, so a double-submitted form is processed once."""
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False)
+    # The endpoint the form was posted to; the forms of one page share a key
+    endpoint = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('key', 'endpoint', name='uq_idempotency_keys_key_endpoint'),)
+
+
+class AIJob(db.Model):
+    """An AI generation job of the scheduler in ai_scheduler.py, so it can be inspected and cancelled."""
+    __tablename__ = 'ai_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    # 'rca' or 'action_plan'
+    stage = db.Column(db.String(50), nullable=False)
+    # 'interactive', 'background' or 'bulk'
+    priority = db.Column(db.String(20), nullable=False)
+    capa_id = db.Column(db.Integer, db.ForeignKey('capa_issues.capa_id', ondelete='SET NULL'), nullable=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=True)
+    # 'queued', 'running', 'done', 'failed' or 'cancelled'
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    # host:pid of the process whose scheduler holds the job
+    worker = db.Column(db.String(100), nullable=False)
+    error_message = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_ai_jobs_status_priority', 'status', 'priority'),)
+
+
 class Company(db.Model):
     __tablename__ = 'companies'
     id = db.Column(db.Integer, primary_key=True)
@@ -246,3 +360,25 @@ class User(UserMixin, db.Model):
     @property
     def is_super_admin(self):
         return self.role == 'super_admin'
+
+
+# --- Loader Profiles ---
+# Each page loads exactly the relationships its template renders, so rendering never
+# triggers lazy loads. One-to-one / many-to-one relationships are joined into the main
+# SELECT; collections use selectinload (one extra SELECT) so they do not multiply rows.
+
+CAPA_LOADER_PROFILES = {
+    # CAPA list: only the creator's name is shown per card
+    'list': (
+        db.joinedload(CapaIssue.creator),
+    ),
+    # view_capa page and the PDF report: every stage of the CAPA
+    'detail': (
+        db.joinedload(CapaIssue.creator),
+        db.joinedload(CapaIssue.gemba_investigation),
+        db.joinedload(CapaIssue.root_cause),
+        db.joinedload(CapaIssue.action_plan),
+        db.selectinload(CapaIssue.evidence),
+    ),
+}
+CAPA_LOADER_PROFILES['report'] = CAPA_LOADER_PROFILES['detail']
@@ -0,0 +1,229 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from waitress import wasyncore
+from waitress.server import create_server
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# --- Pre-fork multi-process Waitress server (POSIX only) ---
+# The master process imports the app once, including the SentenceTransformer model,
+# opens the listening socket and forks the workers. The model weights are therefore
+# shared copy-on-write instead of being loaded N times. Each worker runs its own Waitress
+# server (own thread pool, own GIL) on the shared socket and opens its own database
+# connection pool. The master restarts workers that die, replaces them one by one on
+# SIGHUP (graceful restart) and drains them all on SIGTERM / SIGINT.
+#
+# Workers are forked from the already-imported app, so a SIGHUP restart does not pick
+# up code changes; restart the master for a deploy.
+
+POLL_INTERVAL_SECONDS = 0.5
+DRAIN_POLL_SECONDS = 0.2
+# A worker that dies sooner than this after starting is restarted with a delay,
+# so a worker that crashes on startup does not turn into a fork loop
+MIN_WORKER_LIFETIME_SECONDS = 10
+RESPAWN_DELAY_SECONDS = 2
+
+
+# --- Worker side ---
+
+def _close_idle_channels(server):
+    for channel in list(server.active_channels.values()):
+        if not channel.requests and not channel.total_outbufs_len:
+            channel.will_close = True
+
+
+def _close_everything(server):
+    for channel in list(server.active_channels.values()):
+        channel.handle_close()
+    # With the map empty, the server's asyncore loop returns
+    server.trigger.close()
+
+
+def _drain(server, graceful_timeout):
+    """Stop accepting, let in-flight requests finish, then close every connection.
+
+    Runs in its own thread; all changes to the server are handed to the event loop
+    through its trigger, since Waitress' socket map is not thread-safe.
+    """
+    # Only this process' copy of the listening socket is closed; the other workers keep serving
+    server.trigger.pull_trigger(lambda: wasyncore.dispatcher.close(server))
+    deadline = time.monotonic() + graceful_timeout
+    while server.active_channels and time.monotonic() < deadline:
+        server.trigger.pull_trigger(lambda: _close_idle_channels(server))
+        time.sleep(DRAIN_POLL_SECONDS)
+    if server.active_channels:
+        logger.warning("Worker %s: closing %d connection(s) still busy after %s s",
+                       os.getpid(), len(server.active_channels), graceful_timeout)
+    server.trigger.pull_trigger(lambda: _close_everything(server))
+
+
+def _setup_worker(app, workers):
+    # Pooled connections inherited from the master must not be shared between processes
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Split the CPU between the workers' embedding computations instead of each using every core
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def _run_worker(app, sock, threads, workers, graceful_timeout):
+    # Ctrl+C and terminal hang-ups reach the whole process group; the master decides what to do
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    _setup_worker(app, workers)
+
+    server = create_server(app, sockets=[sock], threads=threads)
+    draining = threading.Event()
+
+    def handle_sigterm(signum, frame):
+        if not draining.is_set():
+            draining.set()
+            threading.Thread(target=_drain, args=(server, graceful_timeout),
+                             name='drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logger.info("Worker %s serving with %d threads", os.getpid(), threads)
+    server.run()
+    server.task_dispatcher.shutdown(cancel_pending=True, timeout=5)
+    logger.info("Worker %s stopped", os.getpid())
+
+
+# --- Master side ---
+
+class PreforkServer:
+    """Supervises `workers` forked Waitress processes sharing one listening socket."""
+
+    def __init__(self, app, host, port, workers, threads, graceful_timeout):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.children = {}  # pid -> start time (monotonic)
+        self.sock = None
+        self._stopping = False
+        self._restart_requested = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                _run_worker(self.app, self.sock, self.threads, self.workers, self.graceful_timeout)
+            except Exception:
+                logger.exception("Worker %s crashed", os.getpid())
+                exit_code = 1
+            finally:
+                # Never fall back into the master's code in the child
+                logging.shutdown()
+                os._exit(exit_code)
+        self.children[pid] = time.monotonic()
+        logger.info("Started worker %s (%d running)", pid, len(self.children))
+        return pid
+
+    def reap_workers(self):
+        """Collect exited workers; returns {pid: lifetime_seconds}."""
+        exited = {}
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            started = self.children.pop(pid, None)
+            if started is not None:
+                exited[pid] = time.monotonic() - started
+                if not self._stopping:
+                    logger.log(logging.INFO if os.waitstatus_to_exitcode(status) == 0 else logging.ERROR,
+                               "Worker %s exited with status %s", pid, os.waitstatus_to_exitcode(status))
+        return exited
+
+    def wait_for_exit(self, pids, timeout):
+        deadline = time.monotonic() + timeout
+        while any(pid in self.children for pid in pids) and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(DRAIN_POLL_SECONDS)
+        return [pid for pid in pids if pid in self.children]
+
+    def restart_workers(self):
+        """Graceful restart: replace the workers one at a time so capacity never drops."""
+        logger.info("Graceful restart of %d workers", len(self.children))
+        for old_pid in list(self.children):
+            if self._stopping:
+                return
+            self.spawn_worker()
+            os.kill(old_pid, signal.SIGTERM)
+            if self.wait_for_exit([old_pid], self.graceful_timeout + 5):
+                logger.warning("Worker %s did not stop in time; killing it", old_pid)
+                os.kill(old_pid, signal.SIGKILL)
+                self.wait_for_exit([old_pid], 5)
+
+    def stop_workers(self):
+        pids = list(self.children)
+        logger.info("Stopping %d workers (waiting up to %s s for in-flight requests)",
+                    len(pids), self.graceful_timeout)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in self.wait_for_exit(pids, self.graceful_timeout + 5):
+            logger.warning("Worker %s did not stop in time; killing it", pid)
+            os.kill(pid, signal.SIGKILL)
+        self.wait_for_exit(pids, 5)
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self._restart_requested = True
+
+    def run(self):
+        self.sock = socket.create_server((self.host, self.port), backlog=1024)
+        # The master serves no requests; its pool must not hand inherited connections to workers
+        with self.app.app_context():
+            db.engine.dispose()
+        # Keep the garbage collector from touching (and so copying) the imported objects in the workers
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        logger.info("Master %s serving on http://%s:%s with %d workers x %d threads "
+                    "(SIGHUP: graceful restart, SIGTERM: shutdown)",
+                    os.getpid(), self.host, self.port, self.workers, self.threads)
+        for _ in range(self.workers):
+            self.spawn_worker()
+
+        try:
+            while not self._stopping:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                for pid, lifetime in self.reap_workers().items():
+                    if self._stopping:
+                        break
+                    if lifetime < MIN_WORKER_LIFETIME_SECONDS:
+                        logger.error("Worker %s died %.1f s after starting; restarting in %s s",
+                                     pid, lifetime, RESPAWN_DELAY_SECONDS)
+                        time.sleep(RESPAWN_DELAY_SECONDS)
+                    self.spawn_worker()
+                if self._restart_requested:
+                    self._restart_requested = False
+                    self.restart_workers()
+        finally:
+            self.stop_workers()
+            self.sock.close()
+            logger.info("Master %s stopped", os.getpid())
+
+
+def serve_prefork(app, host, port, workers, threads, graceful_timeout=60):
+    PreforkServer(app, host, port, workers, threads, graceful_timeout).run()
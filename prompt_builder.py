@@ -0,0 +1,185 @@
+import logging
+import re
+from collections import namedtuple
+
+from config import (
+    PROMPT_DEDUPE_SIMILARITY,
+    PROMPT_MAX_TOKENS,
+    PROMPT_SNIPPET_LINE_MAX_TOKENS,
+    PROMPT_SNIPPET_MAX_TOKENS
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Token-budgeted prompt assembly ---
+# The RCA and action-plan prompts end with "learning examples" taken from the knowledge
+# base. Those snippets are ordered by relevance, near-identical ones are dropped, each is
+# trimmed to a budget and they are added only while the whole prompt stays below
+# PROMPT_MAX_TOKENS, so long or numerous past CAPAs cannot blow up Gemini latency and
+# cost. Tokens are estimated at ~4 characters per token (the same estimate as
+# fake_llm.py); the real counts end up in ai_call_logs.prompt_tokens.
+
+CHARS_PER_TOKEN = 4
+ELLIPSIS = '...'
+
+# One knowledge example. `score` orders the snippets (higher first; None keeps the
+# retrieval order), `lines` are the rendered lines below the title and `dedupe_text` is
+# what near-duplicates are detected on (the WHYs or actions, not the description).
+KnowledgeSnippet = namedtuple('KnowledgeSnippet', ['source_capa_id', 'score', 'lines', 'dedupe_text'])
+
+
+# Version of the snippets pre-rendered into AIKnowledgeBase.prompt_snippets_json. Bump it
+# when the rendering below changes: older snippets are then rendered on the fly until
+# backfill_knowledge.py has refreshed them.
+PROMPT_SNIPPET_VERSION = 1
+
+
+def render_rca_snippet(issue_description, machine_name, whys):
+    """Lines and dedupe text of an RCA learning example, or None without WHYs."""
+    if not whys:
+        return None
+    lines = [
+        "Konteks Masalah Sebelumnya:",
+        f"  Deskripsi: {issue_description or 'Tidak tersedia'}",
+        f"  Mesin: {machine_name or 'Tidak tersedia'}",
+        "Pembelajaran RCA (5 Whys yang disesuaikan pengguna):",
+    ]
+    lines.extend(f"  Why {idx}: {why_text}" for idx, why_text in enumerate(whys, 1))
+    return {'lines': lines, 'dedupe_text': ' '.join(whys)}
+
+
+def render_action_plan_snippet(issue_description, machine_name, temp_actions, prev_actions):
+    """Lines and dedupe text of an action-plan learning example, or None without actions."""
+    if not temp_actions and not prev_actions:
+        return None
+    lines = [
+        "Konteks Masalah Sebelumnya:",
+        f"  Deskripsi: {issue_description or 'Tidak tersedia'}",
+        f"  Mesin: {machine_name or 'Tidak tersedia'}",
+        "Tindakan Sementara yang telah disesuaikan pengguna sebelumnya:",
+    ]
+    lines.extend([f"  {j}. {action_text}" for j, action_text in enumerate(temp_actions, 1)]
+                 or ["  (Tidak ada tindakan sementara yang tersimpan)"])
+    lines.append("Tindakan Pencegahan yang telah disesuaikan pengguna sebelumnya:")
+    lines.extend([f"  {j}. {action_text}" for j, action_text in enumerate(prev_actions, 1)]
+                 or ["  (Tidak ada tindakan pencegahan yang tersimpan)"])
+    return {'lines': lines, 'dedupe_text': ' '.join(list(temp_actions) + list(prev_actions))}
+
+
+def render_knowledge_snippets(issue_description, machine_name, whys, temp_actions, prev_actions):
+    """The value stored in AIKnowledgeBase.prompt_snippets_json."""
+    return {
+        'version': PROMPT_SNIPPET_VERSION,
+        'rca': render_rca_snippet(issue_description, machine_name, whys),
+        'action_plan': render_action_plan_snippet(issue_description, machine_name, temp_actions, prev_actions),
+    }
+
+
+def stored_snippet(prompt_snippets, kind):
+    """The pre-rendered 'rca' / 'action_plan' snippet of an entry, or None if missing or outdated."""
+    if not prompt_snippets or prompt_snippets.get('version') != PROMPT_SNIPPET_VERSION:
+        return None
+    return prompt_snippets.get(kind)
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def trim_text(text, max_tokens):
+    """`text` cut at a word boundary so it fits in `max_tokens` (with an ellipsis if cut)."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars - len(ELLIPSIS)]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip(' ,.;:') + ELLIPSIS
+
+
+def _words(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def _is_near_duplicate(words, kept_word_sets, threshold):
+    for kept in kept_word_sets:
+        union = words | kept
+        if union and len(words & kept) / len(union) >= threshold:
+            return True
+    return False
+
+
+def _render(title, lines, indent):
+    return ''.join(f"{indent}{line}\n" for line in [title] + lines) + "\n"
+
+
+def _trim_snippet(lines, max_tokens, line_max_tokens, indent):
+    lines = [trim_text(line, line_max_tokens) for line in lines]
+    if estimate_tokens(_render('', lines, indent)) <= max_tokens:
+        return lines
+    # Drop trailing lines until the snippet, marked as cut, fits
+    while len(lines) > 1 and estimate_tokens(_render('', lines + [ELLIPSIS], indent)) > max_tokens:
+        lines = lines[:-1]
+    return lines + [ELLIPSIS]
+
+
+def build_knowledge_section(snippets, title_format, token_budget,
+                            snippet_max_tokens=PROMPT_SNIPPET_MAX_TOKENS,
+                            line_max_tokens=PROMPT_SNIPPET_LINE_MAX_TOKENS,
+                            dedupe_similarity=PROMPT_DEDUPE_SIMILARITY,
+                            indent='    '):
+    """Render the most relevant snippets that fit in `token_budget`.
+
+    `title_format` is formatted with `number` and `source_capa_id` for each snippet.
+    Returns (text, used_snippets).
+    """
+    ordered = list(snippets)
+    if ordered and all(snippet.score is not None for snippet in ordered):
+        ordered.sort(key=lambda snippet: snippet.score, reverse=True)
+
+    parts = []
+    used = []
+    kept_word_sets = []
+    remaining = token_budget
+    skipped_duplicates = skipped_budget = 0
+    for snippet in ordered:
+        words = _words(snippet.dedupe_text)
+        if _is_near_duplicate(words, kept_word_sets, dedupe_similarity):
+            skipped_duplicates += 1
+            continue
+        title = title_format.format(number=len(used) + 1, source_capa_id=snippet.source_capa_id)
+        text = _render(title, _trim_snippet(snippet.lines, snippet_max_tokens, line_max_tokens, indent), indent)
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            # A shorter, less relevant snippet may still fit
+            skipped_budget += 1
+            continue
+        parts.append(text)
+        used.append(snippet)
+        kept_word_sets.append(words)
+        remaining -= tokens
+
+    if skipped_duplicates or skipped_budget:
+        logger.info("Knowledge snippets: %d used, %d near-duplicates dropped, %d over the token budget",
+                    len(used), skipped_duplicates, skipped_budget)
+    return ''.join(parts), used
+
+
+def assemble_prompt(head, knowledge_intro, snippets, title_format, tail, no_knowledge_text='',
+                    max_tokens=PROMPT_MAX_TOKENS):
+    """The full prompt: `head`, the knowledge section (or `no_knowledge_text`) and `tail`.
+
+    The knowledge section gets whatever is left of `max_tokens` after the fixed parts.
+    Returns (prompt, used_snippets).
+    """
+    fixed_tokens = estimate_tokens(head + knowledge_intro + tail)
+    budget = max_tokens - fixed_tokens
+    if budget <= 0:
+        logger.warning("Prompt without knowledge is already %d tokens (ceiling %d); no examples added",
+                       fixed_tokens, max_tokens)
+    section, used = build_knowledge_section(snippets, title_format, budget) if budget > 0 else ('', [])
+    knowledge = knowledge_intro + section if used else no_knowledge_text
+    prompt = head + knowledge + tail
+    logger.debug("Prompt of ~%d tokens with %d of %d knowledge snippets",
+                 estimate_tokens(prompt), len(used), len(snippets))
+    return prompt, used
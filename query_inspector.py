@@ -0,0 +1,168 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, jsonify, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import (
+    QUERY_INSPECTOR_ENABLED,
+    QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD,
+    QUERY_INSPECTOR_SLOW_QUERY_MS
+)
+from metrics import require_metrics_access
+
+logger = logging.getLogger(__name__)
+
+# --- Slow-query and N+1 detector (development / staging only) ---
+# When QUERY_INSPECTOR_ENABLED is set, every SQL statement executed during a request
+# is recorded together with the line of application code that triggered it. At the
+# end of the request, statements repeated QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD times
+# or more are reported as likely N+1 patterns, and statements slower than
+# QUERY_INSPECTOR_SLOW_QUERY_MS are logged as they happen. Per-endpoint totals are
+# kept in memory and served as JSON at /_debug/queries (to logged-in users, or with the
+# same access rules as /metrics); DELETE resets them.
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_THIS_FILE = os.path.abspath(__file__)
+
+
+def _call_site():
+    """Return 'file.py:line in function' for the innermost frame in this project's own code."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (filename.startswith(_PROJECT_DIR) and filename != _THIS_FILE
+                and 'site-packages' not in filename and os.sep + 'templates' + os.sep not in filename):
+            return f"{os.path.relpath(filename, _PROJECT_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+def _short(statement, length=200):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= length else statement[:length] + '...'
+
+
+class EndpointReport:
+    """Running totals of the queries issued by one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.query_time = 0.0
+        self.slow_queries = 0
+        self.n_plus_one = Counter()  # (statement, call site) -> requests where it repeated
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'avg_queries': round(self.queries / self.requests, 2) if self.requests else 0,
+            'max_queries': self.max_queries,
+            'avg_query_ms': round(self.query_time * 1000 / self.requests, 2) if self.requests else 0,
+            'slow_queries': self.slow_queries,
+            'n_plus_one': [
+                {'statement': statement, 'call_site': call_site, 'requests': count}
+                for (statement, call_site), count in self.n_plus_one.most_common()
+            ],
+        }
+
+
+_reports = {}
+_reports_lock = threading.Lock()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inspector_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('inspector_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if not has_request_context() or 'inspector_queries' not in g:
+        return
+    call_site = _call_site()
+    g.inspector_queries.append((statement, call_site, elapsed))
+    if elapsed * 1000 >= QUERY_INSPECTOR_SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms) in %s at %s: %s",
+                       elapsed * 1000, request.endpoint, call_site, _short(statement))
+
+
+def _finish_request(exc=None):
+    queries = g.pop('inspector_queries', None)
+    if queries is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+
+    repeated = Counter((statement, call_site) for statement, call_site, _ in queries)
+    n_plus_one = [(key, count) for key, count in repeated.items()
+                  if count >= QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD]
+    for (statement, call_site), count in n_plus_one:
+        logger.warning("Possible N+1 in %s: %d identical queries from %s: %s",
+                       endpoint, count, call_site, _short(statement))
+
+    total_time = sum(elapsed for _, _, elapsed in queries)
+    slow = sum(1 for _, _, elapsed in queries if elapsed * 1000 >= QUERY_INSPECTOR_SLOW_QUERY_MS)
+    with _reports_lock:
+        report = _reports.setdefault(endpoint, EndpointReport())
+        report.requests += 1
+        report.queries += len(queries)
+        report.max_queries = max(report.max_queries, len(queries))
+        report.query_time += total_time
+        report.slow_queries += slow
+        for key, _ in n_plus_one:
+            report.n_plus_one[key] += 1
+    logger.debug("%s %s: %d queries in %.1f ms", request.method, request.path, len(queries), total_time * 1000)
+
+
+def get_report():
+    """Per-endpoint query report, worst offenders (most queries per request) first."""
+    with _reports_lock:
+        items = [(endpoint, report.as_dict()) for endpoint, report in _reports.items()]
+    items.sort(key=lambda item: item[1]['max_queries'], reverse=True)
+    return dict(items)
+
+
+def reset_report():
+    with _reports_lock:
+        _reports.clear()
+
+
+def init_query_inspector(app):
+    """Install the detector on `app` when QUERY_INSPECTOR_ENABLED is set; otherwise do nothing."""
+    if not QUERY_INSPECTOR_ENABLED:
+        return
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_query_recording():
+        g.inspector_queries = []
+
+    app.teardown_request(_finish_request)
+
+    @app.route('/_debug/queries', methods=['GET', 'DELETE'])
+    def query_report():
+        if not current_user.is_authenticated:
+            require_metrics_access()
+        if request.method == 'DELETE':
+            reset_report()
+        return jsonify(get_report())
+
+    # DELETE is called from scripts (curl) without a CSRF token; browsers cannot send a
+    # cross-site DELETE without a CORS preflight, which this app never allows
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(query_report)
+
+    logger.warning("Query inspector enabled (slow query threshold %s ms, N+1 threshold %s). "
+                   "Do not enable it in production.",
+                   QUERY_INSPECTOR_SLOW_QUERY_MS, QUERY_INSPECTOR_N_PLUS_ONE_THRESHOLD)
@@ -1,6 +1,6 @@
 # Standard Library
 import calendar
-import json
+import hashlib
 import os
 from datetime import date, datetime, timedelta
 from pathlib import Path
@@ -31,7 +31,8 @@ from flask_login import (
 )
 from flask_mail import Message
 from flask_wtf import FlaskForm, CSRFProtect
-from sqlalchemy import distinct
+from sqlalchemy import text
+from sqlalchemy.orm.attributes import flag_modified
 from werkzeug.utils import secure_filename
 from wtforms import (
     PasswordField,
@@ -48,16 +49,25 @@ from wtforms.validators import (
 )
 
 # Local Application Imports
-from ai_learning import store_knowledge_on_capa_close
+from ai_learning import capa_whys_embedding, embedding_model, prefetch_rca_knowledge, store_knowledge_on_capa_close
 from ai_service import (
+    llm_client,
     trigger_action_plan_recommendation,
     trigger_rca_analysis
 )
-from config import UPLOAD_FOLDER
+from caches import autocomplete_indexes, get_companies, get_company
+from company_context import (
+    ALL_COMPANIES,
+    ALL_COMPANIES_NAME,
+    get_company_context,
+    reset_company_context
+)
+from config import AUTOCOMPLETE_MAX_AGE_SECONDS, AUTOCOMPLETE_MAX_LIMIT, UPLOAD_FOLDER
+from idempotency import claim_submission, idempotency_key_field, release_submission
+from metrics import span
 from models import (
     AIKnowledgeBase,
     CapaIssue,
-    Company,
     db,
     Evidence,
     GembaInvestigation,
@@ -68,73 +78,17 @@ from utils import allowed_file
 # Define your local timezone
 LOCAL_TIMEZONE = pytz.timezone('Asia/Jakarta')  # Or your specific timezone for +07:00
 
+DUPLICATE_SUBMISSION_MESSAGE = 'Formulir ini sudah dikirim sebelumnya; pengiriman ganda diabaikan.'
+
 class CSRFOnlyForm(FlaskForm):
-    pass
+    # Lets the routes that start AI work ignore a double-submitted form (see idempotency.py)
+    idempotency_key = idempotency_key_field()
 
 def register_routes(app):
 
     @app.context_processor
     def inject_company_context():
-        available_companies = []
-        selected_company_id = None
-        selected_company_name = "All Companies" # Default for super_user if nothing is selected
-
-        if current_user.is_authenticated:
-            if current_user.role == 'super_admin':
-                available_companies = Company.query.order_by(Company.name).all()
-                # Try to get selected company from session
-                session_company_id = session.get('selected_company_id')
-                if session_company_id and session_company_id != 'all':
-                    company = Company.query.get(session_company_id)
-                    if company:
-                        selected_company_id = company.id
-                        selected_company_name = company.name
-                elif session_company_id == 'all':
-                    selected_company_id = 'all'
-                    selected_company_name = "All Companies"
-                # If nothing in session for super_admin, default to their own company or 'All Companies'
-                elif current_user.company_id: # Super admin has an assigned company
-                    company = Company.query.get(current_user.company_id)
-                    if company:
-                        session['selected_company_id'] = current_user.company_id
-                        session['selected_company_name'] = company.name
-                        selected_company_id = current_user.company_id
-                        selected_company_name = company.name
-                    else: # Assigned company not found, default to 'all'
-                        session['selected_company_id'] = 'all'
-                        session['selected_company_name'] = "All Companies"
-                        selected_company_id = 'all'
-                        selected_company_name = "All Companies"
-                        app.logger.warning(f"Super admin {current_user.username} assigned company ID {current_user.company_id} not found during context injection. Defaulting to 'All Companies'.")
-                else: # Super user not tied to a company, defaults to all
-                    session['selected_company_id'] = 'all'
-                    session['selected_company_name'] = "All Companies"
-                    selected_company_id = 'all'
-                    selected_company_name = "All Companies"
-
-            else: # Regular user
-                if current_user.company_id:
-                    company = Company.query.get(current_user.company_id)
-                    if company:
-                        available_companies = [company] # Only their own company
-                        selected_company_id = company.id
-                        selected_company_name = company.name
-                        session['selected_company_id'] = company.id
-                        session['selected_company_name'] = company.name
-                    else:
-                        # Should not happen if data is consistent
-                        flash('Error: Your assigned company is not found. Please contact support.', 'danger')
-                        selected_company_name = "Error: Company Not Found"
-                else:
-                    # User not assigned to any company - critical issue
-                    flash('Critical Error: You are not assigned to any company. Please contact support.', 'danger')
-                    selected_company_name = "Error: No Company Assigned"
-        
-        return dict(
-            available_companies=available_companies, 
-            selected_company_id=selected_company_id,
-            selected_company_name=selected_company_name
-        )
+        return get_company_context().as_template_context()
 
 
     class RequestPasswordResetForm(FlaskForm):
@@ -169,6 +123,24 @@ def register_routes(app):
         password = PasswordField('Password', validators=[DataRequired()])
         submit = SubmitField('Login')
 
+    @app.route('/healthz')
+    def healthz():
+        # Probe for load balancers and monitoring; no login required
+        checks = {'pid': os.getpid()}
+        try:
+            db.session.execute(text('SELECT 1'))
+            checks['database'] = 'ok'
+        except Exception as e:
+            app.logger.error("Health check database query failed: %s", e)
+            checks['database'] = 'error'
+        # AI features fall back when unavailable, so they are reported but do not fail the check
+        checks['embedding_model'] = 'loaded' if embedding_model is not None else 'unavailable'
+        checks['llm'] = llm_client.model_name if llm_client.is_available else 'unavailable'
+        checks['status'] = 'ok' if checks['database'] == 'ok' else 'error'
+        response = jsonify(checks)
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200 if checks['status'] == 'ok' else 503
+
     @app.route('/login', methods=['GET', 'POST'])
     def login():
         if current_user.is_authenticated:
@@ -182,20 +154,20 @@ def register_routes(app):
                 # Set initial company context in session after login
                 if user.role == 'super_admin':
                     if user.company_id:
-                        company = Company.query.get(user.company_id)
+                        company = get_company(user.company_id)
                         if company: # Ensure company exists
                             session['selected_company_id'] = user.company_id
                             session['selected_company_name'] = company.name
                         else: # Super admin's assigned company not found, default to 'all'
-                            session['selected_company_id'] = 'all'
-                            session['selected_company_name'] = "All Companies"
-                            app.logger.warning(f"Super admin {user.username} assigned company ID {user.company_id} not found. Defaulting to 'All Companies'.")
+                            session['selected_company_id'] = ALL_COMPANIES
+                            session['selected_company_name'] = ALL_COMPANIES_NAME
+                            app.logger.warning("Super admin %s assigned company ID %s not found. Defaulting to 'All Companies'.", user.username, user.company_id)
                     else: # Super admin not tied to a specific company
-                        session['selected_company_id'] = 'all'
-                        session['selected_company_name'] = "All Companies"
+                        session['selected_company_id'] = ALL_COMPANIES
+                        session['selected_company_name'] = ALL_COMPANIES_NAME
                 else: # Regular user
                     if user.company_id:
-                        company = Company.query.get(user.company_id)
+                        company = get_company(user.company_id)
                         if company: # Ensure company exists
                             session['selected_company_id'] = user.company_id
                             session['selected_company_name'] = company.name
@@ -203,13 +175,14 @@ def register_routes(app):
                             session.pop('selected_company_id', None)
                             session.pop('selected_company_name', None)
                             flash('Error: Your assigned company could not be loaded. Please contact support.', 'danger')
-                            app.logger.error(f"User {user.username} assigned company ID {user.company_id} not found.")
+                            app.logger.error("User %s assigned company ID %s not found.", user.username, user.company_id)
                     else: # Regular user without a company_id - data integrity issue
                         session.pop('selected_company_id', None)
                         session.pop('selected_company_name', None)
                         flash('Critical Error: You are not assigned to a company. Please contact support.', 'danger')
-                        app.logger.error(f"User {user.username} has no company_id assigned.")
-                
+                        app.logger.error("User %s has no company_id assigned.", user.username)
+                reset_company_context()
+
                 flash('Logged in successfully!', 'success')
                 next_page = request.args.get('next')
                 return redirect(next_page or url_for('index'))
@@ -227,9 +200,8 @@ def register_routes(app):
         form = RegistrationForm()
         # Populate company choices - ensuring it's done before validation if needed, or on GET
         form.company_id.choices = [
-            (c.id, c.name) for c in Company.query.filter(
-                Company.name.notin_(['Sansico Group (all company combine)', 'Unassigned'])
-            ).order_by(Company.name).all()
+            (c.id, c.name) for c in get_companies()
+            if c.name not in ('Sansico Group (all company combine)', 'Unassigned')
         ]
         if not form.company_id.choices:
              flash('No companies available for registration. Please contact an administrator.', 'warning')
@@ -250,12 +222,12 @@ def register_routes(app):
                 return redirect(url_for('login'))
             except Exception as e:
                 db.session.rollback()
-                app.logger.error(f"Error during registration: {e}")
+                app.logger.error("Error during registration: %s", e)
                 flash('An error occurred during registration. Please try again.', 'danger')
         else:
             # Log validation errors for debugging if POST request fails validation
             if request.method == 'POST':
-                app.logger.warning(f"Registration form validation errors: {form.errors}")
+                app.logger.warning("Registration form validation errors: %s", form.errors)
 
         return render_template('register.html', title='Register', form=form)
 
@@ -274,17 +246,17 @@ def register_routes(app):
         msg.html = render_template('reset_email.html', user=user, token=token)
         try:
             # Print mail configuration for debugging
-            print(f"Mail Server: {current_app.config['MAIL_SERVER']}")
-            print(f"Mail Port: {current_app.config['MAIL_PORT']}")
-            print(f"Mail Use TLS: {current_app.config['MAIL_USE_TLS']}")
-            print(f"Mail Username: {current_app.config['MAIL_USERNAME']}")
-            print(f"Mail Default Sender: {current_app.config['MAIL_DEFAULT_SENDER']}")
+            app.logger.debug("Mail Server: %s", current_app.config['MAIL_SERVER'])
+            app.logger.debug("Mail Port: %s", current_app.config['MAIL_PORT'])
+            app.logger.debug("Mail Use TLS: %s", current_app.config['MAIL_USE_TLS'])
+            app.logger.debug("Mail Username: %s", current_app.config['MAIL_USERNAME'])
+            app.logger.debug("Mail Default Sender: %s", current_app.config['MAIL_DEFAULT_SENDER'])
             
             # Try to send the email
             current_app.extensions['mail'].send(msg)
             return True
         except Exception as e:
-            current_app.logger.error(f"Error sending password reset email: {e}")
+            current_app.logger.error("Error sending password reset email: %s", e)
             # More detailed error printing
             import traceback
             traceback.print_exc()
@@ -338,14 +310,14 @@ def register_routes(app):
 
         selected_id = request.form.get('company_id')
         
-        if selected_id == 'all':
-            session['selected_company_id'] = 'all'
-            session['selected_company_name'] = "All Companies"
+        if selected_id == ALL_COMPANIES:
+            session['selected_company_id'] = ALL_COMPANIES
+            session['selected_company_name'] = ALL_COMPANIES_NAME
             flash('Viewing data for All Companies.', 'info')
         else:
             try:
                 company_id_int = int(selected_id)
-                company = Company.query.get(company_id_int)
+                company = get_company(company_id_int)
                 if company:
                     session['selected_company_id'] = company.id
                     session['selected_company_name'] = company.name
@@ -354,40 +326,19 @@ def register_routes(app):
                     flash('Invalid company selected.', 'danger')
             except ValueError:
                 flash('Invalid company ID format.', 'danger')
-        
+
+        reset_company_context()
         return redirect(request.referrer or url_for('index'))
 
 
     @app.route('/dashboard/data')
     @login_required
     def dashboard_data():
-        s_company_id = session.get('selected_company_id')
-        capa_issue_query = CapaIssue.query.filter(CapaIssue.is_deleted == False)
-        ai_kb_query = AIKnowledgeBase.query # Assuming you might want to filter this too
-
-        if current_user.role == 'super_admin' and s_company_id == 'all':
-            pass # No company filter for super_admin viewing all
-        elif s_company_id is not None and s_company_id != 'all':
-            try:
-                company_id_int = int(s_company_id)
-                capa_issue_query = capa_issue_query.filter(CapaIssue.company_id == company_id_int)
-                ai_kb_query = ai_kb_query.filter(AIKnowledgeBase.company_id == company_id_int)
-            except ValueError:
-                app.logger.error(f"Invalid company_id '{s_company_id}' in session for dashboard_data for user {current_user.username}.")
-                capa_issue_query = capa_issue_query.filter(CapaIssue.company_id == -1)
-                ai_kb_query = ai_kb_query.filter(AIKnowledgeBase.company_id == -1)
-        elif current_user.role != 'super_admin' and s_company_id is None:
-            app.logger.warning(f"User {current_user.username} (role: {current_user.role}) has no selected_company_id in session for dashboard_data.")
-            capa_issue_query = capa_issue_query.filter(CapaIssue.company_id == -1)
-            ai_kb_query = ai_kb_query.filter(AIKnowledgeBase.company_id == -1)
-        elif current_user.role == 'super_admin' and s_company_id is None:
-            app.logger.warning(f"Super admin {current_user.username} has no selected_company_id in session for dashboard_data. Defaulting to all.")
-            # No filter, effectively 'all'
-            pass 
-        else:
-            app.logger.error(f"Unexpected company session state for dashboard_data user {current_user.username}, role {current_user.role}, session company ID {s_company_id}.")
-            capa_issue_query = capa_issue_query.filter(CapaIssue.company_id == -1)
-            ai_kb_query = ai_kb_query.filter(AIKnowledgeBase.company_id == -1)
+        company_context = get_company_context()
+        capa_issue_query = company_context.apply_filter(
+            CapaIssue.query.filter(CapaIssue.is_deleted == False), CapaIssue.company_id)
+        ai_kb_query = company_context.apply_filter(
+            AIKnowledgeBase.query, AIKnowledgeBase.company_id)  # Assuming you might want to filter this too
 
         # The capa_issue_query and ai_kb_query are already filtered by company context at the beginning of this function.
         # We will use capa_issue_query for all CapaIssue related aggregations.
@@ -400,7 +351,9 @@ def register_routes(app):
             filter_type = request.args.get('filter_type')
             time_range = request.args.get('range') # For predefined/default
 
-            print(f"Dashboard data request: filter_type='{filter_type}', range='{time_range}', year='{request.args.get('year')}', month='{request.args.get('month')}', week='{request.args.get('week')}', start_date='{request.args.get('start_date')}', end_date='{request.args.get('end_date')}'")
+            app.logger.debug("Dashboard data request: filter_type='%s', range='%s', year='%s', month='%s', week='%s', start_date='%s', end_date='%s'",
+                             filter_type, time_range, request.args.get('year'), request.args.get('month'),
+                             request.args.get('week'), request.args.get('start_date'), request.args.get('end_date'))
 
             if filter_type == 'custom':
                 start_date_str = request.args.get('start_date')
@@ -409,12 +362,12 @@ def register_routes(app):
                     try:
                         from_date_obj = datetime.strptime(start_date_str, '%Y-%m-%d').date()
                     except ValueError:
-                        app.logger.warning(f"Invalid start_date format: {start_date_str}")
+                        app.logger.warning("Invalid start_date format: %s", start_date_str)
                 if end_date_str:
                     try:
                         to_date_obj = datetime.strptime(end_date_str, '%Y-%m-%d').date()
                     except ValueError:
-                        app.logger.warning(f"Invalid end_date format: {end_date_str}")
+                        app.logger.warning("Invalid end_date format: %s", end_date_str)
             elif filter_type == 'ymw': # RESTORED BLOCK
                 year_str = request.args.get('year')
                 month_str = request.args.get('month') # Can be 'all' or number
@@ -436,21 +389,21 @@ def register_routes(app):
                                         from_date_obj = date(year, month, start_day_of_week)
                                         to_date_obj = date(year, month, min(end_day_of_week, num_days_in_month))
                                     else:
-                                        app.logger.warning(f"Invalid week '{week_str}' for {year}-{month}. Defaulting to whole month.")
+                                        app.logger.warning("Invalid week '%s' for %s-%s. Defaulting to whole month.", week_str, year, month)
                                         from_date_obj = date(year, month, 1)
                                         to_date_obj = date(year, month, num_days_in_month)
                                 else: # Year and Month selected, all weeks
                                     from_date_obj = date(year, month, 1)
                                     to_date_obj = date(year, month, num_days_in_month)
                             else:
-                                app.logger.warning(f"Invalid month value: {month_str}. Defaulting to whole year {year}.")
+                                app.logger.warning("Invalid month value: %s. Defaulting to whole year %s.", month_str, year)
                                 from_date_obj = date(year, 1, 1)
                                 to_date_obj = date(year, 12, 31)
                         else: # Year selected, all months
                             from_date_obj = date(year, 1, 1)
                             to_date_obj = date(year, 12, 31)
                     except ValueError:
-                        app.logger.warning(f"Invalid year/month/week format: Y='{year_str}', M='{month_str}', W='{week_str}'. No YMW filter applied.")
+                        app.logger.warning("Invalid year/month/week format: Y='%s', M='%s', W='%s'. No YMW filter applied.", year_str, month_str, week_str)
             
             elif time_range: # Handles predefined ranges
                 if time_range == '12m':
@@ -469,7 +422,7 @@ def register_routes(app):
                     from_date_obj = None
                     to_date_obj = None # No date filtering for 'all'
                 else:
-                    app.logger.warning(f"Unknown time_range: {time_range}. Defaulting to 'Last 12 Months'.")
+                    app.logger.warning("Unknown time_range: %s. Defaulting to 'Last 12 Months'.", time_range)
                     from_date_obj = today - timedelta(days=365)
                     to_date_obj = today
             else: # Default if no filter_type and no range (e.g. initial load or unexpected params)
@@ -496,42 +449,42 @@ def register_routes(app):
             status_distribution = status_query_aggregated.all()
             status_labels = [row[0] for row in status_distribution]
             status_values = [row[1] for row in status_distribution]
-            print(f"Status Distribution: {status_distribution}")
+            app.logger.debug("Status Distribution: %s", status_distribution)
 
             # --- Top Customers ---
             top_customers_query = query_after_date_filter.with_entities(CapaIssue.customer_name, db.func.count(CapaIssue.customer_name))
             top_customers = top_customers_query.group_by(CapaIssue.customer_name).order_by(db.func.count(CapaIssue.customer_name).desc()).limit(5).all()
             customer_labels = [row[0] for row in top_customers]
             customer_values = [row[1] for row in top_customers]
-            print(f"Top Customers: {top_customers}")
+            app.logger.debug("Top Customers: %s", top_customers)
 
             # --- Area Distribution ---
             area_distribution_query = query_after_date_filter.with_entities(CapaIssue.item_involved, db.func.count(CapaIssue.item_involved))
             area_distribution = area_distribution_query.group_by(CapaIssue.item_involved).order_by(db.func.count(CapaIssue.item_involved).desc()).limit(5).all()
             area_labels = [row[0] for row in area_distribution]
             area_values = [row[1] for row in area_distribution]
-            print(f"Area Distribution: {area_distribution}")
+            app.logger.debug("Area Distribution: %s", area_distribution)
 
             # --- Repeated Issues (by description/count) ---
             repeated_issues_query = query_after_date_filter.with_entities(CapaIssue.issue_description, db.func.count(CapaIssue.issue_description))
             repeated_issues = repeated_issues_query.group_by(CapaIssue.issue_description).having(db.func.count(CapaIssue.issue_description) > 1).order_by(db.func.count(CapaIssue.issue_description).desc()).limit(5).all()
             repeated_issues_labels = [row[0] for row in repeated_issues]
             repeated_issues_values = [row[1] for row in repeated_issues]
-            print(f"Repeated Issues: {repeated_issues}")
+            app.logger.debug("Repeated Issues: %s", repeated_issues)
 
             # --- Top Machines with Most Issues ---
             top_machines_query = query_after_date_filter.with_entities(CapaIssue.machine_name, db.func.count(CapaIssue.machine_name))
             top_machines = top_machines_query.group_by(CapaIssue.machine_name).order_by(db.func.count(CapaIssue.machine_name).desc()).limit(5).all()
             top_machines_labels = [row[0] for row in top_machines]
             top_machines_values = [row[1] for row in top_machines]
-            print(f"Top Machines: {top_machines}")
+            app.logger.debug("Top Machines: %s", top_machines)
 
             # --- Issue Trends Over Time (monthly) ---
             issue_trends_query = query_after_date_filter.with_entities(db.func.date_format(CapaIssue.issue_date, '%Y-%m'), db.func.count(CapaIssue.capa_id))
             issue_trends = issue_trends_query.group_by(db.func.date_format(CapaIssue.issue_date, '%Y-%m')).order_by(db.func.date_format(CapaIssue.issue_date, '%Y-%m')).all()
             issue_trends_labels = [row[0] for row in issue_trends]
             issue_trends_values = [row[1] for row in issue_trends]
-            print(f"Issue Trends: {issue_trends}")
+            app.logger.debug("Issue Trends: %s", issue_trends)
 
             return jsonify({
                 'status_distribution': {'labels': status_labels, 'values': status_values},
@@ -543,7 +496,7 @@ def register_routes(app):
             })
 
         except Exception as e:
-            print(f"Error in dashboard_data: {str(e)}")
+            app.logger.error("Error in dashboard_data: %s", e)
             return jsonify({
                 'error': str(e)
             }), 500
@@ -551,44 +504,20 @@ def register_routes(app):
     @app.route('/')
     @login_required
     def index():
-        s_company_id = session.get('selected_company_id')
-        issues_query = CapaIssue.query.filter(CapaIssue.is_deleted == False)
-
-        if current_user.role == 'super_admin' and s_company_id == 'all':
-            # Super admin viewing all companies, no company filter
-            pass
-        elif s_company_id is not None and s_company_id != 'all':
-            try:
-                company_id_int = int(s_company_id)
-                issues_query = issues_query.filter(CapaIssue.company_id == company_id_int)
-            except ValueError:
-                flash("Invalid company selection in session. Displaying no issues.", "danger")
-                app.logger.error(f"Invalid company_id '{s_company_id}' in session for user {current_user.username}.")
-                issues_query = issues_query.filter(CapaIssue.company_id == -1) # Effectively no results
-        elif current_user.role != 'super_admin' and s_company_id is None:
-            # Regular user with no company_id in session (should be set at login)
-            flash("Your company context is not set. Please re-login or contact support.", "warning")
-            app.logger.warning(f"User {current_user.username} (role: {current_user.role}) has no selected_company_id in session.")
-            issues_query = issues_query.filter(CapaIssue.company_id == -1) # Effectively no results
-        elif current_user.role == 'super_admin' and s_company_id is None:
-            # Super admin with no company_id in session (should be 'all' or a specific ID)
-            flash("Company context not fully initialized for admin. Defaulting to all companies view. Please re-select if needed.", "info")
-            app.logger.warning(f"Super admin {current_user.username} has no selected_company_id in session. Defaulting to all.")
-            # No filter, effectively 'all'
-            pass 
-        else:
-            # Fallback for any other unexpected state
-            app.logger.error(f"Unexpected company session state for user {current_user.username}, role {current_user.role}, session company ID {s_company_id}. Displaying no issues.")
-            issues_query = issues_query.filter(CapaIssue.company_id == -1) # Effectively no results
+        company_context = get_company_context()
+        issues_query = company_context.apply_filter(
+            CapaIssue.query_for('list').filter(CapaIssue.is_deleted == False), CapaIssue.company_id)
 
         # Handle search
         search_query_term = request.args.get('search_query')
         search_by = request.args.get('search_by')
         
-        current_app.logger.info(f"Index route: search_query='{search_query_term}', search_by='{search_by}', company_filter_applied_query='{str(issues_query)}'")
+        # Queries are only rendered to SQL when DEBUG is enabled for this logger
+        current_app.logger.debug("Index route: search_query='%s', search_by='%s', company_filter_applied_query='%s'",
+                                 search_query_term, search_by, issues_query)
 
         if search_query_term:
-            current_app.logger.info(f"Applying search filter for '{search_by}' with term '{search_query_term}'.")
+            current_app.logger.debug("Applying search filter for '%s' with term '%s'.", search_by, search_query_term)
             if search_by == 'capa_id':
                 issues_query = issues_query.filter(CapaIssue.capa_id.ilike(f'%{search_query_term}%'))
             elif search_by == 'part_number': # Assuming 'item_involved' is used for Part Number
@@ -596,10 +525,10 @@ def register_routes(app):
             elif search_by == 'issue_description':
                 issues_query = issues_query.filter(CapaIssue.issue_description.ilike(f'%{search_query_term}%'))
             else:
-                current_app.logger.warning(f"Unknown search_by criteria: '{search_by}'")
-            current_app.logger.info(f"Query after applying search filter: {str(issues_query)}")
+                current_app.logger.warning("Unknown search_by criteria: '%s'", search_by)
+            current_app.logger.debug("Query after applying search filter: %s", issues_query)
         else:
-            current_app.logger.info("No search query term provided, skipping search filtering.")
+            current_app.logger.debug("No search query term provided, skipping search filtering.")
 
         # Sort issues by CAPA ID descending so the newest CAPA appears first
         issues = issues_query.order_by(CapaIssue.capa_id.desc()).all()
@@ -619,121 +548,54 @@ def register_routes(app):
         flash('CAPA issue successfully soft-deleted.', 'success')
         return redirect(url_for('index'))
 
-    @app.route('/api/machine_names')
-    @login_required
-    def api_machine_names():
-        s_company_id = session.get('selected_company_id')
-        query = db.session.query(distinct(CapaIssue.machine_name)).filter(CapaIssue.machine_name.isnot(None), CapaIssue.machine_name != '')
+    def autocomplete_response(index_name):
+        """Serve an autocomplete list from the cached index, honouring `prefix`/`limit` and If-None-Match."""
+        company_id = get_company_context().filter_company_id
+        if company_id == -1:  # Company context could not be resolved
+            return jsonify([])
 
-        if current_user.role == 'super_admin' and s_company_id == 'all':
-            # Super admin viewing all companies, no additional company filter needed on query
-            pass
-        elif s_company_id is not None and s_company_id != 'all':
-            try:
-                company_id_int = int(s_company_id)
-                query = query.filter(CapaIssue.company_id == company_id_int)
-            except ValueError:
-                app.logger.error(f"Invalid company_id '{s_company_id}' in session for api_machine_names for user {current_user.username}.")
-                flash('Invalid company selection for machine names.', 'danger') # User-facing message
-                return jsonify([]) # Return empty list on error
-        elif current_user.role != 'super_admin': # Regular user
-            if current_user.company_id:
-                query = query.filter(CapaIssue.company_id == current_user.company_id)
-            else:
-                app.logger.warning(f"User {current_user.username} (role: {current_user.role}) has no company_id for api_machine_names.")
-                flash('Your user profile is not associated with a company.', 'warning')
-                return jsonify([])
-        elif current_user.role == 'super_admin' and s_company_id is None:
-            # Super admin with no company_id in session (should be 'all' or a specific ID after login)
-            # This case implies an issue with session initialization, but we'll default to 'all' for safety.
-            app.logger.warning(f"Super admin {current_user.username} has no selected_company_id in session for api_machine_names. Defaulting to all.")
-            pass # No filter, effectively 'all'
+        prefix = request.args.get('prefix', '').strip()
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+        values = autocomplete_indexes[index_name].get(company_id)
+        etag = hashlib.sha1(
+            f"{index_name}:{company_id}:{values.version}:{prefix.lower()}:{limit}".encode('utf-8')).hexdigest()
+
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
         else:
-            # Fallback for any other unexpected state or if a regular user somehow has s_company_id == 'all'
-            app.logger.error(f"Unexpected company session state for api_machine_names user {current_user.username}, role {current_user.role}, session company ID {s_company_id}.")
-            flash('Could not determine company context for machine names.', 'danger')
-            return jsonify([])
+            response = jsonify(values.with_prefix(prefix, limit))
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = f'private, max-age={AUTOCOMPLETE_MAX_AGE_SECONDS}'
+        return response
 
+    @app.route('/api/machine_names')
+    @login_required
+    def api_machine_names():
         try:
-            machine_names_result = query.order_by(CapaIssue.machine_name).all()
-            machine_names = [item[0] for item in machine_names_result if item[0]] # Ensure name is not None/empty before adding
-            return jsonify(machine_names)
+            return autocomplete_response('capa_machine_names')
         except Exception as e:
-            app.logger.error(f"Error executing query for machine names: {e}")
+            app.logger.error("Error executing query for machine names: %s", e)
             return jsonify({'error': 'Could not fetch machine names due to a server error.'}), 500
             
     @app.route('/api/knowledge_machine_names')
     @login_required
     def api_knowledge_machine_names():
-        s_company_id = session.get('selected_company_id')
-        query = db.session.query(distinct(AIKnowledgeBase.machine_name)).filter(AIKnowledgeBase.machine_name.isnot(None), AIKnowledgeBase.machine_name != '')
-
-        if current_user.role == 'super_admin' and s_company_id == 'all':
-            # Super admin viewing all companies, no additional company filter needed on query
-            pass
-        elif s_company_id is not None and s_company_id != 'all':
-            try:
-                company_id_int = int(s_company_id)
-                query = query.filter(AIKnowledgeBase.company_id == company_id_int)
-            except ValueError:
-                app.logger.error(f"Invalid company_id '{s_company_id}' in session for api_knowledge_machine_names for user {current_user.username}.")
-                flash('Invalid company selection for knowledge machine names.', 'danger')
-                return jsonify([])
-        elif current_user.role != 'super_admin': # Regular user
-            if current_user.company_id:
-                query = query.filter(AIKnowledgeBase.company_id == current_user.company_id)
-            else:
-                app.logger.warning(f"User {current_user.username} (role: {current_user.role}) has no company_id for api_knowledge_machine_names.")
-                flash('Your user profile is not associated with a company.', 'warning')
-                return jsonify([])
-        elif current_user.role == 'super_admin' and s_company_id is None:
-            app.logger.warning(f"Super admin {current_user.username} has no selected_company_id in session for api_knowledge_machine_names. Defaulting to all.")
-            pass
-        else:
-            app.logger.error(f"Unexpected company session state for api_knowledge_machine_names user {current_user.username}, role {current_user.role}, session company ID {s_company_id}.")
-            flash('Could not determine company context for knowledge machine names.', 'danger')
-            return jsonify([])
-
         try:
-            machine_names_result = query.order_by(AIKnowledgeBase.machine_name).all()
-            machine_names = [item[0] for item in machine_names_result if item[0]]
-            return jsonify(machine_names)
+            return autocomplete_response('knowledge_machine_names')
         except Exception as e:
-            app.logger.error(f"Error executing query for knowledge machine names: {e}")
+            app.logger.error("Error executing query for knowledge machine names: %s", e)
+            return jsonify({'error': 'Could not fetch knowledge machine names due to a server error.'}), 500
 
     @app.route('/api/customer_names', methods=['GET'])
     @login_required
     def api_customer_names():
-        current_app.logger.info(f"API_CUSTOMER_NAMES: Called by user {current_user.username}")
-        selected_company_id = session.get('selected_company_id')
-        current_app.logger.info(f"API_CUSTOMER_NAMES: Session selected_company_id: {selected_company_id}")
-
-        customer_names_query = db.session.query(distinct(CapaIssue.customer_name)).filter(CapaIssue.customer_name.isnot(None))
-        
-        # Log count before company filtering (if applicable)
-        customer_names_before_filtering = customer_names_query.all()
-        current_app.logger.info(f"API_CUSTOMER_NAMES: Query result count before potential filtering: {len(customer_names_before_filtering)}")
-
-        if selected_company_id and selected_company_id != 'all':
-            try:
-                company_id_int = int(selected_company_id)
-                customer_names_query = customer_names_query.filter(CapaIssue.company_id == company_id_int)
-                current_app.logger.info(f"API_CUSTOMER_NAMES: Filtering by specific company_id: {company_id_int}")
-            except ValueError:
-                current_app.logger.warning(f"API_CUSTOMER_NAMES: Invalid company_id format in session: {selected_company_id}. Returning empty list.")
-                return jsonify([]) 
-        elif selected_company_id == 'all':
-            current_app.logger.info("API_CUSTOMER_NAMES: selected_company_id is 'all'. Not filtering by company.")
-        else: # selected_company_id is None or some other unexpected value not 'all' and not caught by the first 'if'
-            current_app.logger.info("API_CUSTOMER_NAMES: No specific valid company_id ('all' or int) provided. Not filtering by company.")
-
-        customer_names_result = customer_names_query.all()
-        current_app.logger.info(f"API_CUSTOMER_NAMES: Query result count after potential filtering: {len(customer_names_result)}")
-    
-        customer_names = [name[0] for name in customer_names_result if name[0]] # Extract names and filter out None/empty
-        final_customer_names = sorted(list(set(customer_names)))
-        current_app.logger.info(f"API_CUSTOMER_NAMES: Returning customer names: {final_customer_names}")
-        return jsonify(final_customer_names)
+        try:
+            return autocomplete_response('capa_customer_names')
+        except Exception as e:
+            app.logger.error("Error executing query for customer names: %s", e)
+            return jsonify({'error': 'Could not fetch customer names due to a server error.'}), 500
 
     @app.route('/gemba/<int:capa_id>', methods=['GET', 'POST'])
     @login_required
@@ -761,7 +623,11 @@ def register_routes(app):
             # Basic validation
             if not findings or not gemba_photos:
                 flash('Silakan isi temuan dan unggah minimal satu foto bukti.', 'danger')
-                return render_template('gemba_investigation.html', issue=issue)
+                return render_template('gemba_investigation.html', issue=issue, form=CSRFOnlyForm())
+
+            if not claim_submission():
+                flash(DUPLICATE_SUBMISSION_MESSAGE, 'info')
+                return redirect(url_for('view_capa', capa_id=capa_id))
 
             # Process and save all photos
             photo_paths = []
@@ -772,7 +638,8 @@ def register_routes(app):
                 if photo and allowed_file(photo.filename):
                     filename = secure_filename(photo.filename)
                     unique_filename = f"gemba_{capa_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-                    photo.save(os.path.join(upload_dir, unique_filename))
+                    with span('upload.save'):
+                        photo.save(os.path.join(upload_dir, unique_filename))
                     photo_paths.append(unique_filename)
 
             # Create new Gemba Investigation record
@@ -798,14 +665,14 @@ def register_routes(app):
                 try:
                     trigger_rca_analysis(capa_id)
                 except Exception as ai_error:
-                    print(
-                        f"Error triggering AI RCA for CAPA ID {capa_id}: {ai_error}")
+                    app.logger.error("Error triggering AI RCA for CAPA ID %s: %s", capa_id, ai_error)
                     flash(
                         f'Gemba investigation submitted, but AI Root Cause Analysis failed: {ai_error}', 'warning')
 
                 return redirect(url_for('view_capa', capa_id=capa_id))
             except Exception as e:
                 db.session.rollback()
+                release_submission()
                 flash(f'Error saving Gemba investigation: {str(e)}', 'danger')
 
         # GET request or form submission failed
@@ -815,7 +682,7 @@ def register_routes(app):
     @app.route('/new', methods=['GET', 'POST'])
     @login_required
     def new_capa():
-        form = FlaskForm()  # Instantiate the form
+        form = CSRFOnlyForm()  # Instantiate the form
 
         if request.method == 'POST':
             customer_name = request.form.get('customer_name')
@@ -848,6 +715,32 @@ def register_routes(app):
                 flash('Invalid date format. Please use YYYY-MM-DD.', 'danger')
                 return render_template('new_capa.html', form=form)
 
+            for photo_file in initial_photos_files:
+                if photo_file and photo_file.filename and not allowed_file(photo_file.filename):
+                    flash(
+                        f'File type not allowed for {secure_filename(photo_file.filename)}.', 'danger')
+                    return render_template('new_capa.html', form=form)
+
+            # Determine company_id for the new CAPA
+            company_context = get_company_context()
+            company_id_to_assign = None
+            if current_user.role == 'super_admin':
+                if company_context.selected_company_id is None or company_context.is_all:
+                    flash('Super admins must select a specific company from the dropdown before creating a new CAPA.', 'danger')
+                    return redirect(url_for('new_capa')) # Or perhaps url_for('index')
+                # The context only resolves to companies that exist in the Company table
+                company_id_to_assign = company_context.selected_company_id
+            else: # Regular user
+                if not current_user.company_id:
+                    flash('Your user profile is not associated with a company. Cannot create CAPA. Please contact an administrator.', 'danger')
+                    return redirect(url_for('index')) # Or a more appropriate page
+                company_id_to_assign = current_user.company_id
+
+            # Claimed once the submission is valid; released again if saving it fails
+            if not claim_submission():
+                flash(DUPLICATE_SUBMISSION_MESSAGE, 'info')
+                return redirect(url_for('index'))
+
             # Process and save uploaded photos temporarily
             for photo_file in initial_photos_files:
                 if photo_file and allowed_file(photo_file.filename):
@@ -858,7 +751,8 @@ def register_routes(app):
                     temp_photo_path = os.path.join(
                         upload_dir, unique_filename_temp)
                     try:
-                        photo_file.save(temp_photo_path)
+                        with span('upload.save'):
+                            photo_file.save(temp_photo_path)
                         saved_photo_filenames.append(unique_filename_temp)
                     except Exception as e_save:
                         flash(
@@ -869,44 +763,9 @@ def register_routes(app):
                                 try:
                                     os.remove(sf_path)
                                 except OSError as e_remove_cleanup:
-                                    app.logger.error(
-                                        f"Error removing photo {sf_path} during save error cleanup: {e_remove_cleanup}")
+                                    app.logger.error("Error removing photo %s during save error cleanup: %s", sf_path, e_remove_cleanup)
+                        release_submission()
                         return render_template('new_capa.html', form=form)
-                elif photo_file and photo_file.filename:  # If file exists but not allowed
-                    flash(
-                        f'File type not allowed for {secure_filename(photo_file.filename)}.', 'danger')
-                    for sf_name in saved_photo_filenames:  # Clean up already saved photos
-                        sf_path = os.path.join(upload_dir, sf_name)
-                        if os.path.exists(sf_path):
-                            try:
-                                os.remove(sf_path)
-                            except OSError as e_remove_cleanup:
-                                app.logger.error(
-                                    f"Error removing photo {sf_path} during type error cleanup: {e_remove_cleanup}")
-                    return render_template('new_capa.html', form=form)
-
-            # Determine company_id for the new CAPA
-            company_id_to_assign = None
-            if current_user.role == 'super_admin':
-                s_company_id = session.get('selected_company_id')
-                if not s_company_id or s_company_id == 'all':
-                    flash('Super admins must select a specific company from the dropdown before creating a new CAPA.', 'danger')
-                    return redirect(url_for('new_capa')) # Or perhaps url_for('index')
-                try:
-                    company_id_to_assign = int(s_company_id)
-                    # Optional: Verify company_id_to_assign exists in Company table
-                    company_exists = Company.query.get(company_id_to_assign)
-                    if not company_exists:
-                        flash(f'Selected company (ID: {company_id_to_assign}) does not exist. Please select a valid company.', 'danger')
-                        return redirect(url_for('new_capa'))
-                except ValueError:
-                    flash('Invalid company ID selected in session. Please re-select a company.', 'danger')
-                    return redirect(url_for('new_capa'))
-            else: # Regular user
-                if not current_user.company_id:
-                    flash('Your user profile is not associated with a company. Cannot create CAPA. Please contact an administrator.', 'danger')
-                    return redirect(url_for('index')) # Or a more appropriate page
-                company_id_to_assign = current_user.company_id
 
             # Create new CAPA Issue (without photo paths initially)
             new_issue = CapaIssue(
@@ -934,8 +793,7 @@ def register_routes(app):
                         os.rename(original_path, final_path)
                         final_photo_filenames.append(final_filename)
                     except OSError as e_rename:
-                        app.logger.error(
-                            f"Error renaming photo {temp_filename} to {final_filename}: {e_rename}. Keeping temp name.")
+                        app.logger.error("Error renaming photo %s to %s: %s. Keeping temp name.", temp_filename, final_filename, e_rename)
                         # Keep temp name, will lack capa_id prefix but photo isn't lost
                         final_photo_filenames.append(temp_filename)
 
@@ -945,12 +803,20 @@ def register_routes(app):
                 new_issue.status = 'Gemba Pending'
                 db.session.commit()  # Second commit to save photo paths and status update
 
+                # Retrieve RCA knowledge while the Gemba investigation is being done
+                try:
+                    prefetch_rca_knowledge(new_issue.capa_id, issue_description, machine_name)
+                except Exception as prefetch_error:
+                    app.logger.warning("Could not schedule RCA knowledge retrieval for CAPA ID %s: %s",
+                                       new_issue.capa_id, prefetch_error)
+
                 flash(
                     f'New CAPA issue (ID: {new_issue.capa_id}) created successfully with {len(final_photo_filenames)} photo(s)! Please complete the Gemba Investigation.', 'success')
                 return redirect(url_for('gemba_investigation', capa_id=new_issue.capa_id))
 
             except Exception as e:
                 db.session.rollback()
+                release_submission()
                 flash(f'Error creating CAPA issue: {str(e)}', 'danger')
                 # Clean up all potentially saved photos (temp or final names)
                 cleanup_candidates = set(
@@ -961,8 +827,7 @@ def register_routes(app):
                         try:
                             os.remove(full_p_path)
                         except OSError as e_remove:
-                            app.logger.error(
-                                f"Error removing photo {full_p_path} during rollback: {e_remove}")
+                            app.logger.error("Error removing photo %s during rollback: %s", full_p_path, e_remove)
 
         # GET request: display the form with a CSRF token
         return render_template('new_capa.html', form=form)
@@ -970,11 +835,7 @@ def register_routes(app):
     @app.route('/view/<int:capa_id>')
     @login_required
     def view_capa(capa_id):
-        issue = CapaIssue.query.options(
-            db.joinedload(CapaIssue.root_cause),  # Eager load related data
-            db.joinedload(CapaIssue.action_plan),
-            db.joinedload(CapaIssue.evidence)
-        ).get_or_404(capa_id)
+        issue = CapaIssue.query_for('detail').get_or_404(capa_id)
         form = CSRFOnlyForm()
         return render_template('view_capa.html', issue=issue, form=form)
 
@@ -1013,6 +874,10 @@ def register_routes(app):
             flash('Silakan isi minimal satu analisis why.', 'danger')
             return redirect(url_for('view_capa', capa_id=capa_id))
 
+        if not claim_submission():
+            flash(DUPLICATE_SUBMISSION_MESSAGE, 'info')
+            return redirect(url_for('view_capa', capa_id=capa_id))
+
         # Set the whys using our new property
         rc.user_adjusted_whys = why_inputs
         rc.rc_submission_timestamp = datetime.utcnow()  # Update timestamp
@@ -1050,14 +915,21 @@ def register_routes(app):
             flash(
                 'Akar Masalah disesuaikan berhasil! Memicu rekomendasi Rencana Tindakan AI baru...', 'success')
 
+            # Encode the final WHYs once, for the action-plan retrieval and the knowledge base
+            try:
+                capa_whys_embedding(issue, rc.user_adjusted_whys_json)
+                db.session.commit()
+            except Exception as embed_error:
+                db.session.rollback()
+                app.logger.warning("Could not store the WHYs embedding of CAPA ID %s: %s", capa_id, embed_error)
+
             # --- Trigger AI Action Plan Recommendation ---
             try:
                 trigger_action_plan_recommendation(capa_id)
                 # Status remains 'Action Pending' until user submits the plan details
             except Exception as ai_error:
                 # Log the error, flash a warning that AI action plan failed
-                print(
-                    f"Error triggering AI Action Plan for CAPA ID {capa_id}: {ai_error}")
+                app.logger.error("Error triggering AI Action Plan for CAPA ID %s: %s", capa_id, ai_error)
                 flash(
                     f'Adjusted Root Cause submitted, but AI Action Plan recommendation failed: {ai_error}', 'warning')
             # -----------------------------------------
@@ -1204,7 +1076,7 @@ def register_routes(app):
             'last_updated': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         }
 
-        ap.user_adjusted_actions_json = json.dumps(adjusted_actions)
+        ap.user_adjusted_actions_json = adjusted_actions
 
         # Untuk kompatibilitas dengan versi lama
         ap.user_adjusted_temp_action = request.form.get(
@@ -1268,7 +1140,8 @@ def register_routes(app):
         if evidence_photo and allowed_file(evidence_photo.filename):
             filename = secure_filename(evidence_photo.filename)
             unique_filename = f'{datetime.utcnow().strftime("%Y%m%d%H%M%S")}_{filename}'
-            evidence_photo.save(os.path.join(UPLOAD_FOLDER, unique_filename))
+            with span('upload.save'):
+                evidence_photo.save(os.path.join(UPLOAD_FOLDER, unique_filename))
 
             # Ambil deskripsi bila ada
             evidence_description = request.form.get('evidence_description', '')
@@ -1284,8 +1157,7 @@ def register_routes(app):
                 # Periksa apakah tindakan yang akan diberi bukti sudah ditandai sebagai selesai
                 if issue.action_plan and issue.action_plan.user_adjusted_actions_json:
                     try:
-                        action_plan_data = json.loads(
-                            issue.action_plan.user_adjusted_actions_json)
+                        action_plan_data = issue.action_plan.user_adjusted_actions_json
 
                         # Periksa apakah tindakan yang dipilih sudah selesai
                         if action_type == 'temporary' and len(action_plan_data.get('temp_actions', [])) > action_index:
@@ -1299,7 +1171,7 @@ def register_routes(app):
                                     'Tindakan ini sudah ditandai selesai. Tidak dapat menambahkan bukti baru.', 'warning')
                                 return redirect(url_for('view_capa', capa_id=capa_id))
                     except Exception as e:
-                        print(f"Error checking action status: {str(e)}")
+                        app.logger.error("Error checking action status: %s", e)
                         # Biarkan proses berlanjut jika terjadi kesalahan
             else:
                 action_index = None
@@ -1319,19 +1191,18 @@ def register_routes(app):
             # Perbarui status tindakan jika terkait dengan tindakan tertentu
             if action_type and action_index is not None and issue.action_plan and issue.action_plan.user_adjusted_actions_json:
                 try:
-                    action_plan_data = json.loads(
-                        issue.action_plan.user_adjusted_actions_json)
+                    action_plan_data = issue.action_plan.user_adjusted_actions_json
 
                     if action_type == 'temporary' and len(action_plan_data.get('temp_actions', [])) > action_index:
                         action_plan_data['temp_actions'][action_index]['completed'] = True
                     elif action_type == 'preventive' and len(action_plan_data.get('prev_actions', [])) > action_index:
                         action_plan_data['prev_actions'][action_index]['completed'] = True
 
-                    issue.action_plan.user_adjusted_actions_json = json.dumps(
-                        action_plan_data)
+                    # Nested changes are not tracked by MutableDict, mark the column dirty explicitly
+                    flag_modified(issue.action_plan, 'user_adjusted_actions_json')
                     db.session.commit()
                 except Exception as e:
-                    print(f"Error updating action plan status: {str(e)}")
+                    app.logger.error("Error updating action plan status: %s", e)
 
             flash('Bukti telah berhasil diupload.', 'success')
         else:
@@ -1384,13 +1255,14 @@ def register_routes(app):
                         os.remove(os.path.join(UPLOAD_FOLDER,
                                   evidence.evidence_photo_path))
                     except Exception as e:
-                        print(f"Error deleting old photo: {str(e)}")
+                        app.logger.error("Error deleting old photo: %s", e)
 
                 # Save new photo
                 filename = secure_filename(evidence_photo.filename)
                 unique_filename = f'{datetime.utcnow().strftime("%Y%m%d%H%M%S")}_{filename}'
-                evidence_photo.save(os.path.join(
-                    UPLOAD_FOLDER, unique_filename))
+                with span('upload.save'):
+                    evidence_photo.save(os.path.join(
+                        UPLOAD_FOLDER, unique_filename))
                 evidence.evidence_photo_path = unique_filename
             else:
                 flash('Format file tidak valid.', 'danger')
@@ -1420,16 +1292,9 @@ def register_routes(app):
             flash('Status CAPA tidak memungkinkan penutupan saat ini.', 'danger')
             return redirect(url_for('view_capa', capa_id=capa_id))
 
-        # Pastikan semua tindakan memiliki bukti (opsional)
-        if issue.action_plan and issue.action_plan.user_adjusted_actions_json:
-            action_plan_data = json.loads(
-                issue.action_plan.user_adjusted_actions_json)
-            # Removed the logic that automatically flags all actions as completed on close.
-            # The 'completed' status should now only be set when evidence is submitted
-            # or potentially through manual edits if implemented elsewhere.
-            # We still might want to save the JSON if other modifications happened,
-            # but for now, we remove the automatic completion flag.
-            # issue.action_plan.user_adjusted_actions_json = json.dumps(action_plan_data) # Commented out or remove if no other changes needed here
+        # Actions are not automatically flagged as completed on close.
+        # The 'completed' status is only set when evidence is submitted
+        # or potentially through manual edits if implemented elsewhere.
 
         # Update status CAPA
         issue.status = 'Closed'
@@ -1439,14 +1304,11 @@ def register_routes(app):
         try:
             knowledge_stored = store_knowledge_on_capa_close(capa_id)
             if knowledge_stored:
-                print(
-                    f"Successfully stored consolidated AI knowledge for CAPA ID {capa_id} upon closure.")
+                app.logger.info("Successfully stored consolidated AI knowledge for CAPA ID %s upon closure.", capa_id)
             else:
-                print(
-                    f"Failed to store or no data to store for AI knowledge for CAPA ID {capa_id} upon closure.")
+                app.logger.warning("Failed to store or no data to store for AI knowledge for CAPA ID %s upon closure.", capa_id)
         except Exception as e:
-            print(
-                f"Error storing AI knowledge upon closing CAPA ID {capa_id}: {e}")
+            app.logger.error("Error storing AI knowledge upon closing CAPA ID %s: %s", capa_id, e)
             # Optionally, flash a warning to the user, but for now, just log it.
 
         flash('CAPA telah berhasil ditutup.', 'success')
@@ -1455,13 +1317,7 @@ def register_routes(app):
     @app.route('/report/<int:capa_id>/pdf')
     @login_required
     def generate_pdf_report(capa_id):
-        issue = CapaIssue.query.options(
-            db.joinedload(CapaIssue.gemba_investigation),
-            db.joinedload(CapaIssue.root_cause),
-            db.joinedload(CapaIssue.action_plan),
-            db.joinedload(CapaIssue.evidence),
-            db.joinedload(CapaIssue.creator) # Ensure creator is loaded
-        ).get_or_404(capa_id)
+        issue = CapaIssue.query_for('report').get_or_404(capa_id)
 
         # Convert timestamps to local timezone
         if issue.submission_timestamp:
@@ -1506,10 +1362,10 @@ def register_routes(app):
                         if os.path.exists(abs_path):
                             evidence_photo_abs_paths[evidence_item.evidence_id] = abs_path
                         else:
-                            print(f"Evidence photo not found at {abs_path} for evidence_id {evidence_item.evidence_id}")
+                            app.logger.warning("Evidence photo not found at %s for evidence_id %s", abs_path, evidence_item.evidence_id)
                             evidence_photo_abs_paths[evidence_item.evidence_id] = '' # Provide empty string if not found
                     except Exception as e_path:
-                        print(f"Error creating path for evidence_id {evidence_item.evidence_id}: {e_path}")
+                        app.logger.error("Error creating path for evidence_id %s: %s", evidence_item.evidence_id, e_path)
                         evidence_photo_abs_paths[evidence_item.evidence_id] = ''
                 else:
                     evidence_photo_abs_paths[evidence_item.evidence_id] = ''
@@ -1564,14 +1420,15 @@ def register_routes(app):
             '''
 
             # Generate PDF using pdfkit with additional CSS
-            pdf_bytes = pdfkit.from_string(
-                html_out,
-                False,
-                options=options,
-                css=os.path.join('static', 'css', 'custom.css') if os.path.exists(
-                    os.path.join('static', 'css', 'custom.css')) else None,
-                configuration=pdfkit_config  # Pass the configuration here
-            )
+            with span('pdf.render'):
+                pdf_bytes = pdfkit.from_string(
+                    html_out,
+                    False,
+                    options=options,
+                    css=os.path.join('static', 'css', 'custom.css') if os.path.exists(
+                        os.path.join('static', 'css', 'custom.css')) else None,
+                    configuration=pdfkit_config  # Pass the configuration here
+                )
 
             # Create and return the response
             response = make_response(pdf_bytes)
@@ -1581,6 +1438,6 @@ def register_routes(app):
             return response
 
         except Exception as e:
-            print(f"Error generating PDF for CAPA ID {capa_id}: {e}")
+            app.logger.error("Error generating PDF for CAPA ID %s: %s", capa_id, e)
             flash(f'Error generating PDF report: {str(e)}', 'danger')
             return redirect(url_for('view_capa', capa_id=capa_id))
@@ -28,18 +28,36 @@ if __name__ == '__main__':
     host = os.getenv('FLASK_RUN_HOST', '0.0.0.0') # Get host from .env or default
     port = int(os.getenv('FLASK_RUN_PORT', 5000)) # Get port from .env or default
     threads = int(os.getenv('WAITRESS_THREADS', 4)) # Get threads from .env or default
+    # Worker processes; more than 1 enables the pre-fork mode (see prefork.py). 'auto' = one per CPU core
+    workers_setting = os.getenv('WAITRESS_WORKERS', '1')
+    workers = (os.cpu_count() or 1) if workers_setting == 'auto' else int(workers_setting)
+    # Seconds a stopping worker gets to finish in-flight requests (AI calls can take a while)
+    graceful_timeout = int(os.getenv('WAITRESS_GRACEFUL_TIMEOUT', 60))
 
     # Ensure FLASK_ENV is set to 'production' in your .env file for security and performance
     flask_env = os.getenv('FLASK_ENV', 'not_set')
     if flask_env != 'production':
         print(f"Warning: FLASK_ENV is '{flask_env}'. It should be 'production' for a production deployment.")
 
+    if workers > 1 and not hasattr(os, 'fork'):
+        print(f"Warning: WAITRESS_WORKERS={workers} needs os.fork, which this platform does not have. "
+              f"Starting a single process instead.")
+        workers = 1
+
     print(f"Attempting to start production server with Waitress...")
-    print(f"Serving Flask app on http://{host}:{port} with {threads} threads.")
+    if workers > 1:
+        print(f"Serving Flask app on http://{host}:{port} with {workers} worker processes x {threads} threads.")
+    else:
+        print(f"Serving Flask app on http://{host}:{port} with {threads} threads.")
     
     try:
-        # THIS IS THE LINE THAT ACTUALLY STARTS THE SERVER
-        serve(app, host=host, port=port, threads=threads)
+        if workers > 1:
+            # The app (and the embedding model) is already loaded here, so the workers share it
+            from prefork import serve_prefork
+            serve_prefork(app, host, port, workers, threads, graceful_timeout)
+        else:
+            # THIS IS THE LINE THAT ACTUALLY STARTS THE SERVER
+            serve(app, host=host, port=port, threads=threads)
     except Exception as e:
         print(f"Critical Error starting Waitress server: {e}")
         print("Please check your .env configuration, Flask app, and ensure the port is not in use.")
@@ -0,0 +1,85 @@
+import functools
+import threading
+from concurrent.futures import Future
+
+# --- Single-flight calls ---
+# Duplicate work started at the same time (a double-clicked form, two tabs submitting the
+# same CAPA) should be done once: the first caller for a key runs the function, callers
+# arriving while it runs wait for it and get the same result or exception. Nothing is
+# cached afterwards, so the next call after it finished runs again. share() does the same
+# for work run asynchronously (e.g. queued as a job) and returns a Future. The guard is per
+# process; duplicates reaching different worker processes are stopped by the forms'
+# idempotency keys (see idempotency.py).
+
+
+class SingleFlight:
+    """At most one call per key at a time; concurrent callers with the same key share its outcome."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future of the call in progress
+
+    def do(self, key, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)`, or wait for the call already running for `key`.
+
+        Returns (result, shared), where `shared` is True for a caller that waited for
+        another caller's call. An exception of the call is raised in every caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def share(self, key, start):
+        """Start asynchronous work with `start()`, which returns its Future, or join the work in flight for `key`.
+
+        Returns (future, shared). The future gets the work's outcome (also when it is
+        cancelled); `key` is free again once the work is done.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future, True
+
+        try:
+            work = start()
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+        work.add_done_callback(functools.partial(self._work_done, key, future))
+        return future, False
+
+    def _forget(self, key):
+        with self._lock:
+            del self._calls[key]
+
+    def _work_done(self, key, future, work):
+        # Freed first, so a caller reacting to the outcome can start the work again
+        self._forget(key)
+        if work.cancelled():
+            future.cancel()
+        elif work.exception() is not None:
+            future.set_exception(work.exception())
+        else:
+            future.set_result(work.result())
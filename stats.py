@@ -0,0 +1,13 @@
+import math
+
+
+def percentile(sorted_values, fraction, default=None):
+    """Nearest-rank percentile of an already sorted list (`default` when empty).
+
+    The smallest value with at least `fraction` of the values at or below it.
+    """
+    if not sorted_values:
+        return default
+    # Rounded first so float noise (0.95 * 100 = 95.00000000000001) does not add a rank
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
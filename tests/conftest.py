@@ -0,0 +1,91 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+# Add the project root to the Python path to allow importing app modules
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+# Set before the app (and config) is imported: a named in-memory SQLite database, shared
+# by every connection of the pool, and the offline LLM backend without its simulated latency
+os.environ.setdefault('DATABASE_URL', 'sqlite:///file:capa_tests?mode=memory&cache=shared&check_same_thread=false&uri=true')
+os.environ.setdefault('LLM_BACKEND', 'fake')
+os.environ.setdefault('FAKE_LLM_LATENCY_MS', '0')
+os.environ.setdefault('FAKE_LLM_LATENCY_JITTER_MS', '0')
+
+TEST_PASSWORD = 'test-password'
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app as flask_app
+    from models import db
+
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        # Keeps the in-memory database alive for the whole session
+        keep_alive = db.engine.connect()
+        db.create_all()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+    keep_alive.close()
+
+
+@pytest.fixture(scope='session')
+def company(app):
+    from models import db, Company, User
+
+    with app.app_context():
+        company = Company(company_code='TEST', name='Test Company')
+        db.session.add(company)
+        db.session.commit()
+        user = User(username='tester', email='tester@example.com', role='user', company_id=company.id)
+        user.set_password(TEST_PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        return company.id
+
+
+@pytest.fixture
+def client(app, company):
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'tester', 'password': TEST_PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def make_capa(app, company):
+    """Factory adding a CAPA with every stage filled in (Gemba, RCA, action plan, evidence)."""
+    def make(evidence_count=2, customer_name='PT Test'):
+        with app.app_context():
+            return _add_full_capa(company, evidence_count, customer_name)
+    return make
+
+
+def _add_full_capa(company_id, evidence_count, customer_name):
+    from models import db, ActionPlan, CapaIssue, Evidence, GembaInvestigation, RootCause, User
+
+    creator = User.query.filter_by(username='tester').one()
+    issue = CapaIssue(customer_name=customer_name, item_involved='Box 24x18', issue_date=date(2025, 1, 15),
+                      issue_description='Lem terlalu tebal pada flap box', machine_name='Folder Gluer 3',
+                      batch_number='B-001', status='Evidence Pending', company_id=company_id,
+                      created_by_user_id=creator.id, initial_photos_json=[])
+    db.session.add(issue)
+    db.session.flush()
+    db.session.add(GembaInvestigation(capa_id=issue.capa_id, findings='Nozzle lem aus', gemba_photos_json=[]))
+    db.session.add(RootCause(capa_id=issue.capa_id, user_adjusted_whys_json=['why 1', 'why 2', 'akar masalah'],
+                             user_adjusted_root_cause='akar masalah'))
+    db.session.add(ActionPlan(capa_id=issue.capa_id, user_adjusted_actions_json={
+        'temp_actions': [{'action_text': 'Sortir ulang', 'pic': 'QC', 'due_date': '2025-02-01', 'completed': True}],
+        'prev_actions': [{'action_text': 'Ganti nozzle', 'pic': 'MTC', 'due_date': '2025-02-15', 'completed': False}],
+    }))
+    for index in range(evidence_count):
+        db.session.add(Evidence(capa_id=issue.capa_id, evidence_photo_path=f'evidence_{index}.jpg',
+                                evidence_description='Bukti', action_type='temporary', action_index=0))
+    db.session.commit()
+    return issue.capa_id
@@ -0,0 +1,117 @@
+import json
+
+import pytest
+
+MACHINE_NAME = 'Folder Gluer 3'  # The machine of the conftest CAPAs
+SOURCE_CAPA_ID = 999
+
+
+@pytest.fixture
+def repeat_issue(app, company, monkeypatch):
+    """Makes every CAPA a repeat issue of a closed CAPA with the given adjusted WHYs."""
+    import ai_service
+
+    def knowledge(whys, similarity=0.99):
+        item = {
+            'adjusted_whys': json.dumps(whys),
+            'context': {'source_capa_id': SOURCE_CAPA_ID, 'company_id': company, 'machine_name': MACHINE_NAME,
+                        'issue_description': 'Lem terlalu tebal', 'similarity_score': similarity},
+        }
+        monkeypatch.setattr(ai_service, 'get_rca_knowledge_for_capa', lambda *args, **kwargs: [item])
+        return item
+
+    monkeypatch.setattr(ai_service, 'capa_issue_embedding', lambda issue: None)
+    monkeypatch.setattr(ai_service, 'AI_FAST_PATH_ENABLED', True)
+    monkeypatch.setattr(ai_service, 'AI_FAST_PATH_REFINE', False)
+    return knowledge
+
+
+def rca_suggestion(app, capa_id):
+    from models import AICallLog, RootCause
+
+    with app.app_context():
+        root_cause = RootCause.query.filter_by(capa_id=capa_id).one()
+        llm_calls = AICallLog.query.filter_by(capa_id=capa_id, call_type='rca').count()
+        return json.loads(root_cause.ai_suggested_rc_json), llm_calls
+
+
+def test_repeat_issue_copies_the_closed_capa_analysis(app, make_capa, repeat_issue):
+    from ai_service import trigger_rca_analysis
+
+    repeat_issue(['why 1', 'why 2', 'why 3', 'why 4', 'why 5'])
+    capa_id = make_capa()
+    with app.app_context():
+        assert trigger_rca_analysis(capa_id) is True
+
+    suggestion, llm_calls = rca_suggestion(app, capa_id)
+    assert suggestion['source_capa_id'] == SOURCE_CAPA_ID
+    assert suggestion['root_cause'] == 'why 5'
+    assert llm_calls == 0
+
+
+def test_bulk_regeneration_skips_the_fast_path(app, make_capa, repeat_issue):
+    from ai_scheduler import BULK
+    from ai_service import trigger_rca_analysis
+
+    repeat_issue(['why 1', 'why 2', 'why 3', 'why 4', 'why 5'])
+    capa_id = make_capa()
+    with app.app_context():
+        future = trigger_rca_analysis(capa_id, priority=BULK, wait=False, use_fast_path=False)
+        assert future.result(timeout=30) is True
+
+    suggestion, llm_calls = rca_suggestion(app, capa_id)
+    assert suggestion.get('source_capa_id') is None
+    assert llm_calls == 1
+
+
+def fast_path_suggestion(company, whys, similarity=0.99, machine_name=MACHINE_NAME, company_id=None):
+    from types import SimpleNamespace
+
+    from ai_service import _rca_fast_path_suggestion
+
+    snapshot = SimpleNamespace(company_id=company, machine_name=MACHINE_NAME)
+    item = {
+        'adjusted_whys': json.dumps(whys),
+        'context': {'source_capa_id': SOURCE_CAPA_ID, 'company_id': company if company_id is None else company_id,
+                    'machine_name': machine_name, 'similarity_score': similarity},
+    }
+    result = _rca_fast_path_suggestion(snapshot, [item])
+    return result[0] if result else None
+
+
+@pytest.mark.parametrize('whys, expected', [
+    (['w1', 'w2', 'w3'], {'why1': 'w1', 'why2': 'w2', 'why3': '', 'why4': '', 'root_cause': 'w3'}),
+    (['w1', 'w2', 'w3', 'w4', 'w5'], {'why1': 'w1', 'why2': 'w2', 'why3': 'w3', 'why4': 'w4', 'root_cause': 'w5'}),
+    # As edit_rca stores it: the fifth WHY is the root cause, later ones are dropped
+    (['w1', 'w2', 'w3', 'w4', 'w5', 'w6'], {'why1': 'w1', 'why2': 'w2', 'why3': 'w3', 'why4': 'w4', 'root_cause': 'w5'}),
+])
+def test_copied_whys_map_to_the_root_cause_like_edit_rca(company, repeat_issue, whys, expected):
+    suggestion = fast_path_suggestion(company, whys)
+    assert suggestion.model_dump(exclude={'source_capa_id'}) == expected
+    assert suggestion.source_capa_id == SOURCE_CAPA_ID
+
+
+def test_fast_path_needs_the_minimum_similarity(company, repeat_issue, monkeypatch):
+    import ai_service
+
+    monkeypatch.setattr(ai_service, 'AI_FAST_PATH_MIN_SIMILARITY', 0.95)
+    assert fast_path_suggestion(company, ['w1', 'w2'], similarity=0.95) is not None
+    assert fast_path_suggestion(company, ['w1', 'w2'], similarity=0.94) is None
+
+
+def test_fast_path_needs_the_same_company_and_machine(company, repeat_issue):
+    assert fast_path_suggestion(company, ['w1', 'w2'], company_id=company + 1) is None
+    assert fast_path_suggestion(company, ['w1', 'w2'], machine_name='Slotter 1') is None
+
+
+def test_dissimilar_issue_calls_the_llm(app, make_capa, repeat_issue):
+    from ai_service import trigger_rca_analysis
+
+    repeat_issue(['why 1', 'why 2', 'why 3', 'why 4', 'why 5'], similarity=0.5)
+    capa_id = make_capa()
+    with app.app_context():
+        assert trigger_rca_analysis(capa_id) is True
+
+    suggestion, llm_calls = rca_suggestion(app, capa_id)
+    assert suggestion.get('source_capa_id') is None
+    assert llm_calls == 1
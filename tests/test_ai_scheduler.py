@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+
+
+def ai_jobs_for(app, capa_id):
+    from models import AIJob
+
+    with app.app_context():
+        return AIJob.query.filter_by(capa_id=capa_id).count()
+
+
+def test_concurrent_triggers_share_one_job(app, make_capa, monkeypatch):
+    import ai_service
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_rca(capa_id, refining, use_fast_path):
+        started.set()
+        release.wait(timeout=10)
+        return True
+
+    monkeypatch.setattr(ai_service, '_run_rca_analysis', slow_rca)
+    capa_id = make_capa()
+    with app.app_context():
+        first = ai_service.trigger_rca_analysis(capa_id, wait=False)
+        assert started.wait(timeout=10)
+        second = ai_service.trigger_rca_analysis(capa_id, wait=False)
+        release.set()
+        assert second is first
+        assert first.result(timeout=10) is True
+    assert ai_jobs_for(app, capa_id) == 1
+
+
+def test_submit_leaves_the_callers_session_alone(app, make_capa):
+    from ai_scheduler import BULK, scheduler
+    from models import db, CapaIssue
+
+    capa_id = make_capa()
+    with app.app_context():
+        issue = db.session.get(CapaIssue, capa_id)
+        issue.batch_number = 'B-uncommitted'
+        job_id, future = scheduler.submit('rca', capa_id, issue.company_id, BULK, lambda: 'done')
+        assert future.result(timeout=10) == 'done'
+        assert issue in db.session.dirty
+        db.session.rollback()
+        assert db.session.get(CapaIssue, capa_id).batch_number == 'B-001'
+
+
+class BlockedScheduler:
+    """A fresh scheduler whose workers are all held by bulk jobs until release()."""
+
+    def __init__(self, app, company, workers=1, interactive_reserved=0):
+        from ai_scheduler import AIScheduler, BULK
+
+        self.app = app
+        self.company = company
+        self.scheduler = AIScheduler(workers, interactive_reserved)
+        self.order = []
+        self._gate = threading.Event()
+        self._started = threading.Semaphore(0)
+        with app.app_context():
+            for _ in range(workers - interactive_reserved):
+                self.scheduler.submit('rca', None, company, BULK, self._blocker)
+        for _ in range(workers - interactive_reserved):
+            assert self._started.acquire(timeout=10)
+
+    def _blocker(self):
+        self._started.release()
+        self._gate.wait(timeout=10)
+
+    def submit(self, name, priority, company_id=None):
+        with self.app.app_context():
+            return self.scheduler.submit('rca', None, company_id, priority, self.order.append, name)
+
+    def release(self):
+        self._gate.set()
+        assert self.scheduler.wait_idle(timeout=10)
+
+
+def test_jobs_start_by_priority_then_company_round_robin(app, company):
+    from ai_scheduler import BULK, INTERACTIVE
+
+    blocked = BlockedScheduler(app, company)
+    for name, company_id in [('A0', 1), ('A1', 1), ('A2', 1), ('B0', 2), ('B1', 2)]:
+        blocked.submit(name, BULK, company_id)
+    blocked.submit('I', INTERACTIVE, 1)
+    blocked.release()
+    assert blocked.order == ['I', 'A0', 'B0', 'A1', 'B1', 'A2']
+
+
+def test_interactive_jobs_do_not_wait_behind_bulk_jobs(app, company):
+    from ai_scheduler import BULK, INTERACTIVE
+
+    blocked = BlockedScheduler(app, company, workers=2, interactive_reserved=1)
+    _, bulk = blocked.submit('bulk', BULK)
+    _, interactive = blocked.submit('interactive', INTERACTIVE)
+    interactive.result(timeout=10)
+    assert blocked.order == ['interactive']  # The reserved worker took it; the bulk job still waits
+    assert not bulk.done()
+    blocked.release()
+    assert blocked.order == ['interactive', 'bulk']
+
+
+def test_job_cancelled_in_the_table_does_not_run(app, company):
+    from ai_scheduler import AIJobCancelled, BULK
+    from models import db, AIJob
+
+    blocked = BlockedScheduler(app, company)
+    job_id, future = blocked.submit('cancelled', BULK)
+    blocked.submit('kept', BULK)
+    with app.app_context():
+        db.session.query(AIJob).filter_by(id=job_id).update({AIJob.status: 'cancelled'})
+        db.session.commit()
+    blocked.release()
+    with pytest.raises(AIJobCancelled):
+        future.result(timeout=10)
+    assert blocked.order == ['kept']
+
+
+def test_cancel_queued_cancels_the_futures(app, company):
+    from ai_scheduler import BULK
+    from models import db, AIJob
+
+    blocked = BlockedScheduler(app, company)
+    job_ids_and_futures = [blocked.submit(name, BULK) for name in ('one', 'two')]
+    with app.app_context():
+        assert blocked.scheduler.cancel_queued() == 2
+        statuses = {db.session.get(AIJob, job_id).status for job_id, _ in job_ids_and_futures}
+    assert statuses == {'cancelled'}
+    assert all(future.cancelled() for _, future in job_ids_and_futures)
+    blocked.release()
+    assert blocked.order == []
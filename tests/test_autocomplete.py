@@ -0,0 +1,43 @@
+import pytest
+
+from caches import SortedValues
+
+CUSTOMERS = ['PT Alpha', 'PT Beta', 'PT Gamma']
+
+
+@pytest.mark.parametrize('prefix', ['', 'pt'])
+@pytest.mark.parametrize('limit, expected', [
+    (None, CUSTOMERS),
+    (2, CUSTOMERS[:2]),
+    (0, CUSTOMERS[:1]),  # At least one value, not the whole list
+    (-1, CUSTOMERS[:1]),  # Not sliced from the end
+])
+def test_with_prefix_limit(prefix, limit, expected):
+    assert SortedValues(reversed(CUSTOMERS)).with_prefix(prefix, limit) == expected
+
+
+@pytest.fixture
+def customers(make_capa):
+    for customer_name in CUSTOMERS:
+        make_capa(evidence_count=0, customer_name=customer_name)
+
+
+def test_autocomplete_without_limit_lists_every_value(client, customers):
+    response = client.get('/api/customer_names')
+    assert response.status_code == 200
+    assert set(CUSTOMERS) <= set(response.get_json())
+
+
+@pytest.mark.parametrize('query, expected_count', [
+    ('?limit=0', 1),
+    ('?limit=-5', 1),
+    ('?limit=100000', 2),  # Clamped to AUTOCOMPLETE_MAX_LIMIT
+    ('?prefix=PT%20&limit=-5', 1),
+])
+def test_autocomplete_limit_is_clamped(client, customers, monkeypatch, query, expected_count):
+    import routes
+
+    monkeypatch.setattr(routes, 'AUTOCOMPLETE_MAX_LIMIT', 2)
+    response = client.get(f'/api/customer_names{query}')
+    assert response.status_code == 200
+    assert len(response.get_json()) == expected_count
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+
+@pytest.fixture
+def upload_folder(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def no_knowledge_prefetch(monkeypatch):
+    # The background retrieval started for a new CAPA would compete for the SQLite tables
+    import routes
+
+    monkeypatch.setattr(routes, 'prefetch_rca_knowledge', lambda *args, **kwargs: None)
+
+
+def new_capa_form(key, photo_name):
+    return {
+        'customer_name': 'PT Retry', 'item_involved': 'Box 30x20', 'issue_date': '2025-03-01',
+        'issue_description': 'Print bergeser', 'machine_name': 'Printer 2', 'batch_number': 'B-9',
+        'idempotency_key': key,
+        'initial_photos[]': (io.BytesIO(b'photo'), photo_name),
+    }
+
+
+def capa_count(app):
+    from models import CapaIssue
+
+    with app.app_context():
+        return CapaIssue.query.filter_by(customer_name='PT Retry').count()
+
+
+def test_retry_after_rejected_file_type_is_processed(app, client, upload_folder):
+    before = capa_count(app)
+    response = client.post('/new', data=new_capa_form('retry-type', 'bad.exe'), content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'retry-type' in response.data  # The re-rendered form keeps the key
+
+    response = client.post('/new', data=new_capa_form('retry-type', 'ok.png'), content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert '/gemba/' in response.headers['Location']
+    assert capa_count(app) == before + 1
+
+    # A second submission of the successful form is still a duplicate
+    response = client.post('/new', data=new_capa_form('retry-type', 'ok.png'), content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert '/gemba/' not in response.headers['Location']
+    assert capa_count(app) == before + 1
+
+
+def test_retry_after_failed_photo_save_is_processed(app, client, upload_folder, monkeypatch):
+    before = capa_count(app)
+    original_save = FileStorage.save
+
+    def failing_save(self, *args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(FileStorage, 'save', failing_save)
+    response = client.post('/new', data=new_capa_form('retry-save', 'ok.png'), content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert capa_count(app) == before
+
+    monkeypatch.setattr(FileStorage, 'save', original_save)
+    response = client.post('/new', data=new_capa_form('retry-save', 'ok.png'), content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert '/gemba/' in response.headers['Location']
+    assert capa_count(app) == before + 1
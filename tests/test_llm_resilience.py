@@ -0,0 +1,124 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from fake_llm import FakeLLMClient, FakeLLMError
+from llm_resilience import CircuitBreaker, LLMUnavailableError, ResilientLLMClient
+
+COOLDOWN_SECONDS = 0.05
+
+
+class CountingClient(FakeLLMClient):
+    def __init__(self, **kwargs):
+        super().__init__(latency_ms=0, latency_jitter_ms=0, **kwargs)
+        self.attempts = 0
+
+    def generate_content(self, prompt, response_schema=None, timeout=None):
+        self.attempts += 1
+        return super().generate_content(prompt, response_schema, timeout)
+
+
+class InterruptedClient(CountingClient):
+    def generate_content(self, prompt, response_schema=None, timeout=None):
+        self.attempts += 1
+        raise KeyboardInterrupt
+
+
+def make_breaker(min_calls=2):
+    return CircuitBreaker(window=20, failure_rate=0.5, min_calls=min_calls, cooldown_seconds=COOLDOWN_SECONDS)
+
+
+def open_breaker(breaker):
+    breaker.record(failed=True)
+    breaker.record(failed=True)
+    assert breaker.is_open
+
+
+def make_client(client, breaker=None, deadline_seconds=30, max_retries=2):
+    return ResilientLLMClient(client, timeout_seconds=5, deadline_seconds=deadline_seconds, max_retries=max_retries,
+                              backoff_seconds=0.01, backoff_max_seconds=0.01, max_in_flight=4,
+                              max_in_flight_per_company=2, queue_timeout_seconds=1,
+                              breaker=breaker or make_breaker(min_calls=10))
+
+
+def test_breaker_lets_one_probe_through_after_the_cooldown():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    assert not breaker.allow()
+
+    time.sleep(COOLDOWN_SECONDS * 1.5)
+    assert breaker.allow()
+    assert not breaker.allow()  # Only one probe at a time
+
+    breaker.record(failed=False)
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_failed_probe_keeps_the_breaker_open():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(COOLDOWN_SECONDS * 1.5)
+    assert breaker.allow()
+
+    breaker.cooldown_seconds = 60
+    breaker.record(failed=True)
+    assert breaker.is_open
+    assert not breaker.allow()  # A new cooldown started
+
+
+def test_outcome_of_another_thread_does_not_settle_the_probe():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(COOLDOWN_SECONDS * 1.5)
+    assert breaker.allow()
+
+    # An attempt started before the breaker opened finishes during the probe
+    late = threading.Thread(target=breaker.record, kwargs={'failed': False})
+    late.start()
+    late.join()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_interrupted_probe_is_released():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(COOLDOWN_SECONDS * 1.5)
+    client = make_client(InterruptedClient(), breaker)
+
+    with pytest.raises(KeyboardInterrupt):
+        client.generate_content('prompt')
+    assert breaker.is_open
+    assert breaker.allow()  # Not stuck waiting for the interrupted probe
+
+
+def test_open_breaker_fails_fast_without_calling_the_backend():
+    breaker = make_breaker()
+    breaker.cooldown_seconds = 60
+    open_breaker(breaker)
+    backend = CountingClient()
+
+    with pytest.raises(LLMUnavailableError):
+        make_client(backend, breaker).generate_content('prompt')
+    assert backend.attempts == 0
+
+
+def test_retryable_errors_are_retried_up_to_max_retries():
+    backend = CountingClient(error_rate=1.0)
+    call_log = SimpleNamespace(company_id=None, retries=0)
+
+    with pytest.raises(FakeLLMError):
+        make_client(backend, max_retries=2).generate_content('prompt', call_log=call_log)
+    assert backend.attempts == 3
+    assert call_log.retries == 2
+
+
+def test_no_retry_once_the_deadline_is_too_close():
+    backend = CountingClient(error_rate=1.0)
+
+    with pytest.raises(FakeLLMError):
+        make_client(backend, deadline_seconds=0.5, max_retries=5).generate_content('prompt')
+    assert backend.attempts == 1
@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+# SELECTs per page with the loader profiles of models.CAPA_LOADER_PROFILES. A page whose
+# count grows, or depends on the number of CAPAs or evidence rows, has gained a lazy load.
+QUERY_BUDGETS = {
+    'index': 1,
+    'view_capa': 2,
+    'report_pdf': 2,
+}
+
+
+@contextmanager
+def count_selects(app):
+    from models import db
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def selects_for(app, client, path):
+    # The first request warms the per-process caches (user loader, company context)
+    assert client.get(path).status_code == 200
+    with count_selects(app) as statements:
+        response = client.get(path)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('page, path', [
+    ('index', '/'),
+    ('view_capa', '/view/{capa_id}'),
+    ('report_pdf', '/report/{capa_id}/pdf'),
+])
+def test_query_budget_per_page(app, client, make_capa, page, path):
+    capa_id = make_capa(evidence_count=1)
+    selects = selects_for(app, client, path.format(capa_id=capa_id))
+    assert selects == QUERY_BUDGETS[page]
+
+    # More CAPAs, and a CAPA with more evidence, cost no extra queries
+    make_capa(evidence_count=1)
+    capa_id = make_capa(evidence_count=5)
+    assert selects_for(app, client, path.format(capa_id=capa_id)) == selects
@@ -0,0 +1,11 @@
+def test_submitted_whys_are_encoded_before_the_action_plan_job(app, client, make_capa, monkeypatch):
+    import routes
+
+    calls = []
+    monkeypatch.setattr(routes, 'capa_whys_embedding', lambda issue, whys: calls.append(('encode', list(whys))))
+    monkeypatch.setattr(routes, 'trigger_action_plan_recommendation', lambda capa_id: calls.append(('action_plan', capa_id)))
+    capa_id = make_capa()
+
+    response = client.post(f'/edit_rca/{capa_id}', data={'why_1': 'Nozzle aus', 'why_2': 'Tidak ada jadwal ganti'})
+    assert response.status_code == 302
+    assert calls == [('encode', ['Nozzle aus', 'Tidak ada jadwal ganti']), ('action_plan', capa_id)]
@@ -12,6 +12,9 @@ def from_json_filter(json_string):
     """Safely parse a JSON string for use in templates."""
     if not json_string:
         return {}
+    if not isinstance(json_string, str):
+        # Native JSON columns are already decoded
+        return json_string
     try:
         return json.loads(json_string)
     except json.JSONDecodeError: